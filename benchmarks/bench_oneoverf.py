@@ -0,0 +1,432 @@
+"""
+Benchmarks of the 1/f correction on synthetic ramps (run with `asv run`).
+
+`time_*` benchmarks measure wall time and `peakmem_*` benchmarks the peak memory of
+the process. The `Equivalence` benchmarks track the largest difference between code
+paths that should give the same result and fail when it exceeds the tolerance, so that
+optimizations of one path can be checked against the others. Checks of optional
+dependencies are skipped when they are not installed.
+"""
+import shutil
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+
+from jwst_fourier.oneoverf import (
+    amplifiers,
+    file_backed,
+    kernels,
+    one_over_f,
+    strategies,
+    sweep,
+)
+from jwst_fourier.oneoverf.simulate import simulate_ramp
+
+SUBARRAYS = ["SUB80", "SUB400", "SUBSTRIP256", "FULL"]
+
+# (nints, ngroups) simulated for each subarray, keeping the FULL ramp below ~200 MB
+RAMP_SIZES = {
+    "SUB80": (50, 5),
+    "SUB400": (20, 5),
+    "SUBSTRIP256": (10, 5),
+    "FULL": (4, 3),
+}
+
+# Maximum difference allowed between code paths, in units of the 1/f noise amplitude
+EQUIVALENCE_RTOL = 1e-4
+
+OOF_AMPLITUDE = 5.0
+
+# DQ flags of the DO_NOT_USE and JUMP_DET pixels
+DO_NOT_USE = 1
+JUMP_DET = 4
+
+# Configurations of the parameter sweep benchmarks
+SWEEP_CONFIGS = [
+    dict(),
+    dict(mean_per_frame=True),
+    dict(dq_bits=0),
+    dict(dq_bits=0, mean_per_frame=True),
+]
+
+_ramps = {}
+
+_cubes = {}
+
+
+def get_ramp(subarray: str) -> dict:
+    """Simulated ramp for a subarray, generated once per benchmark process"""
+    if subarray not in _ramps:
+        nints, ngroups = RAMP_SIZES[subarray]
+        _ramps[subarray] = simulate_ramp(
+            subarray,
+            nints=nints,
+            ngroups=ngroups,
+            oof_amplitude=OOF_AMPLITUDE,
+            nan_fraction=1e-3,
+            outlier_fraction=1e-3,
+            seed=42,
+        )
+    return _ramps[subarray]
+
+
+def get_cube(subarray: str) -> dict:
+    """Simulated cube (e.g. rateints) for a subarray, generated once per process"""
+    if subarray not in _cubes:
+        nints, _ = RAMP_SIZES[subarray]
+        _cubes[subarray] = simulate_ramp(
+            subarray,
+            nints=nints,
+            ngroups=0,
+            oof_amplitude=OOF_AMPLITUDE,
+            nan_fraction=1e-3,
+            outlier_fraction=1e-3,
+            seed=42,
+        )
+    return _cubes[subarray]
+
+
+def get_sub_and_weights(subarray: str) -> tuple:
+    """Stack-subtracted ramp and pixel weights, as computed by the correction"""
+    data = get_ramp(subarray)["data"]
+    stacked_ramp, rms = one_over_f.stack_ramp(data)
+    with np.errstate(divide="ignore"):
+        pixel_weights = rms**-2
+    pixel_weights[~np.isfinite(pixel_weights)] = 0.0
+    return data - stacked_ramp, pixel_weights
+
+
+def correct(subarray: str, **kwargs) -> np.ndarray:
+    """Run the full correction on the simulated ramp of a subarray"""
+    data = get_ramp(subarray)["data"]
+    out = np.empty_like(data)
+    one_over_f.correct_oof_data(data, out, subarray, **kwargs)
+    return out
+
+
+class StackRamp:
+    params = (
+        SUBARRAYS,
+        ["median", "sigma_clip", "odd_ratio", "rolling_median", "rolling_mean"],
+    )
+    param_names = ["subarray", "method"]
+    timeout = 600
+
+    def setup(self, subarray, method):
+        self.data = get_ramp(subarray)["data"]
+
+    def time_stack_ramp(self, subarray, method):
+        one_over_f.stack_ramp(self.data, method=method)
+
+    def peakmem_stack_ramp(self, subarray, method):
+        one_over_f.stack_ramp(self.data, method=method)
+
+
+class NoiseMap:
+    params = (SUBARRAYS, [False, True])
+    param_names = ["subarray", "iterative"]
+    timeout = 600
+
+    def setup(self, subarray, iterative):
+        self.sub, self.weights = get_sub_and_weights(subarray)
+        if iterative:
+            self.func = one_over_f.generate_noise_map_iter
+        else:
+            self.func = one_over_f.generate_noise_map
+
+    def time_generate_noise_map(self, subarray, iterative):
+        self.func(self.sub, self.weights, subarray)
+
+    def peakmem_generate_noise_map(self, subarray, iterative):
+        self.func(self.sub, self.weights, subarray)
+
+
+class ComputeOOF:
+    params = SUBARRAYS
+    param_names = ["subarray"]
+
+    def setup(self, subarray):
+        sub, weights = get_sub_and_weights(subarray)
+        # One frame of the first amplificator
+        nrow = weights.shape[-2]
+        amp_nrows = nrow // one_over_f.get_namps(subarray, nrow)
+        self.sub = sub[0, 0, :amp_nrows]
+        self.weights = weights[0, :amp_nrows]
+
+    def time_compute_oof(self, subarray):
+        one_over_f.compute_oof(self.sub, self.weights)
+
+
+class CorrectOOF:
+    params = (SUBARRAYS, [False, True], [False, True], [False, True])
+    param_names = ["subarray", "iterative", "mean_per_frame", "outliers"]
+    timeout = 1200
+
+    def setup(self, subarray, iterative, mean_per_frame, outliers):
+        get_ramp(subarray)
+        self.output_dir = tempfile.mkdtemp()
+        self.kwargs = dict(iterative=iterative, mean_per_frame=mean_per_frame)
+        if outliers:
+            # Outlier maps are read from a file by the correction
+            outlier_file = f"{self.output_dir}/outliers.fits"
+            fits.writeto(outlier_file, get_ramp(subarray)["outlier_map"])
+            self.kwargs["outlier_map"] = outlier_file
+
+    def teardown(self, subarray, iterative, mean_per_frame, outliers):
+        shutil.rmtree(self.output_dir)
+
+    def time_correct_oof(self, subarray, iterative, mean_per_frame, outliers):
+        correct(subarray, **self.kwargs)
+
+    def peakmem_correct_oof(self, subarray, iterative, mean_per_frame, outliers):
+        correct(subarray, **self.kwargs)
+
+
+class Sweep:
+    params = SUBARRAYS
+    param_names = ["subarray"]
+    timeout = 1200
+
+    def setup(self, subarray):
+        get_ramp(subarray)
+
+    def time_sweep(self, subarray):
+        data = get_ramp(subarray)["data"]
+        shared = sweep.compute_shared_products(data)
+        for config in SWEEP_CONFIGS:
+            dcmap = sweep.sweep_noise_map(shared, subarray, **config)
+            one_over_f.apply_noise_map(data, dcmap)
+
+    def time_separate_corrections(self, subarray):
+        for config in SWEEP_CONFIGS:
+            correct(subarray, **config)
+
+
+class Equivalence:
+    params = SUBARRAYS
+    param_names = ["subarray"]
+    timeout = 1200
+
+    def setup(self, subarray):
+        self.sub, self.weights = get_sub_and_weights(subarray)
+
+    @staticmethod
+    def _check(diff: float) -> float:
+        """Relative difference, raising if it is larger than the tolerance"""
+        rel_diff = diff / OOF_AMPLITUDE
+        if not rel_diff <= EQUIVALENCE_RTOL:
+            raise AssertionError(
+                f"Code paths differ by {rel_diff:.2e} of the 1/f amplitude"
+                f" (tolerance {EQUIVALENCE_RTOL:.0e})"
+            )
+        return rel_diff
+
+    @staticmethod
+    def _check_identical(reference: np.ndarray, result: np.ndarray) -> float:
+        """Relative difference, raising if the results are not bit-identical"""
+        if not np.array_equal(reference, result, equal_nan=True):
+            raise AssertionError(
+                "Code paths should give identical results, but differ by"
+                f" {np.nanmax(np.abs(reference - result)) / OOF_AMPLITUDE:.2e} of the"
+                " 1/f amplitude"
+            )
+        return 0.0
+
+    def track_iterative_noise_map(self, subarray):
+        vectorized = one_over_f.generate_noise_map(self.sub, self.weights, subarray)
+        iterative = one_over_f.generate_noise_map_iter(self.sub, self.weights, subarray)
+        return self._check(np.nanmax(np.abs(vectorized - iterative)))
+
+    def track_iterative_correction(self, subarray):
+        reference = correct(subarray)
+        iterative = correct(subarray, iterative=True)
+        return self._check(np.nanmax(np.abs(reference - iterative)))
+
+    def track_tiled_correction(self, subarray):
+        reference = correct(subarray)
+        # Budget small enough to split the columns in several tiles
+        max_memory = get_ramp(subarray)["data"].nbytes / 1024**3
+        tiled = correct(subarray, max_memory=max_memory)
+        return self._check(np.nanmax(np.abs(reference - tiled)))
+
+    def track_mean_per_frame_correction(self, subarray):
+        reference = correct(subarray, mean_per_frame=True)
+        iterative = correct(subarray, mean_per_frame=True, iterative=True)
+        return self._check(np.nanmax(np.abs(reference - iterative)))
+
+    def track_n_threads_correction(self, subarray):
+        rel_diff = 0.0
+        for options in [dict(), dict(iterative=True), dict(mean_per_frame=True)]:
+            reference = correct(subarray, kernel="numpy", n_threads=1, **options)
+            threaded = correct(subarray, kernel="numpy", n_threads=4, **options)
+            # Each thread computes whole integrations, so the sums are not reordered
+            rel_diff = max(rel_diff, self._check_identical(reference, threaded))
+        return rel_diff
+
+    def track_sweep_correction(self, subarray):
+        data = get_ramp(subarray)["data"]
+        rel_diff = 0.0
+        for precision in strategies.WORKING_PRECISIONS:
+            shared = sweep.compute_shared_products(data, working_precision=precision)
+            for config in SWEEP_CONFIGS:
+                dcmap = sweep.sweep_noise_map(shared, subarray, **config)
+                # Written to the output dtype like the models of `correct_oof_sweep`
+                out = one_over_f.apply_noise_map(data, dcmap, out=np.empty_like(data))
+                diff = out - correct(subarray, working_precision=precision, **config)
+                rel_diff = max(rel_diff, self._check(np.nanmax(np.abs(diff))))
+        return rel_diff
+
+    def track_rolling_correction(self, subarray):
+        data = get_ramp(subarray)["data"]
+        reference = sweep.compute_shared_products(data)
+        # A window covering all integrations from each of them is the global median
+        rolling = sweep.compute_shared_products(
+            data, stack_method="rolling_median", stack_window=2 * data.shape[0]
+        )
+        # Noise maps are compared before they are subtracted from the float32 data
+        diff = sweep.sweep_noise_map(rolling, subarray) - sweep.sweep_noise_map(
+            reference, subarray
+        )
+        return self._check(np.nanmax(np.abs(diff)))
+
+    def track_cube_correction(self, subarray):
+        data = get_cube(subarray)["data"]
+        reference = np.empty_like(data)
+        one_over_f.correct_oof_data(data, reference, subarray)
+        rel_diff = 0.0
+        for options in [dict(iterative=True), dict(max_memory=data.nbytes / 1024**3)]:
+            out = np.empty_like(data)
+            one_over_f.correct_oof_data(data, out, subarray, **options)
+            rel_diff = max(rel_diff, self._check(np.nanmax(np.abs(reference - out))))
+        return rel_diff
+
+    def track_file_correction(self, subarray):
+        """Correction of a memory-mapped file against the in-memory correction"""
+        data = get_ramp(subarray)["data"]
+        primary = fits.PrimaryHDU()
+        primary.header["SUBARRAY"] = subarray
+        max_memory = data.nbytes / 1024**3
+        rel_diff = 0.0
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = f"{tmp_dir}/ramp.fits"
+            hdul = fits.HDUList([primary, fits.ImageHDU(data, name="SCI")])
+            hdul.writeto(input_file)
+            for options in [dict(), dict(max_memory=max_memory)]:
+                output_file = file_backed.correct_oof_file(
+                    input_file, output_dir=tmp_dir, **options
+                )
+                reference = correct(subarray, **options)
+                with fits.open(output_file) as out_hdul:
+                    diff = np.nanmax(np.abs(out_hdul["SCI"].data - reference))
+                rel_diff = max(rel_diff, self._check(diff))
+        return rel_diff
+
+    def track_dq_masking(self, subarray):
+        """DQ weighting against NaN masking of the same pixels"""
+        data = get_ramp(subarray)["data"]
+        rng = np.random.default_rng(42)
+        groupdq = np.where(rng.random(data.shape) < 1e-3, JUMP_DET, 0).astype(np.uint8)
+        pixeldq = np.where(rng.random(data.shape[-2:]) < 1e-3, DO_NOT_USE, 0)
+        pixeldq = pixeldq.astype(np.uint32)
+        masked = correct(
+            subarray,
+            kernel="numpy",
+            dq=[groupdq, pixeldq],
+            dq_bits=DO_NOT_USE | JUMP_DET,
+        )
+
+        stacked_ramp, rms = one_over_f.stack_ramp(data)
+        sub = data - stacked_ramp
+        sub[(groupdq != 0) | (pixeldq != 0)] = np.nan
+        # With DQ weighting, the means are normalized by the weights of good pixels
+        with np.errstate(divide="ignore"):
+            pixel_weights = np.where(np.isfinite(sub), rms**-2, 0.0)
+        pixel_weights[~np.isfinite(pixel_weights)] = 0.0
+        dcmap = one_over_f.generate_noise_map(sub, pixel_weights, subarray)
+        reference = one_over_f.apply_noise_map(data, dcmap)
+        return self._check(np.nanmax(np.abs(reference - masked)))
+
+    def track_noise_recovery(self, subarray):
+        """Residual 1/f noise after correction, relative to the injected noise"""
+        ramp = get_ramp(subarray)
+        injected = one_over_f.expand_noise_map(ramp["oof"], ramp["data"].shape)
+        residual = correct(subarray) - (ramp["data"] - injected)
+        # The part of the noise common to all integrations is not removed
+        residual -= np.nanmedian(residual, axis=0)
+        return float(np.nanstd(residual) / OOF_AMPLITUDE)
+
+    track_iterative_noise_map.unit = "1/f amplitude"
+    track_iterative_correction.unit = "1/f amplitude"
+    track_tiled_correction.unit = "1/f amplitude"
+    track_mean_per_frame_correction.unit = "1/f amplitude"
+    track_n_threads_correction.unit = "1/f amplitude"
+    track_sweep_correction.unit = "1/f amplitude"
+    track_rolling_correction.unit = "1/f amplitude"
+    track_cube_correction.unit = "1/f amplitude"
+    track_file_correction.unit = "1/f amplitude"
+    track_dq_masking.unit = "1/f amplitude"
+    track_noise_recovery.unit = "1/f amplitude"
+
+
+class DaskEquivalence:
+    params = SUBARRAYS
+    param_names = ["subarray"]
+    timeout = 1200
+
+    def setup(self, subarray):
+        if not strategies.HAS_DASK:
+            raise NotImplementedError("dask is not installed")
+
+    def track_dask_correction(self, subarray):
+        # Chunks of one tile of columns, then one chunk per core
+        max_memory = get_ramp(subarray)["data"].nbytes / 1024**3
+        rel_diff = 0.0
+        for options in [dict(), dict(max_memory=max_memory), dict(mean_per_frame=True)]:
+            reference = correct(subarray, **options)
+            dask = correct(subarray, backend="dask", **options)
+            rel_diff = max(
+                rel_diff, Equivalence._check(np.nanmax(np.abs(reference - dask)))
+            )
+        return rel_diff
+
+    track_dask_correction.unit = "1/f amplitude"
+
+
+class NumbaEquivalence:
+    params = SUBARRAYS
+    param_names = ["subarray"]
+    timeout = 1200
+
+    def setup(self, subarray):
+        if not kernels.HAS_NUMBA:
+            raise NotImplementedError("numba is not installed")
+        self.sub, self.weights = get_sub_and_weights(subarray)
+
+    def track_numba_noise_map(self, subarray):
+        # Noise maps are compared before they are subtracted from the float32 data,
+        # where the float64 sums of numba can round the result differently
+        layout = amplifiers.get_amp_layout(subarray, self.sub.shape[-2])
+        rel_diff = 0.0
+        for mean_per_frame in [False, True]:
+            reference = one_over_f.generate_noise_map(
+                self.sub, self.weights, subarray, mean_per_frame=mean_per_frame
+            )
+            offsets = None
+            if mean_per_frame:
+                offsets = np.nanmedian(self.sub, axis=(-2, -1))
+            numba = kernels.column_means(
+                layout.split(self.sub), layout.split(self.weights), offsets=offsets
+            )
+            rel_diff = max(
+                rel_diff, Equivalence._check(np.nanmax(np.abs(reference - numba)))
+            )
+        return rel_diff
+
+    def track_numba_n_threads(self, subarray):
+        reference = correct(subarray, kernel="numba", n_threads=1)
+        threaded = correct(subarray, kernel="numba", n_threads=4)
+        return Equivalence._check_identical(reference, threaded)
+
+    track_numba_noise_map.unit = "1/f amplitude"
+    track_numba_n_threads.unit = "1/f amplitude"
@@ -0,0 +1,223 @@
+"""
+Manifest of the exposures reduced by a batch run, used to resume interrupted runs.
+
+The manifest is a JSON-lines file with one record per change of status of a stage of
+an exposure: "running" when it starts, then "done" with its output files or "failed"
+with the error. Records are only appended, so a run killed at any point leaves a
+readable manifest, and the last record of each exposure and stage is its current
+status. A stage that was running when the run died is rerun like a failed one.
+
+Each record has the hash of everything that determines the result of the stage (input
+file, steps, step configuration, jwst version and CRDS context, resolved like the key
+of the step cache). A completed stage is only skipped if its hash did not change and
+its outputs still exist, so an update of the default CRDS context reruns it.
+"""
+import hashlib
+import json
+import logging
+from datetime import datetime, timezone
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from typing import Optional, Sequence, Union
+
+from .pipeline.steps import OUTPUT_PARAMETERS
+
+__all__ = ["RunManifest", "file_identity", "stage_hash"]
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+STATUSES = ("running", "done", "failed")
+
+# Step options that do not change the result of a stage (besides OUTPUT_PARAMETERS)
+RESULT_INDEPENDENT_OPTIONS = {"ramp_fit": {"max_cores"}, "oneoverf": {"n_threads"}}
+
+
+def file_identity(path: Union[Path, str]) -> Optional[dict]:
+    """
+    Path, size and modification time of a file, or None if it does not exist.
+
+    Hashing the content of each exposure would require reading it again on every run,
+    so a file is assumed unchanged if its size and modification time are the same.
+    """
+    path = Path(path)
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return {
+        "path": str(path.resolve()),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+    }
+
+
+def get_jwst_version() -> Optional[str]:
+    """
+    Installed version of jwst, read from the package metadata without importing it
+    """
+    try:
+        return version("jwst")
+    except PackageNotFoundError:
+        return None
+
+
+def _result_config(step_config: Optional[dict]) -> dict:
+    """Step configuration without the options that do not change the result"""
+    config = {}
+    for step_name, step_cfg in (step_config or {}).items():
+        ignored = OUTPUT_PARAMETERS | RESULT_INDEPENDENT_OPTIONS.get(step_name, set())
+        config[step_name] = {
+            k: v for k, v in (step_cfg or {}).items() if k not in ignored
+        }
+    return config
+
+
+def stage_hash(
+    inputs,
+    steps: Optional[Sequence[str]],
+    step_config: Optional[dict],
+    **options,
+) -> str:
+    """
+    Hash of everything that determines the result of a stage for one exposure.
+
+    Parameters
+    ----------
+    inputs
+        Identity of the inputs of the stage, e.g. `file_identity` of the uncal file,
+        or the hash of the stage before it
+    steps : Optional[Sequence[str]]
+        Steps run by the stage
+    step_config : Optional[dict]
+        Configuration of the steps. Options that only affect where outputs are saved
+        or the resources used are ignored.
+    **options
+        Other values that affect the result or the outputs of the stage
+
+    Returns
+    -------
+    str
+        Hash of the stage
+    """
+    # Imported here so that the manifest can be read without importing jwst
+    from .pipeline.cache import get_crds_context
+
+    key_dict = {
+        "inputs": inputs,
+        "steps": list(steps) if steps is not None else None,
+        "config": _result_config(step_config),
+        "options": options,
+        "jwst": get_jwst_version(),
+        # Same context as the step cache, so both are invalidated by the same updates
+        "crds_context": get_crds_context(),
+    }
+    key_str = json.dumps(key_dict, sort_keys=True, default=str)
+    return hashlib.sha256(key_str.encode()).hexdigest()
+
+
+class RunManifest:
+    """
+    Status of each stage of each exposure of a batch run, stored in a JSON-lines file.
+
+    Several processes can record to the same manifest: each record is appended with a
+    single write of one line.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path of the manifest file, created on the first record
+    """
+
+    def __init__(self, path: Union[Path, str]):
+        self.path = Path(path)
+
+    def __repr__(self) -> str:
+        return f"RunManifest('{self.path}')"
+
+    def read(self) -> dict:
+        """
+        Last record of each exposure and stage, by (exposure, stage)
+        """
+        records = {}
+        if not self.path.exists():
+            return records
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Partial line written by a process that was killed
+                    continue
+                records[(record["exposure"], record["stage"])] = record
+        return records
+
+    @staticmethod
+    def _exposure_key(exposure: Union[Path, str]) -> str:
+        """Absolute path of an exposure, which identifies it in the manifest"""
+        return str(Path(exposure).resolve())
+
+    def get(self, exposure: Union[Path, str], stage: str) -> Optional[dict]:
+        """
+        Last record of a stage of an exposure, or None if it never ran
+        """
+        return self.read().get((self._exposure_key(exposure), stage))
+
+    def record(
+        self,
+        exposure: Union[Path, str],
+        stage: str,
+        status: str,
+        config_hash: str,
+        outputs: Optional[Sequence[Union[Path, str]]] = None,
+        error: Optional[str] = None,
+    ):
+        """
+        Append the status of a stage of an exposure to the manifest.
+
+        Parameters
+        ----------
+        exposure : Union[Path, str]
+            Input file of the exposure
+        stage : str
+            Name of the stage (e.g. "stage1")
+        status : str
+            One of `STATUSES`
+        config_hash : str
+            Hash of the stage (see `stage_hash`)
+        outputs : Optional[Sequence[Union[Path, str]]]
+            Files written by the stage
+        error : Optional[str]
+            Error of a failed stage
+        """
+        if status not in STATUSES:
+            raise ValueError(f"Unknown status '{status}'. Should be one of {STATUSES}")
+        record = {
+            "exposure": self._exposure_key(exposure),
+            "stage": stage,
+            "status": status,
+            "config_hash": config_hash,
+            "outputs": [str(Path(p).resolve()) for p in outputs or []],
+            "error": error,
+            "time": datetime.now(timezone.utc).isoformat(),
+        }
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def is_done(self, exposure: Union[Path, str], stage: str, config_hash: str) -> bool:
+        """
+        Whether a stage of an exposure completed with the same hash and its outputs
+        still exist
+        """
+        record = self.get(exposure, stage)
+        if record is None or record["status"] != "done":
+            return False
+        if record["config_hash"] != config_hash:
+            log.info(f"Configuration of {stage} changed for {exposure}: rerunning it")
+            return False
+        missing = [p for p in record["outputs"] if not Path(p).exists()]
+        if missing:
+            log.info(f"Outputs of {stage} are missing for {exposure}: rerunning it")
+            return False
+        return True
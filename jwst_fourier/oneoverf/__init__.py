@@ -1,3 +1,21 @@
-from .oneoverf_step import OneOverFStep
+"""
+The step is imported when first accessed, so that the modules of this package that
+do not need jwst (e.g. `strategies`, `kernels`) can be used without loading it.
+"""
+import importlib
 
 __all__ = ["OneOverFStep"]
+
+# Module of each attribute imported on first access
+_LAZY_ATTRIBUTES = {"OneOverFStep": ".oneoverf_step"}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        module = importlib.import_module(_LAZY_ATTRIBUTES[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,69 @@
+"""
+numba kernels, imported by `kernels` when first used so that numba is not imported
+with the package.
+"""
+import numba
+import numpy as np
+
+
+@numba.njit(parallel=True, cache=True)
+def column_sums(sub, weights, offsets):
+    # sub: (nframe, namps, nrow, ncol), weights: (nwframe, namps, nrow, ncol),
+    # with frame i using weights i % nwframe, offsets: (nframe,)
+    nframe, namps, nrow, ncol = sub.shape
+    nwframe = weights.shape[0]
+    sums = np.zeros((nframe, namps, ncol), dtype=np.float64)
+    for k in numba.prange(nframe * namps):
+        i = k // namps
+        iamp = k % namps
+        iw = i % nwframe
+        offset = offsets[i]
+        for row in range(nrow):
+            for col in range(ncol):
+                value = (sub[i, iamp, row, col] - offset) * weights[iw, iamp, row, col]
+                # NaN values are skipped, like np.nansum
+                if not np.isnan(value):
+                    sums[i, iamp, col] += value
+    return sums
+
+
+@numba.njit(parallel=True, cache=True)
+def rolling_median(values, halfwidth):
+    # values: (npix, nint). Same algorithm as `stacking.rolling_median_stack`, with the
+    # sorted window of each pixel updated in place: the leaving value is removed by
+    # shifting the larger ones down and the new one is inserted by shifting up.
+    npix, nint = values.shape
+    window = 2 * halfwidth + 1
+    median = np.empty((npix, nint), dtype=np.float64)
+    for p in numba.prange(npix):
+        sorted_window = np.empty(window, dtype=values.dtype)
+        sorted_window[:] = np.inf
+        nvalid = 0
+        for i in range(-halfwidth, nint):
+            new = np.inf
+            if i + halfwidth < nint and not np.isnan(values[p, i + halfwidth]):
+                new = values[p, i + halfwidth]
+            old = np.inf
+            if i - halfwidth - 1 >= 0 and not np.isnan(values[p, i - halfwidth - 1]):
+                old = values[p, i - halfwidth - 1]
+
+            rank = 0
+            while rank < window - 1 and sorted_window[rank] < old:
+                rank += 1
+            for r in range(rank, window - 1):
+                sorted_window[r] = sorted_window[r + 1]
+            rank = window - 1
+            while rank > 0 and sorted_window[rank - 1] > new:
+                sorted_window[rank] = sorted_window[rank - 1]
+                rank -= 1
+            sorted_window[rank] = new
+            nvalid += (new < np.inf) - (old < np.inf)
+
+            if i >= 0:
+                if nvalid == 0:
+                    median[p, i] = np.nan
+                else:
+                    lo = np.float64(sorted_window[(nvalid - 1) // 2])
+                    hi = np.float64(sorted_window[nvalid // 2])
+                    median[p, i] = 0.5 * lo + 0.5 * hi
+    return median
@@ -0,0 +1,109 @@
+"""
+Readout geometry of the detector amplificators.
+
+The detector is read by 4 amplificators (outputs), each reading a band of 512 rows of
+the 2048x2048 array in the DMS orientation. Each amplificator has its own 1/f noise,
+so the column means of the 1/f correction are computed separately in each band.
+Full frames are read with 4 outputs and most subarrays with one, but subarrays that
+span the detector along the amplificator axis can also be read with 4 outputs, which is
+recorded in the NOUTPUTS keyword (`meta.exposure.noutputs`). Arrays read by several
+outputs must then have all the rows of the detector: in other readouts (e.g.
+full-width stripes read with 4 outputs), the amplificator boundaries cross the
+columns, and the column means cannot be separated per amplificator.
+
+An `AmpLayout` splits arrays into views with one axis per amplificator, so that the
+column means of all amplificators are computed without copying the data.
+"""
+from typing import Optional
+
+import numpy as np
+
+__all__ = ["AMP_NROWS", "AmpLayout", "get_amp_layout"]
+
+# Number of rows read by each amplificator of the detector
+AMP_NROWS = 512
+
+
+class AmpLayout:
+    """
+    Amplificators reading an array, each reading the same number of consecutive rows.
+
+    Parameters
+    ----------
+    namps : int
+        Number of amplificators
+    """
+
+    def __init__(self, namps: int = 1):
+        if namps < 1:
+            raise ValueError(f"Number of amplificators should be positive, not {namps}")
+        self.namps = int(namps)
+
+    def __repr__(self) -> str:
+        return f"AmpLayout(namps={self.namps})"
+
+    def amp_nrows(self, nrow: int) -> int:
+        """
+        Number of rows read by each amplificator in an array with `nrow` rows
+        """
+        if nrow % self.namps != 0:
+            raise ValueError(
+                f"{nrow} rows cannot be split between {self.namps} amplificators"
+            )
+        return nrow // self.namps
+
+    def split(self, data: np.ndarray) -> np.ndarray:
+        """
+        View of the data with the rows split per amplificator.
+
+        Splitting one axis in two never requires a copy, even for non-contiguous data
+        (e.g. a tile of columns), so the returned array is always a view.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            Data with shape (..., nrow, ncol)
+
+        Returns
+        -------
+        np.ndarray
+            View of the data with shape (..., namps, nrow // namps, ncol)
+        """
+        amp_nrows = self.amp_nrows(data.shape[-2])
+        return data.reshape(data.shape[:-2] + (self.namps, amp_nrows, data.shape[-1]))
+
+
+def get_amp_layout(
+    subarray: str, nrow: int, noutputs: Optional[int] = None
+) -> AmpLayout:
+    """
+    Amplificator layout of an array from the subarray and readout metadata.
+
+    Parameters
+    ----------
+    subarray : str
+        Subarray used to acquire the data
+    nrow : int
+        Number of rows in the array
+    noutputs : Optional[int]
+        Number of outputs used to read the array (NOUTPUTS keyword). Default is 4
+        outputs of `AMP_NROWS` rows for FULL (i.e. `nrow // AMP_NROWS`) and 1 for
+        subarrays. Several outputs require `nrow` to be `noutputs * AMP_NROWS`.
+
+    Returns
+    -------
+    AmpLayout
+        Layout of the amplificators
+    """
+    if noutputs is None:
+        noutputs = max(nrow // AMP_NROWS, 1) if subarray == "FULL" else 1
+    if noutputs > 1 and nrow != noutputs * AMP_NROWS:
+        raise ValueError(
+            f"{noutputs} outputs of {AMP_NROWS} rows do not match the {nrow} rows of"
+            f" {subarray}. Readouts whose amplificators split the columns (e.g."
+            " full-width stripes) are not supported."
+        )
+    layout = AmpLayout(noutputs)
+    # Raise early if the rows cannot be split between the outputs
+    layout.amp_nrows(nrow)
+    return layout
@@ -0,0 +1,258 @@
+"""
+Execution of the 1/f correction with dask.
+
+The correction only mixes pixels along the integrations and along the rows read by one
+amplificator, so the data is split in chunks of columns of each amplificator that are
+stacked and corrected independently, in parallel. Each chunk holds all integrations
+and groups of its pixels. The median of each frame (`mean_per_frame`) uses all pixels,
+so it is computed from the stack before the chunks are corrected. The arithmetic of
+each chunk is the same as the numpy path, so the results are identical.
+
+Chunks run on the default dask scheduler (threads of this process) and are written to
+the output array as they complete, so with memory-mapped input and output (e.g.
+`file_backed.correct_oof_file`) only the chunks being processed are in memory. Any
+other dask scheduler can be used, e.g. "processes" or a `dask.distributed` cluster
+whose workers spill to disk when they run out of memory. Their results are gathered
+in this process before being written to the output.
+
+dask is optional and only imported when this backend is used.
+"""
+import logging
+import os
+from typing import Optional, Sequence
+
+import dask.array as da
+import numpy as np
+from dask import local, threaded
+from dask.base import get_scheduler
+
+from . import amplifiers, kernels, stacking
+from .one_over_f import (
+    _frame_medians,
+    _good_pixel_mask,
+    _outlier_nan_map,
+    apply_noise_map,
+    generate_noise_map,
+    generate_noise_map_iter,
+    stack_ramp,
+)
+
+__all__ = ["correct_oof_dask", "get_chunks"]
+
+log = logging.getLogger(__name__)
+
+
+def get_chunks(
+    shape: tuple, layout: amplifiers.AmpLayout, tile_ncols: Optional[int] = None
+) -> tuple:
+    """
+    Chunks of the data: one amplificator and `tile_ncols` columns, all integrations.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the data (nint, ngroup, nrow, ncol) or (nint, nrow, ncol)
+    layout : amplifiers.AmpLayout
+        Amplificators reading the data
+    tile_ncols : Optional[int]
+        Number of columns of each chunk. Default splits the columns in one chunk per
+        core.
+
+    Returns
+    -------
+    tuple
+        Size of the chunks along each axis, as accepted by `dask.array.from_array`
+    """
+    if tile_ncols is None:
+        ncores = os.cpu_count() or 1
+        tile_ncols = -(-shape[-1] // ncores)
+    return (-1,) * (len(shape) - 2) + (layout.amp_nrows(shape[-2]), tile_ncols)
+
+
+def _stack_block(
+    block: np.ndarray, method: str, working_dtype, window: Optional[int]
+) -> np.ndarray:
+    """Stack and RMS of a chunk, along a new first axis"""
+    return np.stack(
+        stack_ramp(block, method=method, dtype=working_dtype, window=window)
+    )
+
+
+def _correct_block(
+    block: np.ndarray,
+    stacked_ramp: np.ndarray,
+    rms: np.ndarray,
+    working_dtype=None,
+    out_dtype=None,
+    frame_medians: Optional[np.ndarray] = None,
+    outliers: Optional[np.ndarray] = None,
+    dq: Sequence = (),
+    dq_bitmask: Optional[int] = None,
+    kernel: str = "numpy",
+    iterative: bool = False,
+    block_info: Optional[dict] = None,
+) -> np.ndarray:
+    """
+    Correct one chunk, read by a single amplificator, like a tile of `correct_oof_data`
+    """
+    # Position of the chunk in the full array, to index the DQ and outlier maps
+    (row_start, row_stop), (col_start, col_stop) = block_info[0]["array-location"][-2:]
+    index = np.s_[..., row_start:row_stop, col_start:col_stop]
+    layout = amplifiers.AmpLayout(1)
+    masked = dq_bitmask is not None
+
+    pixel_weights = rms**-2
+    pixel_weights[~np.isfinite(pixel_weights)] = 0.0
+    sub = np.subtract(block, stacked_ramp, dtype=working_dtype)
+
+    if masked:
+        good = _good_pixel_mask(sub.shape, index, dq, dq_bitmask, outliers)
+        good &= np.isfinite(sub)
+        pixel_weights = pixel_weights * good
+        sub[~good] = 0
+    elif outliers is not None:
+        outlier_block = _outlier_nan_map(outliers[index], sub.ndim)
+        sub = np.multiply(sub, outlier_block, dtype=working_dtype)
+
+    # Chunks already run in parallel, so each one is reduced by a single thread
+    if kernel == "numba":
+        dcmap = kernels.column_means(
+            layout.split(sub),
+            layout.split(pixel_weights),
+            offsets=frame_medians,
+            n_threads=1,
+        )
+    else:
+        if frame_medians is not None:
+            sub -= frame_medians[..., np.newaxis, np.newaxis]
+        if iterative:
+            dcmap = generate_noise_map_iter(sub, pixel_weights, layout, masked=masked)
+        else:
+            dcmap = generate_noise_map(sub, pixel_weights, layout, masked=masked)
+
+    dcmap = np.where(np.isfinite(dcmap), dcmap, 0)
+    return apply_noise_map(block, dcmap, out=np.empty(block.shape, dtype=out_dtype))
+
+
+def _runs_in_process(scheduler: Optional[str]) -> bool:
+    """Whether the tasks of a dask scheduler run in this process"""
+    get = get_scheduler(scheduler=scheduler)
+    # Without configured scheduler, dask arrays use threads
+    return get in (None, threaded.get, local.get_sync)
+
+
+def correct_oof_dask(
+    data: np.ndarray,
+    out: np.ndarray,
+    layout: amplifiers.AmpLayout,
+    tile_ncols: Optional[int] = None,
+    stacked_ramp: Optional[np.ndarray] = None,
+    rms: Optional[np.ndarray] = None,
+    stack_method: str = "median",
+    stack_window: Optional[int] = None,
+    working_dtype: Optional[np.dtype] = None,
+    mean_per_frame: bool = False,
+    outliers: Optional[np.ndarray] = None,
+    dq: Optional[Sequence] = None,
+    dq_bitmask: Optional[int] = None,
+    kernel: str = "numpy",
+    iterative: bool = False,
+    scheduler: Optional[str] = None,
+):
+    """
+    Correct 1/f noise in chunks of the data with dask and write the result in `out`.
+
+    Options are resolved by `one_over_f.correct_oof_data`, which calls this function
+    with the dask backend.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Input ramp (nint, ngroup, nrow, ncol) or cube (nint, nrow, ncol), or an
+        array-like object that reads data on access
+    out : np.ndarray
+        Array where the corrected data is written. Can be `data` itself.
+    layout : amplifiers.AmpLayout
+        Amplificators reading the data
+    tile_ncols : Optional[int]
+        Number of columns of each chunk (see `get_chunks`)
+    stacked_ramp, rms : Optional[np.ndarray]
+        Stack of the data and its RMS (e.g. from a deep stack). Default is to stack
+        each chunk.
+    stack_method : str
+        Estimator used to stack (see `one_over_f.stack_ramp`)
+    stack_window : Optional[int]
+        Window of the rolling stack methods (see `one_over_f.stack_ramp`)
+    working_dtype : Optional[np.dtype]
+        Floating point type of the computation
+    mean_per_frame : bool
+        Whether the median of each frame is subtracted before the column means
+    outliers : Optional[np.ndarray]
+        Outlier map (nint, ny, nx). Outliers are flagged with 1.
+    dq : Optional[Sequence]
+        DQ arrays of the data, used with `dq_bitmask`
+    dq_bitmask : Optional[int]
+        DQ flags of the pixels given a weight of 0
+    kernel : str
+        Resolved kernel of the column means ("numpy" or "numba")
+    iterative : bool
+        Whether the numpy kernel loops over integrations
+    scheduler : Optional[str]
+        dask scheduler (e.g. "threads", "processes", "synchronous"). Default is the
+        dask configuration, i.e. threads or the active `dask.distributed` client.
+    """
+    chunks = get_chunks(data.shape, layout, tile_ncols)
+    meta = np.empty((0,) * data.ndim, dtype=data.dtype)
+    data_chunks = da.from_array(data, chunks=chunks, meta=meta)
+    log.info(f"Correcting 1/f noise with dask in {data_chunks.npartitions} chunks")
+
+    if stacked_ramp is None:
+        # Rolling methods have one stack per integration
+        if stack_method in stacking.ROLLING_STACK_METHODS:
+            stack_chunk_sizes = data_chunks.chunks
+        else:
+            stack_chunk_sizes = data_chunks.chunks[1:]
+        stack_chunks = data_chunks.map_blocks(
+            _stack_block,
+            method=stack_method,
+            working_dtype=working_dtype,
+            window=stack_window,
+            chunks=((2,),) + stack_chunk_sizes,
+            dtype=working_dtype or data.dtype,
+        )
+        stacked_ramp, rms = stack_chunks.compute(scheduler=scheduler)
+
+    # The frame median uses all columns, so it is computed before the chunks
+    if mean_per_frame:
+        frame_medians = _frame_medians(
+            data,
+            stacked_ramp,
+            outliers,
+            dtype=working_dtype,
+            dq=dq,
+            dq_bitmask=dq_bitmask,
+        )
+    else:
+        frame_medians = None
+
+    corrected = da.map_blocks(
+        _correct_block,
+        data_chunks,
+        da.from_array(stacked_ramp, chunks=data_chunks.chunks[-stacked_ramp.ndim :]),
+        da.from_array(rms, chunks=data_chunks.chunks[-rms.ndim :]),
+        working_dtype=working_dtype,
+        out_dtype=out.dtype,
+        frame_medians=frame_medians,
+        outliers=outliers,
+        dq=dq or [],
+        dq_bitmask=dq_bitmask,
+        kernel=kernel,
+        iterative=iterative,
+        dtype=out.dtype,
+    )
+
+    if _runs_in_process(scheduler):
+        # Each chunk writes its own region of the output, so no lock is needed
+        da.store(corrected, out, lock=False, scheduler=scheduler)
+    else:
+        out[...] = corrected.compute(scheduler=scheduler)
@@ -0,0 +1,236 @@
+"""
+Deep stack shared by several exposures of the same target.
+
+Exposures with few integrations give a noisy stack, and exposures taken with the same
+setup and pointing stack to the same scene. A deep stack built once from the
+integrations of all compatible exposures can be used to correct each of them instead
+of their own stack. Deep stacks are saved to FITS files and kept in memory once
+loaded, so that a pipeline correcting many exposures only reads the file once.
+"""
+import logging
+from pathlib import Path
+from typing import Optional, Sequence, Union
+
+import numpy as np
+from astropy.io import fits
+from jwst import datamodels
+
+from . import stacking
+
+__all__ = [
+    "build_deep_stack",
+    "check_compatible",
+    "get_deep_stack",
+    "get_header_stack_keys",
+    "get_stack_keys",
+    "load_deep_stack",
+    "save_deep_stack",
+]
+
+log = logging.getLogger(__name__)
+
+# Header keywords and model attributes that must match for exposures to share a stack
+STACK_KEYS = {
+    "SUBARRAY": "subarray.name",
+    "READPATT": "exposure.readpatt",
+    "NGROUPS": "exposure.ngroups",
+    "RA_V1": "pointing.ra_v1",
+    "DEC_V1": "pointing.dec_v1",
+    "PA_V3": "pointing.pa_v3",
+}
+
+# Tolerance on pointing keywords (degrees)
+POINTING_TOLERANCE = {"RA_V1": 0.01 / 3600, "DEC_V1": 0.01 / 3600, "PA_V3": 1e-3}
+
+# Deep stacks loaded from files, by path
+_loaded_stacks = {}
+
+
+def get_stack_keys(model: datamodels.DataModel) -> dict:
+    """
+    Values of `STACK_KEYS` for a data model
+    """
+    keys = {}
+    for key, attr in STACK_KEYS.items():
+        value = model.meta
+        for name in attr.split("."):
+            value = getattr(value, name, None)
+        keys[key] = value
+    return keys
+
+
+def get_header_stack_keys(hdul: fits.HDUList) -> dict:
+    """
+    Values of `STACK_KEYS` from the primary and SCI headers of a FITS file
+    """
+    header = hdul[0].header.copy()
+    header.update(hdul["SCI"].header)
+    return {key: header.get(key) for key in STACK_KEYS}
+
+
+def check_compatible(keys: dict, ref_keys: dict, name: str = "exposure"):
+    """
+    Raise a ValueError if the keys of an exposure do not match the reference keys.
+
+    Pointing keys are compared with the tolerances of `POINTING_TOLERANCE`. Keys that
+    are missing from either exposure are not compared.
+    """
+    for key in STACK_KEYS:
+        value, ref_value = keys.get(key), ref_keys.get(key)
+        if value is None or ref_value is None:
+            continue
+        if key in POINTING_TOLERANCE:
+            matches = abs(value - ref_value) <= POINTING_TOLERANCE[key]
+        else:
+            matches = value == ref_value
+        if not matches:
+            raise ValueError(
+                f"{name} cannot share the deep stack: {key}={value} instead of"
+                f" {ref_value}"
+            )
+
+
+def _open_model(input) -> datamodels.DataModel:
+    if isinstance(input, datamodels.DataModel):
+        return input
+    try:
+        return datamodels.RampModel(input)
+    except ValueError:
+        return datamodels.open(input)
+
+
+def build_deep_stack(
+    inputs: Sequence,
+    stack_method: str = "median",
+    dtype: Optional[np.dtype] = None,
+    output_file: Optional[Union[Path, str]] = None,
+) -> dict:
+    """
+    Stack the integrations of several compatible exposures together.
+
+    Parameters
+    ----------
+    inputs : Sequence
+        Files or data models of the exposures. They must have the same subarray,
+        readout pattern, number of groups and pointing.
+    stack_method : str
+        Estimator used to stack (see `stacking.stack_integrations`). With online
+        methods, the stack is updated one integration at a time and exposures are
+        opened and closed in turn, so one exposure is held in memory at a time. Other
+        methods hold all integrations in memory at once.
+    dtype : Optional[np.dtype]
+        Floating point type of the computation (see `stacking.stack_integrations`)
+    output_file : Optional[Union[Path, str]]
+        If given, the deep stack is saved to this file (see `save_deep_stack`)
+
+    Returns
+    -------
+    dict
+        "stack" and "rms" of each pixel, with the shape of one integration,
+        "keys" of the exposures (see `get_stack_keys`), and "files" used
+    """
+    if len(inputs) == 0:
+        raise ValueError("At least one exposure is required to build a deep stack")
+    if stack_method in stacking.ROLLING_STACK_METHODS:
+        raise ValueError(
+            f"A deep stack has one stack for all integrations, not '{stack_method}'"
+        )
+
+    ref_keys = None
+    files = []
+    online = stack_method in stacking.ONLINE_STACK_METHODS
+    online_stack = None
+    data = []
+    for input in inputs:
+        model = _open_model(input)
+        try:
+            keys = get_stack_keys(model)
+            name = model.meta.filename or str(input)
+            if ref_keys is None:
+                ref_keys = keys
+            else:
+                check_compatible(keys, ref_keys, name=name)
+            files.append(name)
+
+            data_dtype = model.data.dtype
+            if online:
+                if online_stack is None:
+                    online_stack = stacking.OnlineStack(
+                        model.data.shape[1:], method=stack_method
+                    )
+                for integration in model.data:
+                    online_stack.add(integration)
+            else:
+                data.append(model.data)
+        finally:
+            # Models given by the caller stay open
+            if model is not input:
+                model.close()
+
+    if online:
+        if dtype is None:
+            dtype = data_dtype
+        stack, rms = online_stack.result(dtype=dtype)
+    else:
+        stack, rms = stacking.stack_integrations(
+            np.concatenate(data), method=stack_method, dtype=dtype
+        )
+    log.info(f"Built deep stack from {len(files)} exposures")
+
+    deep_stack = {"stack": stack, "rms": rms, "keys": ref_keys, "files": files}
+    if output_file is not None:
+        save_deep_stack(deep_stack, output_file)
+    return deep_stack
+
+
+def save_deep_stack(deep_stack: dict, output_file: Union[Path, str]):
+    """
+    Save a deep stack to a FITS file with DEEPSTACK and DEEPSTACK_RMS extensions.
+
+    The keys of the exposures are saved in the primary header and the files used in
+    a FILES table.
+    """
+    header = fits.Header()
+    for key, value in deep_stack["keys"].items():
+        if value is not None:
+            header[key] = value
+    header["NEXP"] = (len(deep_stack["files"]), "Number of stacked exposures")
+    hdul = fits.HDUList(
+        [
+            fits.PrimaryHDU(header=header),
+            fits.ImageHDU(deep_stack["stack"], name="DEEPSTACK"),
+            fits.ImageHDU(deep_stack["rms"], name="DEEPSTACK_RMS"),
+            fits.BinTableHDU.from_columns(
+                [fits.Column("FILENAME", "A256", array=deep_stack["files"])],
+                name="FILES",
+            ),
+        ]
+    )
+    hdul.writeto(output_file, overwrite=True)
+    _loaded_stacks.pop(Path(output_file).resolve(), None)
+    log.info(f"Saved deep stack to {output_file}")
+
+
+def load_deep_stack(input_file: Union[Path, str]) -> dict:
+    """
+    Load a deep stack saved with `save_deep_stack`. Loaded stacks are kept in memory.
+    """
+    path = Path(input_file).resolve()
+    if path not in _loaded_stacks:
+        with fits.open(path, memmap=False) as hdul:
+            _loaded_stacks[path] = {
+                "stack": hdul["DEEPSTACK"].data,
+                "rms": hdul["DEEPSTACK_RMS"].data,
+                "keys": {key: hdul[0].header.get(key) for key in STACK_KEYS},
+                "files": list(hdul["FILES"].data["FILENAME"]),
+            }
+    return _loaded_stacks[path]
+
+
+def get_deep_stack(deep_stack: Optional[Union[dict, Path, str]]) -> Optional[dict]:
+    """
+    Get a deep stack from a file or a dict returned by `build_deep_stack`
+    """
+    if deep_stack is None or isinstance(deep_stack, dict):
+        return deep_stack
+    return load_deep_stack(deep_stack)
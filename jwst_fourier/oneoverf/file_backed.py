@@ -0,0 +1,217 @@
+"""
+1/f correction of FITS files through memory maps.
+
+The SCI extension of the input is memory-mapped and only read one slice at a time by
+the correction. The corrected data is written directly to a memory-mapped SCI extension
+of the output file, so the full cube never needs to be held in memory.
+"""
+import math
+import shutil
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+from astropy.io import fits
+
+from . import deepstack
+from .one_over_f import (
+    _make_output_dir,
+    _save_intermediates,
+    correct_oof_data,
+    get_output_path,
+)
+
+__all__ = ["ScaledData", "correct_oof_file"]
+
+FITS_BLOCK_NBYTES = 2880
+
+
+class ScaledData:
+    """
+    FITS image data read on access, with BSCALE and BZERO applied to each slice.
+
+    Astropy loads the full array in memory to scale it, so integer data (e.g. uncal
+    files) is memory-mapped unscaled and scaled here one slice at a time.
+
+    Parameters
+    ----------
+    hdu : fits.ImageHDU
+        HDU opened with `memmap=True` and `do_not_scale_image_data=True`
+    dtype : Optional[np.dtype]
+        Type of the slices. Default is float32 for scaled or integer data, and the type
+        of the data otherwise. Unsigned integers (e.g. DQ arrays) wrap around when
+        scaled, so BZERO offsets are exact.
+    """
+
+    def __init__(self, hdu: fits.ImageHDU, dtype: Optional[np.dtype] = None):
+        self.raw = hdu.data
+        self.bscale = hdu.header.get("BSCALE", 1)
+        self.bzero = hdu.header.get("BZERO", 0)
+        self.scaled = self.bscale != 1 or self.bzero != 0
+        if dtype is not None:
+            self.dtype = np.dtype(dtype)
+        elif self.scaled or not np.issubdtype(self.raw.dtype, np.floating):
+            self.dtype = np.dtype(np.float32)
+        else:
+            self.dtype = self.raw.dtype.newbyteorder("=")
+
+    @property
+    def shape(self) -> tuple:
+        return self.raw.shape
+
+    @property
+    def ndim(self) -> int:
+        return self.raw.ndim
+
+    def __getitem__(self, index) -> np.ndarray:
+        data = self.raw[index].astype(self.dtype)
+        if self.scaled:
+            data *= self.dtype.type(self.bscale)
+            data += self.dtype.type(self.bzero)
+        return data
+
+
+def _create_output_file(
+    hdul: fits.HDUList, output_file: Path, sci_dtype: np.dtype
+) -> None:
+    """
+    Copy all extensions to the output file in their order, with an empty SCI extension
+
+    The SCI data is not written: the file is only extended by its size, so that the
+    extension can then be memory-mapped and filled one tile at a time.
+    """
+    sci_index = hdul.index_of("SCI")
+    fits.HDUList(hdul[:sci_index]).writeto(output_file, overwrite=True)
+
+    sci_header = hdul["SCI"].header.copy()
+    # Output data is floating point
+    sci_header["BITPIX"] = -8 * sci_dtype.itemsize
+    for key in ("BSCALE", "BZERO"):
+        sci_header.remove(key, ignore_missing=True)
+
+    nbytes = math.prod(hdul["SCI"].data.shape) * sci_dtype.itemsize
+    padded_nbytes = math.ceil(nbytes / FITS_BLOCK_NBYTES) * FITS_BLOCK_NBYTES
+    # Append mode ignores seeks, so the file is opened for update at its end
+    with open(output_file, "r+b") as f:
+        f.seek(0, 2)
+        f.write(sci_header.tostring().encode("ascii"))
+        # Seeking past the end and writing one byte extends the file without writing data
+        f.seek(padded_nbytes - 1, 1)
+        f.write(b"\0")
+
+        if sci_index + 1 < len(hdul):
+            # Extensions after SCI are unchanged: their bytes are copied from the input
+            with open(hdul.filename(), "rb") as input_f:
+                input_f.seek(hdul.fileinfo(sci_index + 1)["hdrLoc"])
+                shutil.copyfileobj(input_f, f)
+
+
+def _dq_arrays(hdul: fits.HDUList, ndim: int) -> list:
+    """
+    DQ extensions of the file read on access (see `one_over_f.get_dq_arrays`)
+    """
+    names = ("GROUPDQ", "PIXELDQ") if ndim == 4 else ("DQ",)
+    # DQ arrays are unsigned integers, stored as signed integers with BZERO in FITS
+    return [
+        ScaledData(hdul[name], dtype=f"u{hdul[name].data.itemsize}")
+        for name in names
+        if name in hdul
+    ]
+
+
+def correct_oof_file(
+    input_file: Union[Path, str],
+    output_file: Optional[Union[Path, str]] = None,
+    output_dir: Optional[Union[Path, str]] = None,
+    save_intermediate: bool = False,
+    intermediate_output_subdir: Optional[Union[Path, str]] = None,
+    intermediate_compress: bool = False,
+    intermediate_float32: bool = False,
+    intermediate_async: bool = True,
+    deep_stack: Optional[Union[dict, Path, str]] = None,
+    dq_bits: Optional[Union[int, str]] = None,
+    noutputs: Optional[int] = None,
+    **kwargs,
+) -> Path:
+    """
+    Correct 1/f noise in a FITS file using memory maps.
+
+    Only the slices needed by each stage of the correction are read from the input and
+    the result is written to the output file tile by tile. Combine with `max_memory`
+    to bound the memory used by the correction.
+
+    Parameters
+    ----------
+    input_file : Union[Path, str]
+        Path to the input file (e.g. uncal or saturation product)
+    output_file : Optional[Union[Path, str]]
+        Path of the output file. Default is the input name with the `oneoverf` suffix
+        in `output_dir`.
+    output_dir : Optional[Union[Path, str]]
+        Directory where result is saved (defaults to CWD)
+    save_intermediate : bool
+        Whether intermediate outputs should be saved (requires full-size arrays)
+    intermediate_output_subdir : Optional[Union[Path, str]]
+        The directory where intermedaite outputs should be saved. Default is in output_dir.
+    intermediate_compress, intermediate_float32, intermediate_async : bool
+        How intermediate products are saved (see `correct_oof`)
+    deep_stack : Optional[Union[dict, Path, str]]
+        Deep stack shared by several exposures (see `correct_oof`)
+    dq_bits : Optional[Union[int, str]]
+        DQ flags of the pixels excluded from the noise map (see `correct_oof`). DQ
+        extensions are memory-mapped like the data.
+    noutputs : Optional[int]
+        Number of amplificators that read the array. Default is the NOUTPUTS keyword
+        (see `correct_oof`).
+    **kwargs
+        Other options passed to `correct_oof_data` (e.g. `max_memory`, `outlier_map`)
+
+    Returns
+    -------
+    Path
+        Path of the output file
+    """
+    output_dir = _make_output_dir(output_dir)
+    if output_file is None:
+        output_file = get_output_path(input_file, output_dir)
+    output_file = Path(output_file)
+
+    with fits.open(input_file, memmap=True, do_not_scale_image_data=True) as hdul:
+        data = ScaledData(hdul["SCI"])
+        subarray = hdul[0].header["SUBARRAY"]
+        noutputs = noutputs or hdul[0].header.get("NOUTPUTS")
+
+        deep_stack = deepstack.get_deep_stack(deep_stack)
+        if deep_stack is not None:
+            deepstack.check_compatible(
+                deepstack.get_header_stack_keys(hdul),
+                deep_stack["keys"],
+                name=Path(input_file).name,
+            )
+
+        _create_output_file(hdul, output_file, data.dtype)
+        with fits.open(output_file, mode="update", memmap=True) as out_hdul:
+            intermediates = correct_oof_data(
+                data,
+                out_hdul["SCI"].data,
+                subarray,
+                save_intermediate=save_intermediate,
+                deep_stack=deep_stack,
+                dq=_dq_arrays(hdul, data.ndim) if dq_bits is not None else None,
+                dq_bits=dq_bits,
+                noutputs=noutputs,
+                **kwargs,
+            )
+
+    if save_intermediate:
+        _save_intermediates(
+            intermediates,
+            output_dir,
+            exposure_file=input_file,
+            intermediate_output_subdir=intermediate_output_subdir,
+            compress=intermediate_compress,
+            float32=intermediate_float32,
+            asynchronous=intermediate_async,
+        )
+
+    return output_file
@@ -0,0 +1,134 @@
+"""
+Compiled kernel for the weighted column means of the 1/f correction.
+
+With numpy, the weighted mean of each column (`one_over_f.compute_oof`) creates a
+full-size temporary for the weighted data, then runs separate reductions over it, and
+the median of each frame is subtracted in another pass before that. The numba kernel
+fuses the median subtraction, weighting, NaN skipping and reduction in a single pass
+over the data, parallelized over frames and amplificators.
+
+numba is optional: `get_kernel("auto")` falls back to numpy when it is not installed.
+It is only imported when the kernel is first used, which takes a noticeable time.
+
+The numba kernel sums in float64 while numpy sums in the working precision, so the
+noise maps agree to float32 rounding (a few 1e-6 of the 1/f amplitude, tracked by the
+`NumbaEquivalence` benchmarks). Once subtracted from float32 data, a few pixels can
+then differ by one float32 rounding step, so the results of "auto" depend on
+whether numba is installed at that level. Use "numpy" for reproducible results
+across environments.
+"""
+import importlib.util
+from typing import Optional
+
+import numpy as np
+
+__all__ = ["KERNELS", "HAS_NUMBA", "get_kernel", "column_means"]
+
+KERNELS = ("auto", "numpy", "numba")
+
+HAS_NUMBA = importlib.util.find_spec("numba") is not None
+
+
+def get_kernel(kernel: str, check_installed: bool = True) -> str:
+    """
+    Resolve the kernel used to compute the noise map.
+
+    Parameters
+    ----------
+    kernel : str
+        "numba", "numpy", or "auto" to use numba when it is installed (results
+        then agree to float32 rounding across environments, see module docstring)
+    check_installed : bool
+        Whether to raise if "numba" is requested but not installed. False only
+        resolves the name, e.g. to plan a run from the headers of its exposures.
+
+    Returns
+    -------
+    str
+        "numba" or "numpy"
+    """
+    if kernel not in KERNELS:
+        raise ValueError(f"Unknown kernel '{kernel}'. Should be one of {KERNELS}")
+    if kernel == "auto":
+        return "numba" if HAS_NUMBA else "numpy"
+    if kernel == "numba" and check_installed and not HAS_NUMBA:
+        raise ImportError("numba is required for the numba kernel")
+    return kernel
+
+
+def column_means(
+    sub: np.ndarray,
+    weights: np.ndarray,
+    offsets: Optional[np.ndarray] = None,
+    n_threads: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Weighted mean of each column with the numba kernel.
+
+    Same result as `one_over_f.compute_oof(sub - offsets, weights)`: NaN values are
+    skipped in the weighted sum, which is divided by the sum of all weights, and
+    non-finite means are set to 0. Sums are accumulated in float64.
+
+    Parameters
+    ----------
+    sub : np.ndarray
+        Data split per amplificator, with shape (..., namps, nrow, ncol)
+    weights : np.ndarray
+        Weights with shape (..., namps, nrow, ncol), broadcastable to sub along the
+        leading axes (e.g. one weight map per group, shared by all integrations)
+    offsets : Optional[np.ndarray]
+        Value subtracted from each frame before weighting (e.g. median of each frame),
+        with shape `sub.shape[:-3]`
+    n_threads : Optional[int]
+        Number of threads of the kernel, at most `numba.config.NUMBA_NUM_THREADS`.
+        Default is the numba setting (all cores unless configured). Each frame is
+        summed by a single thread, so the result does not depend on the number of
+        threads.
+
+    Returns
+    -------
+    np.ndarray
+        Mean of each column, with shape (..., namps, 1, ncol)
+    """
+    lead_shape = sub.shape[:-3]
+    frame_shape = sub.shape[-3:]
+    nframe = int(np.prod(lead_shape))
+
+    # Weights shared by the leading axes of sub are not repeated in memory
+    nwlead = weights.ndim - 3
+    if weights.shape[:-3] != lead_shape[len(lead_shape) - nwlead :]:
+        raise ValueError(
+            f"Weights with shape {weights.shape} do not match data {sub.shape}"
+        )
+    weights_frames = np.ascontiguousarray(weights).reshape(-1, *frame_shape)
+
+    if offsets is None:
+        offsets = np.zeros(nframe)
+    offsets = np.ascontiguousarray(offsets, dtype=np.float64).reshape(nframe)
+
+    # numba is imported with the kernel module on first use
+    import numba
+
+    from ._numba_kernels import column_sums
+
+    if n_threads is not None:
+        previous_n_threads = numba.get_num_threads()
+        numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+    try:
+        sums = column_sums(
+            np.ascontiguousarray(sub).reshape(nframe, *frame_shape),
+            weights_frames,
+            offsets,
+        )
+    finally:
+        if n_threads is not None:
+            numba.set_num_threads(previous_n_threads)
+
+    # The denominator does not depend on the data: computed once per weight map
+    weight_sums = np.nansum(weights_frames, axis=-2, dtype=np.float64)
+    nrepeat = nframe // weights_frames.shape[0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = sums.reshape(nrepeat, *weight_sums.shape) / weight_sums
+    means = means.astype(sub.dtype).reshape(*lead_shape, frame_shape[0], 1, -1)
+
+    return np.where(np.isfinite(means), means, 0)
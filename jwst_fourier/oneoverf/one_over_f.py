@@ -1,38 +1,61 @@
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Union
+from typing import Callable, Optional, Sequence, Union
 
 import numpy as np
 from astropy.io import fits
 from jwst import datamodels
+from jwst.datamodels import dqflags
 from jwst.lib.suffix import remove_suffix
-from matplotlib import rcParams
 
-rcParams["image.origin"] = "lower"
+from . import amplifiers, deepstack, kernels, stacking, strategies
+from .strategies import get_working_dtype
 
+log = logging.getLogger(__name__)
 
-def stack_ramp(ramp: np.ndarray) -> np.ndarray:
+# Number of tile-sized arrays that exist at the same time while correcting one tile
+# (data, sub, weighted sub, noise map, corrected data, ...).
+# Used to convert a memory budget to a number of columns per tile.
+TILE_ARRAY_COPIES = 6
+
+INTERMEDIATE_PRODUCTS = ("deepstack", "deepstack_rms", "sub", "subcorr", "noisemap")
+
+# Intermediate products are written in order by a single background thread
+_intermediate_writer: Optional[ThreadPoolExecutor] = None
+_intermediate_writes: list = []
+
+
+def stack_ramp(
+    ramp: np.ndarray,
+    method: str = "median",
+    dtype: Optional[np.dtype] = None,
+    window: Optional[int] = None,
+) -> np.ndarray:
     """
     Stack the ramp along the integration axis (axis=0).
 
     :param ramp: Ramp (uncal) observation to be stacked (nints, ngroups, npix1, npix2)
     :type ramp: np.ndarray
-    :return: Ramp array stacked along integration axis. Shape (ngroups, npix1, npix2)
+    :param method: Estimator used to stack ("median", "sigma_clip" or "odd_ratio")
+    :type method: str
+    :param dtype: Floating point type of the computation. Default is the ramp type if floating.
+    :type dtype: Optional[np.dtype]
+    :param window: Number of integrations in the window of the rolling methods
+    :type window: Optional[int]
+    :return: Ramp array stacked along integration axis and its RMS. Shape (ngroups, npix1, npix2),
+        or the shape of the ramp for rolling methods
     :rtype: np.ndarray
     """
-    # TODO: Try with etienne's odd_ratio_mean
     # TODO: This handles outliers along int, but not along group or spatially (i.e. same in all int but outlier vs others like hot pixel)
-    # Check for nans because nanmedian can be slow and memory-intensive for large files
-    if np.isnan(ramp).any():
-        deepstack = np.nanmedian(ramp, axis=0)
-        rms = np.nanstd(ramp, axis=0)
-    else:
-        deepstack = np.median(ramp, axis=0)
-        rms = np.std(ramp, axis=0)
+    # NaNs are handled directly by the stacking engine, without nanmedian's large temporaries
+    return stacking.stack_integrations(ramp, method=method, dtype=dtype, window=window)
 
-    return deepstack, rms
 
-
-def compute_oof(ramp: np.ndarray, weights: np.ndarray, subarray: str) -> np.ndarray:
+def compute_oof(
+    ramp: np.ndarray, weights: np.ndarray, masked: bool = False
+) -> np.ndarray:
     """
     Compute 1/f noise for each column in the ramp.
 
@@ -41,61 +64,192 @@ def compute_oof(ramp: np.ndarray, weights: np.ndarray, subarray: str) -> np.ndar
     superbias). Data should be:
         - 2D (dimy, dimx)
         - 3D (ngroup or nint, dimy, dimx)
-        - >3D (nint, ngroup, dimy, dimx, *)
+        - >3D (nint, ngroup, *, dimy, dimx)
     For >3D, extra dimensions (e.g. amplificators in the FULL array) should be
-    at the end.
+    before the last two axes.
 
-    The weighted average is computed per column and broadcast to the same shape
-    as ramp
+    The weighted average is computed per column and returned with a length of 1
+    along the column axis, so that it broadcasts against the ramp.
 
     Parameters
     ----------
     ramp : np.ndarray
         The data from which 1/f noise should be computed
     weights : np.ndarray
-        Weight of each pixel in the array, with shape (ngroup, dimy, dimx)
-    subarray : str
-        Subarray corresponding to the data, dictates how shape is hanlded
+        Weight of each pixel in the array, broadcastable to ramp
+    masked : bool
+        Whether invalid pixels are already masked with a weight and a value of 0, so
+        that the sums do not need to skip NaN values (faster)
 
     Returns
     -------
     np.ndarray
-        1/f map with the same shape as ramp
+        1/f value of each column, with shape (..., 1, dimx)
     """
-    # Get axis that is along columns (with length nrows)
-    if subarray == "FULL" and ramp.ndim > 3:
-        # If more than 3 dim and FULL: (nint, ngroup, *nrow*, ncol, namps)
-        # If more than 3 dim and SUB: (nint, *nrow*, ncol, namps)
-        col_axis = -3
-    else:
-        # If FULL and 3 or less: (ngroup/int?, *nrow*, ncol) -> -2
-        # If not FULL: (ngroup/int?, *nrow*, ncol) -> r2
-        col_axis = -2
-    nrows = ramp.shape[col_axis]
-
-    # Get index shape when we repeat along columns at then end
-    if col_axis >= 0:
-        # Positive col_axis, index will be, e.g. [:, :, new, ...] For col = 2
-        repeat_ind = np.s_[(slice(None),) * col_axis + (np.newaxis,) + (Ellipsis,)]
-    else:
-        # Negative col_axis, index will be [..., new, :] For col = -2
-        repeat_ind = np.s_[
-            (Ellipsis,) + (np.newaxis,) + (slice(None),) * -(col_axis + 1)
-        ]
-
     # Sum along columns to get DC value in each column
-    dc = np.nansum(weights * ramp, axis=col_axis) / np.nansum(weights, axis=col_axis)
+    if masked:
+        dc = np.sum(weights * ramp, axis=-2, keepdims=True) / np.sum(
+            weights, axis=-2, keepdims=True
+        )
+    else:
+        dc = np.nansum(weights * ramp, axis=-2, keepdims=True) / np.nansum(
+            weights, axis=-2, keepdims=True
+        )
     # Make sure non nan
-    dc = np.where(np.isfinite(dc), dc, 0)
-    # Expand along column axis
-    return np.repeat(dc[repeat_ind], nrows, axis=col_axis)
+    return np.where(np.isfinite(dc), dc, 0)
+
+
+def get_namps(subarray: str, nrow: int, noutputs: Optional[int] = None) -> int:
+    """
+    Number of amplificators that split the columns of the array.
+
+    Parameters
+    ----------
+    subarray : str
+        Subarray used to acquire the data. When FULL, each amplificator reads 512 rows.
+    nrow : int
+        Number of rows in the array
+    noutputs : Optional[int]
+        Number of outputs used to read the array (see `amplifiers.get_amp_layout`)
+
+    Returns
+    -------
+    int
+        Number of amplificators
+    """
+    return amplifiers.get_amp_layout(subarray, nrow, noutputs=noutputs).namps
+
+
+def split_amps(data: np.ndarray, namps: int) -> np.ndarray:
+    """
+    View of the data with the rows split per amplificator.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Data with shape (..., nrow, ncol)
+    namps : int
+        Number of amplificators
+
+    Returns
+    -------
+    np.ndarray
+        View of the data with shape (..., namps, nrow // namps, ncol)
+    """
+    return amplifiers.AmpLayout(namps).split(data)
+
+
+def _get_amp_layout(
+    subarray: Union[str, amplifiers.AmpLayout], nrow: int
+) -> amplifiers.AmpLayout:
+    """
+    Amplificator layout given directly or from the subarray name
+    """
+    if isinstance(subarray, amplifiers.AmpLayout):
+        return subarray
+    return amplifiers.get_amp_layout(subarray, nrow)
+
+
+def apply_noise_map(
+    data: np.ndarray, dcmap: np.ndarray, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Subtract a compact 1/f noise map from the data using broadcasting.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Data with shape (..., nrow, ncol)
+    dcmap : np.ndarray
+        Compact noise map from `generate_noise_map`, with shape (..., namps, 1, ncol)
+    out : Optional[np.ndarray]
+        Array where the result is stored, with the same shape as data
+
+    Returns
+    -------
+    np.ndarray
+        Corrected data, with the same shape as data
+    """
+    namps = dcmap.shape[-3]
+    if out is not None:
+        np.subtract(split_amps(data, namps), dcmap, out=split_amps(out, namps))
+        return out
+    return np.subtract(split_amps(data, namps), dcmap).reshape(data.shape)
+
+
+def expand_noise_map(dcmap: np.ndarray, shape: tuple) -> np.ndarray:
+    """
+    Materialize the full-size 1/f noise map from its compact representation.
+
+    Parameters
+    ----------
+    dcmap : np.ndarray
+        Compact noise map from `generate_noise_map`, with shape (..., namps, 1, ncol)
+    shape : tuple
+        Shape of the data (..., nrow, ncol)
+
+    Returns
+    -------
+    np.ndarray
+        Noise map with the given shape
+    """
+    namps = dcmap.shape[-3]
+    per_amp_shape = shape[:-2] + (namps, shape[-2] // namps, shape[-1])
+    return np.broadcast_to(dcmap, per_amp_shape).reshape(shape)
+
+
+def get_n_threads(n_threads: Optional[int]) -> int:
+    """
+    Number of threads used to compute the noise map.
+
+    Parameters
+    ----------
+    n_threads : Optional[int]
+        Number of threads. 0 uses all cores and None a single thread.
+
+    Returns
+    -------
+    int
+        Number of threads
+    """
+    if n_threads is None:
+        return 1
+    if n_threads < 0:
+        raise ValueError(f"Number of threads should be positive or 0, not {n_threads}")
+    if n_threads == 0:
+        return os.cpu_count() or 1
+    return n_threads
+
+
+def _run_on_integrations(func: Callable, nint: int, n_threads: int):
+    """
+    Call `func(chunk)` on slices of integrations, in parallel on `n_threads` threads
+
+    Each call should write its result for the integrations of its slice in a
+    preallocated output. The computation of each integration does not depend on the
+    slicing, so the result is the same for any number of threads.
+    """
+    n_threads = min(n_threads, nint)
+    bounds = np.linspace(0, nint, n_threads + 1).astype(int)
+    chunks = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+    if n_threads <= 1:
+        for chunk in chunks:
+            func(chunk)
+        return
+
+    # numpy releases the GIL in its reductions, so threads run in parallel
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        # Consume the results to raise exceptions from the threads
+        list(pool.map(func, chunks))
 
 
 def generate_noise_map(
     sub: np.ndarray,
     pixel_weights: np.ndarray,
-    subarray: str,
+    subarray: Union[str, amplifiers.AmpLayout],
     mean_per_frame: bool = False,
+    masked: bool = False,
+    n_threads: Optional[int] = None,
 ) -> np.ndarray:
     """
     Generate 1/f noise map for each individual group.
@@ -109,65 +263,67 @@ def generate_noise_map(
         Ramp data with stacked integration subtracted from each group
     pixel_weights : np.ndarray
         Weight associated with each pixel when calculing mean over columns.
-    subarray : str
+        Either one map per group shared by all integrations, or one per frame.
+    subarray : Union[str, amplifiers.AmpLayout]
         Subarray used to acquire the data. When FULL, correction is done per amplificator.
+        An `amplifiers.AmpLayout` can also be given for other readout geometries.
+    masked : bool
+        Whether invalid pixels have a weight and a value of 0 (see `compute_oof`)
+    n_threads : Optional[int]
+        Number of threads that compute the map, each for a slice of integrations
+        (see `get_n_threads`). The result does not depend on the number of threads.
 
     Returns
     -------
     np.ndarray
-        1/f noise map with same shape as sub
+        Compact 1/f noise map with one value per column and amplificator, with shape
+        (nint, ngroup, namps, 1, ncol). Use `apply_noise_map` to subtract it from the
+        data and `expand_noise_map` to get a map with the same shape as sub.
     """
 
-    if sub.ndim == 4:
-        nint, ngroup, nrow, ncol = sub.shape
-    elif sub.ndim == 3:
-        nint, nrow, ncol = sub.shape
-    else:
+    if sub.ndim not in (3, 4):
         raise ValueError(f"Unsupported number of dimensions for data: {sub.ndim}")
 
-    # Median on all pixels in each frame, keep int and group dims
-    # and broadcast to match subarray
-    if mean_per_frame:
-        sub = sub - np.nanmedian(sub, axis=(-2, -1))[:, :, None, None]
-
-    if subarray == "FULL":
-        # For full array, each amplificator has its own noise
-        # All columsn are split in 4 (2048/512)
-        amp_nrows = 512
-        namps = nrow // amp_nrows
-        # I could not get numpy to reshape directly, but moving axes does the trick
-        try:
-            per_amp_shape = (nint, ngroup, namps, amp_nrows, ncol)
-        except NameError:
-            per_amp_shape = (nint, namps, amp_nrows, ncol)
-        sub_per_amp = np.moveaxis(sub.reshape(per_amp_shape), -3, -1)
-        pixel_weights_per_amp = np.moveaxis(
-            pixel_weights.reshape(per_amp_shape[1:]), -3, -1
+    # The amplificator axis is inserted before rows with views of the data
+    layout = _get_amp_layout(subarray, sub.shape[-2])
+    dcmap = np.empty(
+        sub.shape[:-2] + (layout.namps, 1, sub.shape[-1]),
+        dtype=np.result_type(sub, pixel_weights),
+    )
+
+    def compute_integrations(chunk: slice):
+        sub_chunk = sub[chunk]
+        # Median on all pixels in each frame, keep int and group dims
+        # and broadcast to match subarray
+        if mean_per_frame:
+            medians = np.nanmedian(sub_chunk, axis=(-2, -1))
+            sub_chunk = sub_chunk - medians[..., None, None]
+        if pixel_weights.ndim == sub.ndim:
+            weights_chunk = pixel_weights[chunk]
+        else:
+            weights_chunk = pixel_weights
+        dcmap[chunk] = compute_oof(
+            layout.split(sub_chunk), layout.split(weights_chunk), masked=masked
         )
-        # Important that namps on last axis.
-        # Function below has assumptions about first 4 axes (int, group, y, x)
-        dcmap_per_amp = compute_oof(sub_per_amp, pixel_weights_per_amp, subarray)
-        # Back to original shape. Again because of reshape need to move namp axis before
-        dcmap = np.moveaxis(dcmap_per_amp, -1, -3).reshape(sub.shape)
-    else:
-        # If only one amp (like in all subarrays), vectorized correction works directly
-        dcmap = compute_oof(sub, pixel_weights, subarray)
 
+    _run_on_integrations(compute_integrations, sub.shape[0], get_n_threads(n_threads))
     return dcmap
 
 
 def generate_noise_map_iter(
     sub: np.ndarray,
     pixel_weights: np.ndarray,
-    subarray: str,
+    subarray: Union[str, amplifiers.AmpLayout],
     mean_per_frame: bool = False,
+    masked: bool = False,
+    n_threads: Optional[int] = None,
 ) -> np.ndarray:
     """
     Generate the 1/f noise map by looping over integrations.
 
     This function is kept only in case `generate_noise_map` (the vectorized version)
-    causes memory issues. Another reason to use this would be to attempt optimizations
-    with something like numba.
+    causes memory issues. A compiled version that loops over frames in parallel is
+    available with numba (see `kernels.column_means`).
 
     Parameters
     ----------
@@ -175,55 +331,768 @@ def generate_noise_map_iter(
         Ramp data with stacked integration subtracted from each group
     pixel_weights : np.ndarray
         Weight associated with each pixel when calculing mean over columns.
-    subarray : str
+        Either one map per group shared by all integrations, or one per frame.
+    subarray : Union[str, amplifiers.AmpLayout]
         Subarray used to acquire the data. When FULL, correction is done per amplificator.
+        An `amplifiers.AmpLayout` can also be given for other readout geometries.
+    masked : bool
+        Whether invalid pixels have a weight and a value of 0 (see `compute_oof`)
+    n_threads : Optional[int]
+        Number of threads looping over integrations (see `generate_noise_map`)
 
     Returns
     -------
     np.ndarray
-        1/f noise map with same shape as sub
+        Compact 1/f noise map with shape (nint, ngroup, namps, 1, ncol)
+        (see `generate_noise_map`), or (nint, namps, 1, ncol) for a cube
     """
 
-    nint, ngroup, _, _ = sub.shape
-    dcmap = np.empty_like(sub)
-    for i in range(nint):
-        # Get ith integration in actual data, subtract median frame from it for each group and each pixel
-        for g in range(ngroup):
+    if sub.ndim not in (3, 4):
+        raise ValueError(f"Unsupported number of dimensions for data: {sub.ndim}")
+    if sub.ndim == 3:
+        # Cubes (e.g. rateints) are looped over like ramps with a single group
+        dcmap = generate_noise_map_iter(
+            sub[:, np.newaxis],
+            pixel_weights[..., np.newaxis, :, :],
+            subarray,
+            mean_per_frame=mean_per_frame,
+            masked=masked,
+            n_threads=n_threads,
+        )
+        return dcmap[:, 0]
+
+    nint, ngroup, nrow, ncol = sub.shape
+    layout = _get_amp_layout(subarray, nrow)
+    dcmap = np.empty((nint, ngroup, layout.namps, 1, ncol), dtype=sub.dtype)
 
-            if mean_per_frame:
-                sub[i, g] = sub[i, g] - np.nanmedian(sub[i, g])
+    def compute_integrations(chunk: slice):
+        for i in range(chunk.start, chunk.stop):
+            # Get ith integration in actual data, subtract median frame from it for each group and each pixel
+            for g in range(ngroup):
 
-        if subarray == "FULL":
-            amp_nrows = 512
-            for iamp in range(4):
-                amp_first_row = iamp * amp_nrows
-                int_ind = np.s_[i, :, amp_first_row : amp_first_row + amp_nrows, :]
-                dcmap[int_ind] = compute_oof(
-                    sub[int_ind], pixel_weights[int_ind[1:]], subarray
+                if mean_per_frame:
+                    sub[i, g] = sub[i, g] - np.nanmedian(sub[i, g])
+
+            sub_per_amp = layout.split(sub[i])
+            if pixel_weights.ndim == sub.ndim:
+                weights_per_amp = layout.split(pixel_weights[i])
+            else:
+                weights_per_amp = layout.split(pixel_weights)
+            for iamp in range(layout.namps):
+                dcmap[i, :, iamp] = compute_oof(
+                    sub_per_amp[:, iamp], weights_per_amp[:, iamp], masked=masked
                 )
-        else:
-            dcmap[i] = compute_oof(sub[i], pixel_weights, subarray)
 
+    _run_on_integrations(compute_integrations, nint, get_n_threads(n_threads))
     return dcmap
 
 
 def _save_intermediate_fits(
-    data: np.ndarray, output_path: Optional[Union[Path, str]], overwrite: bool = True
+    intermediates: dict,
+    output_path: Optional[Union[Path, str]],
+    compress: bool = False,
+    float32: bool = False,
+    overwrite: bool = True,
 ):
     """
-    Helper function to save intermediate products to FITS
+    Helper function to save intermediate products to one multi-extension FITS file
 
     Parameters
     ----------
-    data : np.ndarray
-        Dataset to save
+    intermediates : dict
+        Datasets to save, each in an extension named after its key
     output_path : Optional[Union[Path, str]]
         Full Path of the output
+    compress : bool
+        Whether extensions should be tile-compressed (lossless GZIP)
+    float32 : bool
+        Whether float64 datasets should be downcast to float32
     overwrite : bool
         Whether existing files should be overwritten (passed to astropy)
     """
-    hdu = fits.PrimaryHDU(data)
-    hdu.writeto(output_path, overwrite=overwrite)
+    hdul = fits.HDUList([fits.PrimaryHDU()])
+    for name, data in intermediates.items():
+        if float32 and data.dtype == np.float64:
+            data = data.astype(np.float32)
+        if compress:
+            # Floating point data is not quantized, so compression is lossless
+            hdu = fits.CompImageHDU(
+                data, name=name, compression_type="GZIP_2", quantize_level=0.0
+            )
+        else:
+            hdu = fits.ImageHDU(data, name=name)
+        hdul.append(hdu)
+    hdul.writeto(output_path, overwrite=overwrite)
+    log.info(f"Saved intermediate products to {output_path}")
+
+
+def _log_write_error(future: Future):
+    if future.exception() is not None:
+        log.error(f"Writing intermediate products failed: {future.exception()}")
+
+
+def save_intermediate_async(
+    intermediates: dict, output_path: Union[Path, str], **kwargs
+) -> Future:
+    """
+    Save intermediate products on a background thread (see `_save_intermediate_fits`).
+
+    The arrays in `intermediates` must not be modified after this call.
+    Use `wait_for_intermediates` to wait until all files are written.
+    """
+    global _intermediate_writer
+    if _intermediate_writer is None:
+        _intermediate_writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="oneoverf-intermediate"
+        )
+    future = _intermediate_writer.submit(
+        _save_intermediate_fits, intermediates, output_path, **kwargs
+    )
+    future.add_done_callback(_log_write_error)
+    _intermediate_writes.append(future)
+    return future
+
+
+def wait_for_intermediates():
+    """
+    Wait until all intermediate products saved in the background are written.
+
+    Raises the first error that happened while writing, if any.
+    """
+    while _intermediate_writes:
+        _intermediate_writes.pop(0).result()
+
+
+def get_tile_ncols(shape: tuple, itemsize: int, max_memory: float) -> int:
+    """
+    Get the number of columns per tile that keeps the correction within a memory budget.
+
+    The 1/f correction only mixes pixels along columns (and along the integration axis
+    for the stacked ramp), so the cube can be processed in tiles of full columns.
+    The number of columns is chosen so that the temporary arrays used to correct one tile
+    fit in `max_memory`.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the data (nint, ngroup, nrow, ncol) or (nint, nrow, ncol)
+    itemsize : int
+        Size in bytes of one element of the data
+    max_memory : float
+        Memory budget in GB for the arrays used to correct one tile
+
+    Returns
+    -------
+    int
+        Number of columns in each tile (at least 1, at most ncol)
+    """
+    ncol = shape[-1]
+    col_nbytes = int(np.prod(shape[:-1])) * itemsize * TILE_ARRAY_COPIES
+    tile_ncols = int(max_memory * 1024**3 // col_nbytes)
+    if tile_ncols < 1:
+        log.warning(
+            f"Memory budget of {max_memory} GB is too small to hold a single column."
+            " Using one column per tile."
+        )
+    return max(1, min(ncol, tile_ncols))
+
+
+def get_column_tiles(ncol: int, tile_ncols: int) -> list:
+    """
+    Split columns in tiles of at most `tile_ncols` columns.
+
+    Parameters
+    ----------
+    ncol : int
+        Total number of columns
+    tile_ncols : int
+        Number of columns in each tile
+
+    Returns
+    -------
+    list
+        Index (`np.s_[..., start:stop]`) of each tile along the last axis
+    """
+    return [
+        np.s_[..., start : min(start + tile_ncols, ncol)]
+        for start in range(0, ncol, tile_ncols)
+    ]
+
+
+def _outlier_nan_map(outliers: np.ndarray, ndim: int) -> np.ndarray:
+    """
+    Convert an outlier map to a multiplicative map (1 for good pixels, NaN for outliers)
+
+    Parameters
+    ----------
+    outliers : np.ndarray
+        Outlier map (nint, ny, nx). Outliers are flagged with 1.
+    ndim : int
+        Number of dimensions of the data the map is applied to.
+
+    Returns
+    -------
+    np.ndarray
+        Map that can be broadcast to the data
+    """
+    # outliers == 1 is an outlier. Convert those to NaN, otherwise set to 1
+    outliers = np.where(outliers == 0, 1, np.nan)
+
+    # One outlier map per integration. Broadcast to all groups for each
+    if ndim == 4:
+        outliers = outliers[:, np.newaxis, ...]
+
+    return outliers
+
+
+def get_dq_bitmask(dq_bits: Optional[Union[int, str]]) -> Optional[int]:
+    """
+    Integer bitmask of DQ flags.
+
+    Parameters
+    ----------
+    dq_bits : Optional[Union[int, str]]
+        Integer value or comma-separated flag names (e.g.
+        "DO_NOT_USE,SATURATED,JUMP_DET", see `jwst.datamodels.dqflags.pixel`)
+
+    Returns
+    -------
+    Optional[int]
+        Bitmask, or None if `dq_bits` is None
+    """
+    if dq_bits is None:
+        return None
+    bitmask = dqflags.interpret_bit_flags(dq_bits, mnemonic_map=dqflags.pixel)
+    # No flags (e.g. "0") still masks outliers and NaN pixels with zero weight
+    return bitmask or 0
+
+
+def get_dq_arrays(model: Union[datamodels.RampModel, datamodels.CubeModel]) -> list:
+    """
+    DQ arrays flagging the pixels of the data of a model.
+
+    Ramps have a DQ array per group (`groupdq`) and one for all groups (`pixeldq`),
+    cubes have one DQ array per integration (`dq`).
+    """
+    if model.data.ndim == 4:
+        return [model.groupdq, model.pixeldq]
+    return [model.dq]
+
+
+def _good_pixel_mask(
+    shape: tuple,
+    index: tuple,
+    dq: Sequence,
+    dq_bitmask: int,
+    outliers: Optional[np.ndarray],
+    integration: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Mask of the pixels used to compute the noise map (True) in a slice of the data
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the slice of the data
+    index : tuple
+        Index of the slice along the last axes (e.g. a tile from `get_column_tiles`)
+    dq : Sequence
+        DQ arrays with the shape of the data (e.g. groupdq) or of one frame (pixeldq)
+    dq_bitmask : int
+        DQ flags of the pixels that are excluded
+    outliers : Optional[np.ndarray]
+        Outlier map (nint, ny, nx). Outliers are flagged with 1.
+    integration : Optional[int]
+        Integration of the slice. Default is a slice of all integrations.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask with the given shape
+    """
+    data_ndim = len(shape) + (integration is not None)
+    good = np.ones(shape, dtype=bool)
+    for dq_array in dq:
+        if integration is not None and dq_array.ndim == data_ndim:
+            dq_array = dq_array[integration]
+        good &= (dq_array[index] & dq_bitmask) == 0
+
+    if outliers is not None:
+        if integration is not None:
+            outliers = outliers[integration]
+        outlier_good = outliers[index] == 0
+        # One outlier map per integration. Broadcast to all groups for each
+        if integration is None and data_ndim == 4:
+            outlier_good = outlier_good[:, np.newaxis]
+        good &= outlier_good
+
+    return good
+
+
+def _stack_tiles(
+    data: np.ndarray,
+    tiles: list,
+    method: str = "median",
+    dtype: Optional[np.dtype] = None,
+    window: Optional[int] = None,
+) -> tuple:
+    """
+    Stack the ramp along the integration axis one tile at a time
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Ramp data (nints, ngroups, npix1, npix2)
+    tiles : list
+        Index of each tile, from `get_column_tiles`
+    method : str
+        Estimator used to stack (see `stack_ramp`)
+    dtype : Optional[np.dtype]
+        Floating point type of the computation (see `stack_ramp`)
+    window : Optional[int]
+        Window of the rolling methods (see `stack_ramp`)
+
+    Returns
+    -------
+    tuple
+        Stacked ramp and its RMS, each with shape (ngroups, npix1, npix2), or the shape
+        of the ramp for rolling methods
+    """
+    if method in stacking.ONLINE_STACK_METHODS:
+        # Integrations are read one at a time, so the ramp is never fully loaded
+        return stack_ramp(data, method=method, dtype=dtype)
+
+    stacked_ramp = rms = None
+    for tile in tiles:
+        tile_stack, tile_rms = stack_ramp(
+            data[tile], method=method, dtype=dtype, window=window
+        )
+        if stacked_ramp is None:
+            shape = tile_stack.shape[:-1] + data.shape[-1:]
+            stacked_ramp = np.empty(shape, dtype=tile_stack.dtype)
+            rms = np.empty(shape, dtype=tile_rms.dtype)
+        stacked_ramp[tile] = tile_stack
+        rms[tile] = tile_rms
+
+    return stacked_ramp, rms
+
+
+def _frame_medians(
+    data: np.ndarray,
+    stacked_ramp: Optional[np.ndarray],
+    outliers: Optional[np.ndarray],
+    dtype: Optional[np.dtype] = None,
+    dq: Optional[Sequence] = None,
+    dq_bitmask: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Median of each frame once the stacked ramp is subtracted, looping over integrations
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Ramp data (nints, ngroups, npix1, npix2)
+    stacked_ramp : Optional[np.ndarray]
+        Ramp stacked along integration axis (ngroups, npix1, npix2) or one stack per
+        integration (rolling methods), or None if it is already subtracted from the data
+    outliers : Optional[np.ndarray]
+        Outlier map (nint, ny, nx). Outliers are ignored in the median.
+    dtype : Optional[np.dtype]
+        Floating point type of the computation. Default follows numpy type promotion.
+    dq : Optional[Sequence]
+        DQ arrays of the data (see `get_dq_arrays`), used with `dq_bitmask`
+    dq_bitmask : Optional[int]
+        DQ flags of the pixels ignored in the median. When set, the median is taken
+        over the good pixels instead of replacing outliers with NaN.
+
+    Returns
+    -------
+    np.ndarray
+        Median of each frame, with shape (nints, ngroups)
+    """
+    medians = np.empty(data.shape[:-2])
+    for i in range(data.shape[0]):
+        if stacked_ramp is None:
+            sub_int = data[i]
+        elif stacked_ramp.ndim == data.ndim:
+            sub_int = np.subtract(data[i], stacked_ramp[i], dtype=dtype)
+        else:
+            sub_int = np.subtract(data[i], stacked_ramp, dtype=dtype)
+        if dq_bitmask is not None:
+            good = _good_pixel_mask(
+                sub_int.shape, np.s_[...], dq or [], dq_bitmask, outliers, integration=i
+            )
+            good &= np.isfinite(sub_int)
+            for frame in np.ndindex(sub_int.shape[:-2]):
+                medians[(i,) + frame] = np.median(sub_int[frame][good[frame]])
+            continue
+
+        if outliers is not None:
+            outlier_int = _outlier_nan_map(outliers[i], sub_int.ndim)
+            sub_int = np.multiply(sub_int, outlier_int, dtype=dtype)
+        medians[i] = np.nanmedian(sub_int, axis=(-2, -1))
+
+    return medians
+
+
+def correct_oof_data(
+    data: np.ndarray,
+    out: np.ndarray,
+    subarray: str,
+    outlier_map: Optional[Union[Path, str]] = None,
+    iterative: bool = False,
+    mean_per_frame: bool = False,
+    max_memory: Optional[float] = None,
+    stack_method: str = "median",
+    working_precision: str = "auto",
+    save_intermediate: bool = False,
+    intermediate_products: Optional[Sequence[str]] = None,
+    kernel: str = "auto",
+    deep_stack: Optional[dict] = None,
+    dq: Optional[Sequence] = None,
+    dq_bits: Optional[Union[int, str]] = None,
+    noutputs: Optional[int] = None,
+    n_threads: Optional[int] = None,
+    strategy: Optional[str] = None,
+    backend: str = "numpy",
+    dask_scheduler: Optional[str] = None,
+    stack_window: Optional[int] = None,
+) -> Optional[dict]:
+    """
+    Correct 1/f noise in a data array and write the result in an output array.
+
+    The data is only accessed through slices (one tile of columns or one integration
+    at a time), so it can be any array-like object that reads data on access
+    (e.g. a memory-mapped file). See `correct_oof` for a description of the options.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Input ramp (nint, ngroup, nrow, ncol) or cube (nint, nrow, ncol)
+    out : np.ndarray
+        Array where the corrected data is written. Can be `data` itself.
+    subarray : str
+        Subarray used to acquire the data. When FULL, correction is done per amplificator.
+    deep_stack : Optional[dict]
+        Deep stack from `deepstack.build_deep_stack` or `deepstack.load_deep_stack`,
+        used instead of stacking the data
+    dq : Optional[Sequence]
+        DQ arrays of the data (see `get_dq_arrays`), read one slice at a time like
+        the data. Only used when `dq_bits` is set.
+    noutputs : Optional[int]
+        Number of outputs used to read the array (see `amplifiers.get_amp_layout`)
+    n_threads : Optional[int]
+        Number of threads computing the noise map (see `correct_oof`)
+    strategy : Optional[str]
+        Execution of the correction, which sets `iterative` and `max_memory` (see
+        `correct_oof`)
+    backend : str
+        "numpy", or "dask" to correct chunks of columns in parallel (see `correct_oof`)
+    dask_scheduler : Optional[str]
+        Scheduler of the dask backend (see `dask_backend.correct_oof_dask`)
+    stack_window : Optional[int]
+        Window of the rolling stack methods (see `correct_oof`)
+
+    Returns
+    -------
+    Optional[dict]
+        Intermediate products if `save_intermediate` is True, None otherwise
+    """
+    dtype = get_working_dtype(working_precision)
+    kernel = kernels.get_kernel(kernel)
+    backend = strategies.get_backend(backend)
+    if backend == "dask" and save_intermediate:
+        raise ValueError("Intermediate products cannot be saved with the dask backend")
+    iterative, max_memory = strategies.resolve_strategy(
+        strategy,
+        data.shape,
+        data.dtype,
+        iterative=iterative,
+        max_memory=max_memory,
+        working_dtype=dtype,
+        stack_method=stack_method,
+        kernel=kernel,
+    )
+    products = get_intermediate_products(intermediate_products)
+    if not save_intermediate:
+        products = ()
+    dq_bitmask = get_dq_bitmask(dq_bits)
+    layout = amplifiers.get_amp_layout(subarray, data.shape[-2], noutputs=noutputs)
+    masked = dq_bitmask is not None
+    if not masked or dq is None:
+        dq = []
+
+    ncol = data.shape[-1]
+    if max_memory is None:
+        tile_ncols = ncol
+    else:
+        tile_ncols = get_tile_ncols(data.shape, data.dtype.itemsize, max_memory)
+    tiles = get_column_tiles(ncol, tile_ncols)
+    if len(tiles) > 1 and backend == "numpy":
+        log.info(f"Correcting 1/f noise in {len(tiles)} tiles of {tile_ncols} columns")
+
+    if deep_stack is not None:
+        if deep_stack["stack"].shape != data.shape[1:]:
+            raise ValueError(
+                f"Deep stack with shape {deep_stack['stack'].shape} does not match"
+                f" data with shape {data.shape}"
+            )
+        stacked_ramp = deep_stack["stack"].astype(dtype or data.dtype, copy=False)
+        rms = deep_stack["rms"].astype(dtype or data.dtype, copy=False)
+    elif backend == "dask":
+        # Each chunk is stacked by the dask backend
+        stacked_ramp = rms = None
+    else:
+        # Get stacked ramp (keep group dimenion, but stack along integration)
+        stacked_ramp, rms = _stack_tiles(
+            data, tiles, method=stack_method, dtype=dtype, window=stack_window
+        )
+
+    # TODO: Without running separate outlier script, could flag some directly here using ramps and stack
+    if outlier_map is not None:
+        outliers = fits.getdata(outlier_map)
+    else:
+        outliers = None
+
+    if backend == "dask":
+        # dask is only imported when its backend is used
+        from . import dask_backend
+
+        dask_backend.correct_oof_dask(
+            data,
+            out,
+            layout,
+            tile_ncols=None if max_memory is None else tile_ncols,
+            stacked_ramp=stacked_ramp,
+            rms=rms,
+            stack_method=stack_method,
+            stack_window=stack_window,
+            working_dtype=dtype,
+            mean_per_frame=mean_per_frame,
+            outliers=outliers,
+            dq=dq,
+            dq_bitmask=dq_bitmask,
+            kernel=kernel,
+            iterative=iterative,
+            scheduler=dask_scheduler,
+        )
+        return None
+
+    # The frame median uses all columns, so it is computed before looping over tiles
+    if mean_per_frame:
+        frame_medians = _frame_medians(
+            data, stacked_ramp, outliers, dtype=dtype, dq=dq, dq_bitmask=dq_bitmask
+        )
+    else:
+        frame_medians = None
+
+    # Full-size arrays are only allocated for the requested products
+    full_size = {}
+
+    for tile in tiles:
+        data_tile = data[tile]
+
+        # TODO: Fix the fact that outliers with very high values have high weight
+        # Using outlier map or some sort of thresholding is probalby best.
+        pixel_weights = rms[tile] ** -2
+        # Some outliers (probably max value) are fix so have 0 rms and inf weight
+        pixel_weights[~np.isfinite(pixel_weights)] = 0.0
+
+        # This automatically subtracts stacked ramp from each int
+        # TODO: Should we weight before subtracing?
+        # this could help mitigate subtraction of PSF as RMS higher in core
+        sub = np.subtract(data_tile, stacked_ramp[tile], dtype=dtype)
+
+        if masked:
+            # Flagged pixels, outliers and NaN get a weight and a value of 0 instead of
+            # NaN, so that the column sums do not need to skip NaN values
+            good = _good_pixel_mask(sub.shape, tile, dq, dq_bitmask, outliers)
+            good &= np.isfinite(sub)
+            pixel_weights = pixel_weights * good
+            sub[~good] = 0
+        elif outliers is not None:
+            outlier_tile = _outlier_nan_map(outliers[tile], sub.ndim)
+            sub = np.multiply(sub, outlier_tile, dtype=dtype)
+
+        if not full_size:
+            for name in set(products) & {"sub", "subcorr", "noisemap"}:
+                full_size[name] = np.empty(data.shape, dtype=sub.dtype)
+        if "sub" in full_size:
+            full_size["sub"][tile] = sub
+            if masked:
+                full_size["sub"][tile][~good] = np.nan
+        if "subcorr" in full_size:
+            # The corrected sub does not include the frame medians
+            if "sub" in full_size:
+                sub_nomed = full_size["sub"][tile]
+            elif frame_medians is not None and kernel == "numpy":
+                sub_nomed = sub.copy()
+            else:
+                sub_nomed = sub
+
+        if kernel == "numba":
+            # Frame medians are subtracted inside the kernel, without modifying sub
+            dcmap = kernels.column_means(
+                layout.split(sub),
+                layout.split(pixel_weights),
+                offsets=frame_medians,
+                n_threads=None if n_threads is None else get_n_threads(n_threads),
+            )
+        else:
+            if frame_medians is not None:
+                sub -= frame_medians[..., np.newaxis, np.newaxis]
+
+            if iterative:
+                dcmap = generate_noise_map_iter(
+                    sub, pixel_weights, layout, masked=masked, n_threads=n_threads
+                )
+            else:
+                dcmap = generate_noise_map(
+                    sub, pixel_weights, layout, masked=masked, n_threads=n_threads
+                )
+
+        # The noise map stays compact (one value per column and amplificator)
+        # and is only expanded to full size when saved
+        dcmap = np.where(np.isfinite(dcmap), dcmap, 0)
+
+        apply_noise_map(data_tile, dcmap, out=out[tile])
+
+        if "subcorr" in full_size:
+            apply_noise_map(sub_nomed, dcmap, out=full_size["subcorr"][tile])
+            if masked:
+                full_size["subcorr"][tile][~good] = np.nan
+        if "noisemap" in full_size:
+            full_size["noisemap"][tile] = expand_noise_map(dcmap, sub.shape)
+
+    if not save_intermediate:
+        return None
+
+    full_size["deepstack"] = stacked_ramp
+    full_size["deepstack_rms"] = rms
+    return {name: full_size[name] for name in products}
+
+
+def get_intermediate_products(
+    intermediate_products: Optional[Sequence[str]] = None,
+) -> tuple:
+    """
+    Check the names of the requested intermediate products. Default is all of them.
+    """
+    if intermediate_products is None:
+        return INTERMEDIATE_PRODUCTS
+    unknown = set(intermediate_products) - set(INTERMEDIATE_PRODUCTS)
+    if unknown:
+        raise ValueError(
+            f"Unknown intermediate products {sorted(unknown)}."
+            f" Should be in {INTERMEDIATE_PRODUCTS}"
+        )
+    return tuple(name for name in INTERMEDIATE_PRODUCTS if name in intermediate_products)
+
+
+def _make_output_dir(output_dir: Optional[Union[Path, str]]) -> Path:
+    """
+    Create the output directory if needed. Defaults to the current directory.
+    """
+    if output_dir is not None:
+        output_dir = Path(output_dir)
+        output_dir.mkdir(exist_ok=True, parents=True)
+    else:
+        output_dir = Path(".")
+    return output_dir
+
+
+def get_output_path(input_file: Union[Path, str], output_dir: Path) -> Path:
+    """
+    Path of the 1/f-corrected file, with the `oneoverf` suffix.
+
+    Parameters
+    ----------
+    input_file : Union[Path, str]
+        Path to the input file
+    output_dir : Path
+        Directory where result is saved
+
+    Returns
+    -------
+    Path
+        Path of the output file
+    """
+    input_path = Path(input_file)
+    file_id = input_path.stem
+    file_id, sep = remove_suffix(file_id)
+    output_path = file_id + sep + "oneoverf.fits"
+
+    return output_dir / output_path
+
+
+def get_intermediate_path(
+    exposure_file: Optional[Union[Path, str]], output_dir: Path
+) -> Path:
+    """
+    Path of the intermediate products of an exposure, with the `oneoverfint` suffix.
+
+    The suffix of the input is kept (e.g. `<exposure>_uncal_oneoverfint.fits` in stage
+    1 and `<exposure>_rateints_oneoverfint.fits` in stage 2), so that the products of
+    both stages of an exposure do not overwrite each other.
+    """
+    if exposure_file is None:
+        return output_dir / "oneoverfint.fits"
+    return output_dir / f"{Path(exposure_file).stem}_oneoverfint.fits"
+
+
+def _save_intermediates(
+    intermediates: dict,
+    output_dir: Path,
+    exposure_file: Optional[Union[Path, str]] = None,
+    intermediate_output_subdir: Optional[Union[Path, str]] = None,
+    compress: bool = False,
+    float32: bool = False,
+    asynchronous: bool = True,
+):
+    """
+    Save the intermediate products from `correct_oof_data` in one FITS file named after
+    the exposure, on a background thread if `asynchronous` is True.
+    """
+    if intermediate_output_subdir is not None:
+        output_subdir = output_dir / intermediate_output_subdir
+        output_subdir.mkdir(exist_ok=True, parents=True)
+    else:
+        output_subdir = output_dir
+    output_path = get_intermediate_path(exposure_file, output_subdir)
+    if asynchronous:
+        save_intermediate_async(
+            intermediates, output_path, compress=compress, float32=float32
+        )
+    else:
+        _save_intermediate_fits(
+            intermediates, output_path, compress=compress, float32=float32
+        )
+
+
+def copy_model_without_data(
+    model: Union[datamodels.RampModel, datamodels.ImageModel, datamodels.CubeModel],
+) -> Union[datamodels.RampModel, datamodels.ImageModel, datamodels.CubeModel]:
+    """
+    Copy of a data model with a new, uninitialized data array.
+
+    The metadata is copied, but all other arrays of the model (err, DQ, tables) are
+    shared with the input instead of being copied. The output should not modify them
+    in place if the input is still used.
+
+    Parameters
+    ----------
+    model : RampModel, ImageModel, CubeModel
+        Input data model
+
+    Returns
+    -------
+    RampModel, ImageModel, CubeModel
+        Model of the same type, with `data` to be filled by the caller
+    """
+    # Objects already in the deepcopy memo are used as their own copy
+    memo = {id(v): v for v in model.instance.values() if isinstance(v, np.ndarray)}
+    memo[id(model.data)] = np.empty_like(model.data)
+    return model.copy(memo=memo)
 
 
 def correct_oof(
@@ -237,13 +1106,30 @@ def correct_oof(
     save_intermediate: bool = False,
     intermediate_output_subdir: Optional[Union[Path, str]] = None,
     mean_per_frame: bool = False,
+    max_memory: Optional[float] = None,
+    stack_method: str = "median",
+    working_precision: str = "auto",
+    in_place: bool = False,
+    intermediate_products: Optional[Sequence[str]] = None,
+    intermediate_compress: bool = False,
+    intermediate_float32: bool = False,
+    intermediate_async: bool = True,
+    kernel: str = "auto",
+    deep_stack: Optional[Union[dict, Path, str]] = None,
+    dq_bits: Optional[Union[int, str]] = None,
+    noutputs: Optional[int] = None,
+    n_threads: Optional[int] = None,
+    strategy: Optional[str] = None,
+    backend: str = "numpy",
+    dask_scheduler: Optional[str] = None,
+    stack_window: Optional[int] = None,
 ) -> datamodels.RampModel:
     """
     Correct 1/f noise from JWST ramp data
 
     Correct 1/f noise by subtracting a stacked image over integration for each group
-    and then computing a mean value for each column. For the FULL subarray, each
-    amplificator is handled separately.
+    and then computing a mean value for each column. When the array is read by several
+    amplificators (e.g. FULL), each amplificator is handled separately.
 
     Parameters
     ----------
@@ -260,10 +1146,94 @@ def correct_oof(
         Default is to use numpy broadcasting.
         Kept only in case of memory issues for large observations
     save_intermediate : bool
-        Whether intermediate outputs should be saved (in separate files).
+        Whether intermediate outputs should be saved (in one `oneoverfint` file per
+        exposure, with one extension per product).
         Intermediate outputs include the noise map, the stacked ramp along integrations, etc.
     intermediate_output_subdir : Optional[Union[Path, str]]
         The directory where intermedaite outputs should be saved. Default is in output_dir.
+    mean_per_frame : bool
+        Whether the median of each frame should be subtracted before computing the
+        column values.
+    max_memory : Optional[float]
+        Memory budget (in GB) for the temporary arrays of the correction.
+        When set, the data is processed in tiles of full columns so that peak memory
+        scales with the tile size instead of the full exposure. Default is to process
+        the whole array at once. Note that saving intermediate products still requires
+        full-size arrays.
+    stack_method : str
+        Estimator used to stack the ramp along integrations: "median" (default),
+        "sigma_clip" (sigma-clipped mean) or "odd_ratio" (odd-ratio mean).
+        "online_mean" and "online_sigma_clip" read one integration at a time and
+        update running statistics (see `stacking.OnlineStack`). Combined with
+        `max_memory` and a memory-mapped input, the full ramp is never loaded.
+        "rolling_median" and "rolling_mean" stack each integration with its neighbors
+        in a window of `stack_window` integrations, which follows scenes that drift
+        during long time series. Their stack, RMS and weights have the size of the data.
+    working_precision : str
+        Floating point precision of the computation: "float32", "float64", or "auto"
+        (default) to follow numpy type promotion. Float32 halves the memory of the
+        temporary arrays (see `check_precision` for its accuracy).
+    in_place : bool
+        Whether the noise map should be subtracted directly in the data of the input
+        model, which is then returned, instead of a copy. Only use when the input
+        model is not needed afterwards (e.g. inside a pipeline). Otherwise, the output
+        model only allocates a new data array and shares all other arrays (err, DQ,
+        tables) with the input (see `copy_model_without_data`).
+    intermediate_products : Optional[Sequence[str]]
+        Intermediate products to save, among `INTERMEDIATE_PRODUCTS`. Default is all.
+        Full-size arrays are only allocated for the selected products.
+    intermediate_compress : bool
+        Whether intermediate products are tile-compressed (lossless)
+    intermediate_float32 : bool
+        Whether float64 intermediate products are downcast to float32
+    intermediate_async : bool
+        Whether intermediate products are written on a background thread, so that
+        the result is returned before they are written (see `wait_for_intermediates`)
+    kernel : str
+        Implementation of the weighted column means: "numba" (compiled kernel that
+        fuses the frame median subtraction, weighting and reduction in one parallel
+        pass), "numpy", or "auto" (default) to use numba when it is installed.
+        `iterative` only applies to the numpy kernel. Both kernels agree to float32
+        rounding: a few pixels can differ by one rounding step of the data, so
+        use "numpy" for results that do not depend on whether numba is installed.
+    deep_stack : Optional[Union[dict, Path, str]]
+        Deep stack shared by several exposures, used instead of the stack of this
+        exposure: a file saved by `deepstack.build_deep_stack` or the dict it returns.
+        The exposure must have the same subarray, readout and pointing.
+    dq_bits : Optional[Union[int, str]]
+        DQ flags of the pixels excluded from the noise map, as an integer or
+        comma-separated names (e.g. "DO_NOT_USE,SATURATED,JUMP_DET"). Flags are read
+        from the `groupdq` and `pixeldq` arrays of ramps and the `dq` array of cubes.
+        When set, flagged pixels, outliers and NaN pixels get a weight of 0 instead of
+        being replaced by NaN, which keeps the column means on faster reductions.
+        The weighted means are then normalized by the weights of the good pixels only.
+        Default is to ignore the DQ arrays.
+    noutputs : Optional[int]
+        Number of amplificators (outputs) that read the array, each with its own 1/f
+        noise. Default is the NOUTPUTS keyword of the model, or 4 for FULL and 1 for
+        subarrays when it is missing (see `amplifiers.get_amp_layout`).
+    n_threads : Optional[int]
+        Number of threads computing the noise map, each for a slice of integrations.
+        0 uses all cores. The result is identical for any number of threads. Default
+        is one thread with the numpy kernel and all cores with numba.
+    strategy : Optional[str]
+        Execution of the correction: "vectorized", "iterative", "tiled" (tiles of
+        columns that fit in `max_memory`), or "auto" to pick the fastest one whose
+        memory, estimated from the shape of the data, fits in `max_memory` (default
+        is most of the available memory). Default is to use `iterative` and
+        `max_memory` as given. See `strategies.choose_strategy`.
+    backend : str
+        "numpy" (default), or "dask" to stack and correct chunks of columns of each
+        amplificator in parallel with dask (see `dask_backend`). The result is
+        identical. Chunks have the columns of one tile when `max_memory` is set, so
+        that each one fits in the budget, and one chunk per core otherwise. Requires
+        dask and does not save intermediate products. `n_threads` is not used.
+    dask_scheduler : Optional[str]
+        Scheduler of the dask backend, e.g. "threads", "processes" or "synchronous".
+        Default is threads, or the active `dask.distributed` client if any.
+    stack_window : Optional[int]
+        Number of integrations in the centered window of the rolling stack methods,
+        including the corrected one. Default is `stacking.ROLLING_WINDOW`.
 
     Returns
     -------
@@ -280,78 +1250,112 @@ def correct_oof(
     else:
         input_model = input_file
 
-    # Get stacked ramp (keep group dimenion, but stack along integration)
-    stacked_ramp, rms = stack_ramp(input_model.data)
-    # TODO: Fix the fact that outliers with very high values have high weight
-    # Using outlier map or some sort of thresholding is probalby best.
-    pixel_weights = rms**-2
-    # Some outliers (probably max value) are fix so have 0 rms and inf weight
-    pixel_weights[~np.isfinite(pixel_weights)] = 0.0
-
-    # This automatically subtracts stacked ramp from each int
-    # TODO: Should we weight before subtracing?
-    # this could help mitigate subtraction of PSF as RMS higher in core
-    sub = input_model.data - stacked_ramp
-
-    # TODO: Without running separate outlier script, could flag some directly here using ramps and stack
-    if outlier_map is not None:
-        outliers = fits.getdata(outlier_map)
-
-        # outliers == 1 is an outlier. Convert those to NaN, otherwise set to 1
-        outliers = np.where(outliers == 0, 1, np.nan)
-
-        # One outlier map per integration. Broadcast to all groups for each
-        sub = sub * outliers[:, np.newaxis, ...]
-
-    subarray = input_model.meta.subarray.name
-    if iterative:
-        dcmap = generate_noise_map_iter(
-            sub, pixel_weights, subarray, mean_per_frame=mean_per_frame
-        )
-    else:
-        dcmap = generate_noise_map(
-            sub, pixel_weights, subarray, mean_per_frame=mean_per_frame
+    deep_stack = deepstack.get_deep_stack(deep_stack)
+    if deep_stack is not None:
+        deepstack.check_compatible(
+            deepstack.get_stack_keys(input_model),
+            deep_stack["keys"],
+            name=input_model.meta.filename or "exposure",
         )
 
-    subcorr = sub - dcmap
-
-    dcmap = np.where(np.isfinite(dcmap), dcmap, 0)
+    if in_place:
+        output_model = input_model
+    else:
+        output_model = copy_model_without_data(input_model)
 
-    output_model = input_model.copy()
-    output_model.data = input_model.data - dcmap
+    intermediates = correct_oof_data(
+        input_model.data,
+        output_model.data,
+        input_model.meta.subarray.name,
+        outlier_map=outlier_map,
+        iterative=iterative,
+        mean_per_frame=mean_per_frame,
+        max_memory=max_memory,
+        stack_method=stack_method,
+        working_precision=working_precision,
+        save_intermediate=save_intermediate,
+        intermediate_products=intermediate_products,
+        kernel=kernel,
+        deep_stack=deep_stack,
+        dq=get_dq_arrays(input_model) if dq_bits is not None else None,
+        dq_bits=dq_bits,
+        noutputs=noutputs or input_model.meta.exposure.noutputs,
+        n_threads=n_threads,
+        strategy=strategy,
+        backend=backend,
+        dask_scheduler=dask_scheduler,
+        stack_window=stack_window,
+    )
 
     if save_results or save_intermediate:
-        if output_dir is not None:
-            output_dir = Path(output_dir)
-            output_dir.mkdir(exist_ok=True, parents=True)
-        else:
-            output_dir = Path(".")
+        output_dir = _make_output_dir(output_dir)
 
     if save_intermediate:
-        if intermediate_output_subdir is not None:
-            output_subdir = output_dir / intermediate_output_subdir
-            output_subdir.mkdir(exist_ok=True, parents=True)
+        if isinstance(input_file, (str, Path)):
+            exposure_file = input_file
         else:
-            output_subdir = output_dir
-        _save_intermediate_fits(stacked_ramp, output_subdir / "deepstack.fits")
-        _save_intermediate_fits(rms, output_subdir / "deepstack_rms.fits")
-        _save_intermediate_fits(sub, output_subdir / "sub.fits")
-        _save_intermediate_fits(subcorr, output_subdir / "subcorr.fits")
-        _save_intermediate_fits(dcmap, output_subdir / "noisemap.fits")
+            exposure_file = input_model.meta.filename
+        _save_intermediates(
+            intermediates,
+            output_dir,
+            exposure_file=exposure_file,
+            intermediate_output_subdir=intermediate_output_subdir,
+            compress=intermediate_compress,
+            float32=intermediate_float32,
+            asynchronous=intermediate_async,
+        )
 
     if save_results:
-        input_path = Path(input_file)
-        file_id = input_path.stem
-        file_id, sep = remove_suffix(file_id)
-        output_path = file_id + sep + "oneoverf.fits"
-
-        output_path = output_dir / output_path
+        output_path = get_output_path(input_file, output_dir)
 
         output_model.write(output_path)
 
     return output_model
 
 
+def check_precision(
+    input_model: Union[datamodels.RampModel, datamodels.CubeModel], **kwargs
+) -> dict:
+    """
+    Compare the 1/f correction computed in float32 and float64 working precision.
+
+    The correction is run once in each precision on the same input, which is not
+    modified. Differences of the corrected data are reported in data units and relative
+    to the standard deviation of the float64 noise map, i.e. the size of the correction.
+
+    Parameters
+    ----------
+    input_model : RampModel, CubeModel
+        Input data model
+    **kwargs
+        Other arguments passed to `correct_oof` (e.g. `outlier_map`, `mean_per_frame`)
+
+    Returns
+    -------
+    dict
+        Dictionary with the maximum absolute difference (`max_abs_diff`), the RMS of the
+        difference (`rms_diff`), the standard deviation of the noise map
+        (`noise_map_std`) and the maximum difference relative to it (`max_rel_diff`)
+    """
+    for key in ("working_precision", "in_place", "save_results", "save_intermediate"):
+        kwargs.pop(key, None)
+
+    result64 = correct_oof(input_model, working_precision="float64", **kwargs)
+    result32 = correct_oof(input_model, working_precision="float32", **kwargs)
+
+    diff = result32.data.astype(np.float64) - result64.data
+    noise_map = input_model.data.astype(np.float64) - result64.data
+    max_abs_diff = float(np.nanmax(np.abs(diff)))
+    noise_map_std = float(np.nanstd(noise_map))
+
+    return dict(
+        max_abs_diff=max_abs_diff,
+        rms_diff=float(np.sqrt(np.nanmean(diff**2))),
+        noise_map_std=noise_map_std,
+        max_rel_diff=max_abs_diff / noise_map_std,
+    )
+
+
 if __name__ == "__main__":
     # Open the uncal time series that needs 1/f correction
     exposurename = (
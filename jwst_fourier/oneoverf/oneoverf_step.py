@@ -1,7 +1,9 @@
+from pathlib import Path
+
 from jwst import datamodels
 from jwst.stpipe import Step
 
-from . import one_over_f
+from . import file_backed, one_over_f
 
 __all__ = ["OneOverFStep"]
 
@@ -20,23 +22,36 @@ class OneOverFStep(Step):
         save_intermediate = boolean(default=False)
         intermediate_output_subdir = str(default=None)
         mean_per_frame = boolean(default=False)
+        max_memory = float(default=None)  # Memory budget (GB), process columns in tiles when set
+        stack_method = option("median", "sigma_clip", "odd_ratio", "online_mean", "online_sigma_clip", "rolling_median", "rolling_mean", default="median")  # Estimator to stack integrations
+        stack_window = integer(default=None)  # Integrations in the sliding window of the rolling stack methods (default 51)
+        working_precision = option("auto", "float32", "float64", default="auto")  # Precision of the computation
+        in_place = boolean(default=False)  # Subtract the noise map in the input data instead of a copy
+        intermediate_products = string_list(default=None)  # Intermediate products to save (default all)
+        intermediate_compress = boolean(default=False)  # Tile-compress intermediate products (lossless)
+        intermediate_float32 = boolean(default=False)  # Downcast float64 intermediate products to float32
+        intermediate_async = boolean(default=True)  # Write intermediate products on a background thread
+        kernel = option("auto", "numpy", "numba", default="auto")  # Implementation of the column means (auto uses numba if installed)
+        deep_stack = string(default=None)  # Deep stack file shared by compatible exposures, used instead of each exposure's stack
+        memmap = boolean(default=False)  # Correct file inputs through memory maps, writing the result to output_dir
+        dq_bits = string(default=None)  # DQ flags given zero weight in the noise map (e.g. "DO_NOT_USE,SATURATED,JUMP_DET"), default ignores DQ
+        noutputs = integer(default=None)  # Number of amplificators reading the array (default from NOUTPUTS, or 4 for FULL and 1 for subarrays)
+        n_threads = integer(default=None)  # Threads computing the noise map over integrations (0 uses all cores, default 1 with numpy and all cores with numba)
+        strategy = option("auto", "vectorized", "iterative", "tiled", default=None)  # Execution of the correction (auto picks the fastest that fits in max_memory), default from iterative and max_memory
+        backend = option("numpy", "dask", default="numpy")  # Run the correction with numpy, or in parallel chunks of columns with dask
+        dask_scheduler = string(default=None)  # Scheduler of the dask backend (e.g. "threads", "processes"), default threads or the active distributed client
     """
 
     def process(self, input):
+        if self.memmap and isinstance(input, (str, Path)):
+            return self._process_file(input)
+
         try:
             with datamodels.RampModel(input) as input_model:
 
                 # TODO: This raises warning about 0 when doing weight RMS calculation.
                 # TODO: If want intermediate to save normally, should use data models and pass then here
-                result = one_over_f.correct_oof(
-                    input_model,
-                    output_dir=self.output_dir,
-                    outlier_map=self.outlier_map,
-                    iterative=self.iterative,
-                    save_intermediate=self.save_intermediate,
-                    intermediate_output_subdir=self.intermediate_output_subdir,
-                    mean_per_frame=self.mean_per_frame,
-                )
+                result = one_over_f.correct_oof(input_model, **self._correct_oof_kwargs())
         except ValueError:
             with datamodels.open(input) as input_model:
 
@@ -47,20 +62,51 @@ class OneOverFStep(Step):
                         "Stage 2 input is not a CubeModel. Skipping 1/f (OOF) correction."
                     )
                     return input_model
-                result = one_over_f.correct_oof(
-                    input_model,
-                    output_dir=self.output_dir,
-                    outlier_map=self.outlier_map,
-                    iterative=self.iterative,
-                    save_intermediate=self.save_intermediate,
-                    intermediate_output_subdir=self.intermediate_output_subdir,
-                    mean_per_frame=self.mean_per_frame,
-                )
+                result = one_over_f.correct_oof(input_model, **self._correct_oof_kwargs())
+
+        result.meta.cal_step.oneoverf = "COMPLETE"
 
+        return result
+
+    def _process_file(self, input):
+        """Correct a file input with memory maps and open the corrected file"""
+        kwargs = self._correct_oof_kwargs()
+        kwargs.pop("in_place")
+        output_file = file_backed.correct_oof_file(input, **kwargs)
+
+        result = datamodels.open(str(output_file))
         result.meta.cal_step.oneoverf = "COMPLETE"
 
         return result
 
+    def _correct_oof_kwargs(self):
+        """Keyword arguments passed to `one_over_f.correct_oof` from the step options"""
+        return dict(
+            output_dir=self.output_dir,
+            outlier_map=self.outlier_map,
+            iterative=self.iterative,
+            save_intermediate=self.save_intermediate,
+            intermediate_output_subdir=self.intermediate_output_subdir,
+            mean_per_frame=self.mean_per_frame,
+            max_memory=self.max_memory,
+            stack_method=self.stack_method,
+            working_precision=self.working_precision,
+            in_place=self.in_place,
+            intermediate_products=self.intermediate_products,
+            intermediate_compress=self.intermediate_compress,
+            intermediate_float32=self.intermediate_float32,
+            intermediate_async=self.intermediate_async,
+            kernel=self.kernel,
+            deep_stack=self.deep_stack,
+            dq_bits=self.dq_bits,
+            noutputs=self.noutputs,
+            n_threads=self.n_threads,
+            strategy=self.strategy,
+            backend=self.backend,
+            dask_scheduler=self.dask_scheduler,
+            stack_window=self.stack_window,
+        )
+
 
 if __name__ == "__main__":
     # Open the uncal time series that needs 1/f correction
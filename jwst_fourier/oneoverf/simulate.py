@@ -0,0 +1,156 @@
+"""
+Synthetic NIRISS ramps with injected 1/f noise.
+
+Used to benchmark the 1/f correction and to check that its code paths agree. The
+simulated ramp contains a static scene (bias and a PSF) that accumulates flux with
+each group, white read noise, and 1/f noise that is constant along each column of an
+amplificator and correlated across columns with a 1/f power spectrum. Cosmic-ray-like
+outliers and NaN pixels can also be injected.
+"""
+from typing import Optional
+
+import numpy as np
+
+from .amplifiers import get_amp_layout
+
+__all__ = ["SUBARRAY_SHAPES", "simulate_oof_noise", "simulate_ramp"]
+
+# (nrow, ncol) of the subarrays used for Fourier imaging
+SUBARRAY_SHAPES = {
+    "SUB80": (80, 80),
+    "SUB400": (400, 400),
+    "SUBSTRIP256": (256, 2048),
+    "FULL": (2048, 2048),
+}
+
+
+def simulate_oof_noise(
+    shape: tuple,
+    namps: int = 1,
+    amplitude: float = 5.0,
+    rng: Optional[np.random.Generator] = None,
+) -> np.ndarray:
+    """
+    Simulate compact 1/f noise with one value per column and amplificator.
+
+    Parameters
+    ----------
+    shape : tuple
+        Leading dimensions of the noise (e.g. (nint, ngroup)) followed by ncol
+    namps : int
+        Number of amplificators, each with independent noise
+    amplitude : float
+        Standard deviation of the noise
+    rng : Optional[np.random.Generator]
+        Random number generator
+
+    Returns
+    -------
+    np.ndarray
+        Noise with shape (*shape[:-1], namps, 1, ncol), as returned by
+        `one_over_f.generate_noise_map`
+    """
+    rng = np.random.default_rng(rng)
+    *lead, ncol = shape
+    # White noise shaped by a 1/f power spectrum (amplitude 1/sqrt(f))
+    freqs = np.fft.rfftfreq(ncol)
+    scale = np.zeros_like(freqs)
+    scale[1:] = freqs[1:] ** -0.5
+    coeffs = rng.normal(size=(*lead, namps, freqs.size)) + 1j * rng.normal(
+        size=(*lead, namps, freqs.size)
+    )
+    noise = np.fft.irfft(coeffs * scale, n=ncol, axis=-1)
+    noise *= amplitude / noise.std()
+
+    return noise[..., np.newaxis, :]
+
+
+def simulate_ramp(
+    subarray: str = "SUB80",
+    nints: int = 10,
+    ngroups: int = 3,
+    oof_amplitude: float = 5.0,
+    read_noise: float = 10.0,
+    peak_flux: float = 5000.0,
+    nan_fraction: float = 0.0,
+    outlier_fraction: float = 0.0,
+    seed: Optional[int] = None,
+    dtype: np.dtype = np.float32,
+    noutputs: Optional[int] = None,
+) -> dict:
+    """
+    Simulate a ramp with 1/f noise for a NIRISS subarray.
+
+    Parameters
+    ----------
+    subarray : str
+        Subarray name, one of `SUBARRAY_SHAPES`. FULL has 4 amplificators.
+    nints : int
+        Number of integrations
+    ngroups : int
+        Number of groups. When 0, a cube (nints, nrow, ncol) is returned instead.
+    oof_amplitude : float
+        Standard deviation of the 1/f noise (ADU)
+    read_noise : float
+        Standard deviation of the white noise (ADU)
+    peak_flux : float
+        Peak flux of the PSF accumulated in each group (ADU)
+    nan_fraction : float
+        Fraction of pixels set to NaN in all integrations (e.g. bad pixels)
+    outlier_fraction : float
+        Fraction of pixels of each integration hit by an outlier, which stays in all
+        the following groups like a cosmic ray
+    seed : Optional[int]
+        Seed of the random number generator
+    dtype : np.dtype
+        Type of the ramp
+    noutputs : Optional[int]
+        Number of amplificators with independent 1/f noise (see
+        `amplifiers.get_amp_layout`)
+
+    Returns
+    -------
+    dict
+        "data": simulated ramp, "oof": injected compact 1/f noise (see
+        `simulate_oof_noise`), "outlier_map": map of outliers with shape
+        (nints, nrow, ncol), and "subarray"
+    """
+    rng = np.random.default_rng(seed)
+    nrow, ncol = SUBARRAY_SHAPES[subarray]
+    layout = get_amp_layout(subarray, nrow, noutputs=noutputs)
+    cube = ngroups == 0
+    ngroups = max(ngroups, 1)
+
+    y, x = np.mgrid[:nrow, :ncol]
+    sigma = min(nrow, ncol) / 20
+    psf = np.exp(-((x - ncol / 2) ** 2 + (y - nrow / 2) ** 2) / (2 * sigma**2))
+    scene = 1e4 + peak_flux * psf * np.arange(1, ngroups + 1)[:, np.newaxis, np.newaxis]
+
+    data = np.empty((nints, ngroups, nrow, ncol), dtype=dtype)
+    data[:] = scene
+    data += rng.normal(scale=read_noise, size=data.shape).astype(dtype)
+    data += rng.normal(scale=np.sqrt(scene)).astype(dtype)
+
+    oof = simulate_oof_noise(
+        (nints, ngroups, ncol), namps=layout.namps, amplitude=oof_amplitude, rng=rng
+    )
+    layout.split(data)[:] += oof.astype(dtype)
+
+    outlier_map = np.zeros((nints, nrow, ncol), dtype=np.uint8)
+    if outlier_fraction > 0:
+        hits = rng.random(outlier_map.shape) < outlier_fraction
+        first_group = rng.integers(0, ngroups, size=outlier_map.shape)
+        groups = np.arange(ngroups)[:, np.newaxis, np.newaxis]
+        for i in range(nints):
+            hit_groups = hits[i] & (groups >= first_group[i])
+            data[i][hit_groups] += rng.uniform(1e3, 3e4, size=hit_groups.sum())
+        outlier_map[hits] = 1
+
+    if nan_fraction > 0:
+        data[:, :, rng.random((nrow, ncol)) < nan_fraction] = np.nan
+
+    if cube:
+        data = data[:, 0]
+        oof = oof[:, 0]
+
+    return {"data": data, "oof": oof, "outlier_map": outlier_map, "subarray": subarray}
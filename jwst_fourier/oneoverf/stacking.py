@@ -0,0 +1,587 @@
+"""
+Estimators to stack a ramp along the integration axis.
+
+All estimators ignore NaNs and return both the stacked value and the RMS of each pixel.
+The ramp is processed in chunks of rows so that temporary arrays stay small, and both
+outputs are computed from the same chunk while it is in memory. Each chunk is copied
+with the integration axis last so that the reductions run on contiguous memory.
+
+The online estimators instead read one integration at a time and update running
+statistics (`OnlineStack`), so that the full ramp never needs to be in memory.
+
+The rolling estimators stack each integration with its neighbors only, in a sliding
+window, and return one stack per integration. They follow scenes that drift during long
+time series instead of subtracting a stack of the whole exposure from each integration.
+"""
+from functools import partial
+from typing import Optional
+
+import numpy as np
+
+from . import kernels
+
+ONLINE_STACK_METHODS = ("online_mean", "online_sigma_clip")
+ROLLING_STACK_METHODS = ("rolling_median", "rolling_mean")
+STACK_METHODS = (
+    "median",
+    "sigma_clip",
+    "odd_ratio",
+    *ONLINE_STACK_METHODS,
+    *ROLLING_STACK_METHODS,
+)
+
+# Default number of integrations in the window of the rolling estimators
+ROLLING_WINDOW = 51
+
+# Approximate size in bytes of the temporary arrays used to stack one chunk
+STACK_CHUNK_NBYTES = 2**27
+
+# Above this number of order statistics, a full sort is faster than partial selection
+MAX_PARTITION_KTH = 16
+
+# Quantiles of a normal distribution at +/- 1 sigma
+SIGMA_QUANTILES = (0.158655, 0.841345)
+
+# Ratio of the standard deviation to the median absolute deviation of a normal distribution
+MAD_TO_STD = 1.482602
+
+
+def nan_quantiles(data: np.ndarray, quantiles: tuple) -> list:
+    """
+    Compute quantiles along the last axis, ignoring NaNs.
+
+    Uses partial selection (`np.partition`) on the order statistics required by the
+    quantiles, with linear interpolation between them. NaNs are sorted at the end by
+    numpy, so the position of the quantiles only depends on the number of valid values
+    of each pixel.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Data with the axis to reduce last
+    quantiles : tuple
+        Quantiles to compute, between 0 and 1
+
+    Returns
+    -------
+    list
+        One array per quantile, with shape `data.shape[:-1]`. NaN where all values are NaN.
+    """
+    nvalid = data.shape[-1] - np.count_nonzero(np.isnan(data), axis=-1)
+    empty = nvalid == 0
+
+    positions = [q * np.maximum(nvalid - 1, 0) for q in quantiles]
+    lo_inds = [np.floor(p).astype(np.intp) for p in positions]
+    hi_inds = [np.ceil(p).astype(np.intp) for p in positions]
+
+    kth = np.unique(np.concatenate([ind[~empty] for ind in lo_inds + hi_inds]))
+    if kth.size == 0:
+        return [np.full(data.shape[:-1], np.nan) for _ in quantiles]
+    if kth.size > MAX_PARTITION_KTH:
+        part = np.sort(data, axis=-1)
+    else:
+        part = np.partition(data, kth, axis=-1)
+
+    results = []
+    for pos, lo_ind, hi_ind in zip(positions, lo_inds, hi_inds):
+        lo = np.take_along_axis(part, lo_ind[..., np.newaxis], axis=-1)[..., 0]
+        hi = np.take_along_axis(part, hi_ind[..., np.newaxis], axis=-1)[..., 0]
+        frac = pos - lo_ind
+        # Same as the mean of the two middle values for the median
+        value = (1 - frac) * lo + frac * hi
+        value[empty] = np.nan
+        results.append(value)
+
+    return results
+
+
+def _nan_mean_std(data: np.ndarray, valid: np.ndarray) -> tuple:
+    """
+    Mean and standard deviation along the last axis for values where `valid` is True
+    """
+    # Reductions with where= do not create masked copies of the data
+    if valid.all():
+        valid = True
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.mean(data, axis=-1, where=valid)
+        std = np.std(data, axis=-1, where=valid)
+    return mean, std
+
+
+def median_stack(data: np.ndarray) -> tuple:
+    """
+    Median and standard deviation along the last axis, ignoring NaNs.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Data with the integration axis last
+
+    Returns
+    -------
+    tuple
+        Median and standard deviation
+    """
+    (median,) = nan_quantiles(data, (0.5,))
+    _, std = _nan_mean_std(data, ~np.isnan(data))
+    return median, std
+
+
+def sigma_clip_stack(data: np.ndarray, sigma: float = 3.0, maxiters: int = 5) -> tuple:
+    """
+    Sigma-clipped mean and standard deviation along the last axis, ignoring NaNs.
+
+    Values further than `sigma` standard deviations from the median are rejected
+    iteratively. The mean and standard deviation of the remaining values are returned.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Data with the integration axis last
+    sigma : float
+        Number of standard deviations used as clipping threshold
+    maxiters : int
+        Maximum number of clipping iterations
+
+    Returns
+    -------
+    tuple
+        Clipped mean and standard deviation
+    """
+    finite = ~np.isnan(data)
+    (center,) = nan_quantiles(data, (0.5,))
+    valid = finite
+    mean, std = _nan_mean_std(data, valid)
+    for _ in range(maxiters):
+        with np.errstate(invalid="ignore"):
+            new_valid = finite & (
+                np.abs(data - center[..., np.newaxis]) <= sigma * std[..., np.newaxis]
+            )
+        if np.array_equal(new_valid, valid):
+            break
+        valid = new_valid
+        mean, std = _nan_mean_std(data, valid)
+
+    return mean, std
+
+
+def odd_ratio_stack(
+    data: np.ndarray,
+    odd_ratio: float = 1e-4,
+    maxiters: int = 10,
+    conv_cut: float = 1e-2,
+) -> tuple:
+    """
+    Odd-ratio mean and weighted standard deviation along the last axis, ignoring NaNs.
+
+    Each value is weighted by the probability that it belongs to a gaussian distribution
+    rather than being an outlier with prior probability `odd_ratio` (E. Artigau's
+    odd-ratio mean). The dispersion of each pixel is estimated from its 16th and 84th
+    percentiles.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Data with the integration axis last
+    odd_ratio : float
+        Prior probability of a value being an outlier
+    maxiters : int
+        Maximum number of iterations
+    conv_cut : float
+        Convergence threshold on the change of the mean, in units of its error
+
+    Returns
+    -------
+    tuple
+        Odd-ratio mean and weighted standard deviation
+    """
+    finite = ~np.isnan(data)
+    lo, guess, hi = nan_quantiles(data, (SIGMA_QUANTILES[0], 0.5, SIGMA_QUANTILES[1]))
+    err = (hi - lo) / 2
+    # Constant pixels have no dispersion: give equal weight to all values
+    err = np.where(err > 0, err, np.inf)[..., np.newaxis]
+    zeroed = np.where(finite, data, 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for _ in range(maxiters):
+            nsig = (data - guess[..., np.newaxis]) / err
+            gfit = np.exp(-0.5 * nsig**2)
+            weights = np.where(finite, gfit / (gfit + odd_ratio), 0)
+            wsum = weights.sum(axis=-1)
+
+            guess_prev = guess
+            guess = (weights * zeroed).sum(axis=-1) / wsum
+            bulk_error = err[..., 0] / np.sqrt(wsum)
+            delta = np.abs(guess - guess_prev) / bulk_error
+            if not np.any(delta >= conv_cut):
+                break
+
+        dev = np.where(finite, data - guess[..., np.newaxis], 0)
+        std = np.sqrt((weights * dev * dev).sum(axis=-1) / wsum)
+
+    return guess, std
+
+
+def get_window_halfwidth(window: Optional[int], nint: int) -> int:
+    """
+    Number of integrations on each side of the center of a rolling window.
+
+    Windows are centered, so an even `window` is extended by one integration. A window
+    larger than the exposure includes all integrations.
+    """
+    if window is None:
+        window = ROLLING_WINDOW
+    if window < 1:
+        raise ValueError(
+            f"Rolling window should have at least 1 integration, not {window}"
+        )
+    return min(window // 2, nint - 1)
+
+
+def _rolling_mean_std(data: np.ndarray, halfwidth: int) -> tuple:
+    """
+    Mean and standard deviation in a sliding window along the last axis, ignoring NaNs.
+
+    The sums of each window are the differences of cumulative sums, so each window is
+    computed in constant time. Values are shifted by the first valid value of each
+    pixel to keep the sums of squares accurate.
+    """
+    valid = ~np.isnan(data)
+    first_valid = np.argmax(valid, axis=-1)[..., np.newaxis]
+    shift = np.take_along_axis(data, first_valid, axis=-1)
+    shift[np.isnan(shift)] = 0
+    shifted = np.where(valid, data - shift, 0).astype(np.float64)
+
+    def window_sums(values):
+        csum = np.zeros(values.shape[:-1] + (values.shape[-1] + 1,))
+        np.cumsum(values, axis=-1, out=csum[..., 1:])
+        nint = values.shape[-1]
+        starts = np.maximum(np.arange(nint) - halfwidth, 0)
+        stops = np.minimum(np.arange(nint) + halfwidth + 1, nint)
+        return csum[..., stops] - csum[..., starts]
+
+    count = window_sums(valid)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = window_sums(shifted) / count
+        var = window_sums(shifted**2) / count - mean**2
+    std = np.sqrt(np.maximum(var, 0))
+    std[count == 0] = np.nan
+    return mean + shift, std
+
+
+def rolling_median_stack(data: np.ndarray, halfwidth: int) -> tuple:
+    """
+    Median and standard deviation in a sliding window along the last axis, without NaNs
+
+    The sorted values of the window of each pixel are updated when the window moves by
+    one integration: the value leaving the window is removed and the new one is inserted
+    at its rank. NaNs are sorted last as infinite values, so the median is the middle of
+    the valid values, like `median_stack`.
+
+    When numba is installed, a compiled kernel updates the window of each pixel in
+    place, in parallel over pixels, with the same result. It shifts at most `window`
+    values per integration without temporary arrays, and should be used for long time
+    series. The numpy fallback finds the ranks and reorders the sorted windows of all
+    pixels with array operations, which also costs O(window) per integration and pixel
+    (O(nint * window) per pixel), with several temporary arrays of the size of the
+    windows. It is therefore no faster asymptotically than selecting the median of each
+    window again, and is only meant for small windows or when numba is missing.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Data with the integration axis last
+    halfwidth : int
+        Number of integrations on each side of the center of the window (see
+        `get_window_halfwidth`)
+
+    Returns
+    -------
+    tuple
+        Median and standard deviation of the window of each integration, with the
+        shape of the data
+    """
+    nint = data.shape[-1]
+    values = data.reshape(-1, nint)
+    _, std = _rolling_mean_std(data, halfwidth)
+    if kernels.HAS_NUMBA:
+        from ._numba_kernels import rolling_median
+
+        return rolling_median(values, halfwidth).reshape(data.shape), std
+
+    npix = values.shape[0]
+    window = 2 * halfwidth + 1
+    pixels = np.arange(npix)
+    ranks = np.arange(window)
+
+    # Windows at the edges are completed with NaNs, which are ignored
+    sorted_window = np.full((npix, window), np.inf, dtype=data.dtype)
+    nvalid = np.zeros(npix, dtype=np.intp)
+    median = np.empty((npix, nint), dtype=np.float64)
+
+    def get_values(i):
+        if 0 <= i < nint:
+            return np.where(np.isnan(values[:, i]), np.inf, values[:, i])
+        return np.full(npix, np.inf, dtype=data.dtype)
+
+    for i in range(-halfwidth, nint):
+        new = get_values(i + halfwidth)
+        old = get_values(i - halfwidth - 1)
+
+        # Rank of the leaving value and of the new value once it has left
+        old_rank = np.minimum((sorted_window < old[:, None]).sum(axis=1), window - 1)
+        new_rank = (sorted_window < new[:, None]).sum(axis=1) - (old < new)
+        source = np.where(ranks < new_rank[:, None], ranks, ranks - 1)
+        source += source >= old_rank[:, None]
+        np.clip(source, 0, window - 1, out=source)
+        sorted_window = np.take_along_axis(sorted_window, source, axis=1)
+        sorted_window[pixels, new_rank] = new
+        nvalid += np.isfinite(new).astype(np.intp) - np.isfinite(old).astype(np.intp)
+
+        if i >= 0:
+            lo_rank = np.maximum(nvalid - 1, 0) // 2
+            lo = sorted_window[pixels, lo_rank].astype(np.float64)
+            hi = sorted_window[pixels, nvalid // 2].astype(np.float64)
+            # Same as the interpolation of `nan_quantiles`
+            median[:, i] = np.where(nvalid > 0, 0.5 * lo + 0.5 * hi, np.nan)
+
+    return median.reshape(data.shape), std
+
+
+def rolling_mean_stack(data: np.ndarray, halfwidth: int) -> tuple:
+    """
+    Mean and standard deviation in a sliding window along the last axis, ignoring NaNs
+    (see `rolling_median_stack`)
+    """
+    return _rolling_mean_std(data, halfwidth)
+
+
+class OnlineStack:
+    """
+    Stack integrations one at a time with running statistics, ignoring NaNs.
+
+    The standard deviation of each pixel is computed with Welford's algorithm, so it is
+    the same as the one returned by the other estimators. The stacked value is either:
+
+    - "online_mean": the running mean
+    - "online_sigma_clip": a sigma-clipped mean. The first `nseed` integrations are
+      kept in memory to compute the median and the median absolute deviation (MAD) of
+      each pixel. Later values further than `sigma` times the MAD-based standard
+      deviation from that median are rejected from the mean. With `nseed` or fewer
+      integrations, this is the median.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of one integration
+    method : str
+        "online_mean" or "online_sigma_clip"
+    sigma : float
+        Number of standard deviations used as clipping threshold
+    nseed : int
+        Number of integrations used to compute the clipping center and threshold.
+        With fewer seed integrations, the MAD is too noisy to clip reliably.
+    """
+
+    def __init__(
+        self,
+        shape: tuple,
+        method: str = "online_sigma_clip",
+        sigma: float = 4.0,
+        nseed: int = 15,
+    ):
+        if method not in ONLINE_STACK_METHODS:
+            raise ValueError(
+                f"Unknown online stack method '{method}'."
+                f" Should be one of {ONLINE_STACK_METHODS}"
+            )
+        self.method = method
+        self.sigma = sigma
+        self.nseed = nseed
+
+        # Running statistics of all valid values, accumulated in float64
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+        # Clipped mean, after the seed integrations
+        self.seed = [] if method == "online_sigma_clip" else None
+        self.center = self.threshold = None
+        self.clip_count = self.clip_mean = None
+
+    @staticmethod
+    def _update_mean(count, mean, values, valid, m2=None):
+        """Welford update of the count, mean and M2 where `valid` is True (in place)"""
+        count += valid
+        delta = np.where(valid, values - mean, 0)
+        mean += np.divide(delta, count, out=np.zeros_like(mean), where=valid)
+        if m2 is not None:
+            m2 += delta * np.where(valid, values - mean, 0)
+
+    def add(self, integration: np.ndarray):
+        """
+        Add one integration to the stack
+        """
+        values = np.asarray(integration, dtype=np.float64)
+        valid = ~np.isnan(values)
+        self._update_mean(self.count, self.mean, values, valid, m2=self.m2)
+
+        if self.method == "online_mean":
+            return
+        if self.center is None:
+            self.seed.append(np.array(integration))
+            if len(self.seed) == self.nseed:
+                self._init_clipping()
+            return
+
+        with np.errstate(invalid="ignore"):
+            keep = valid & (np.abs(values - self.center) <= self.threshold)
+        self._update_mean(self.clip_count, self.clip_mean, values, keep)
+
+    def _init_clipping(self):
+        """Compute the clipping center and threshold from the seed integrations"""
+        seed = np.stack(self.seed).astype(np.float64)
+        self.seed = None
+        with np.errstate(invalid="ignore"):
+            (self.center,) = nan_quantiles(np.moveaxis(seed, 0, -1), (0.5,))
+            (mad,) = nan_quantiles(
+                np.moveaxis(np.abs(seed - self.center), 0, -1), (0.5,)
+            )
+        self.threshold = self.sigma * MAD_TO_STD * mad
+        # Constant pixels have no dispersion: keep all values
+        self.threshold[self.threshold == 0] = np.inf
+
+        self.clip_count = np.zeros(self.center.shape, dtype=np.int64)
+        self.clip_mean = np.zeros(self.center.shape)
+        for values in seed:
+            with np.errstate(invalid="ignore"):
+                keep = ~np.isnan(values) & (
+                    np.abs(values - self.center) <= self.threshold
+                )
+            self._update_mean(self.clip_count, self.clip_mean, values, keep)
+
+    def result(self, dtype: np.dtype = np.float64) -> tuple:
+        """
+        Stacked value and standard deviation of each pixel. NaN where no valid values.
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            std = np.sqrt(self.m2 / self.count)
+        empty = self.count == 0
+        std[empty] = np.nan
+
+        if self.method == "online_mean":
+            stacked = np.where(empty, np.nan, self.mean)
+        elif self.center is None:
+            # Fewer integrations than nseed: median of all of them
+            (stacked,) = nan_quantiles(np.moveaxis(np.stack(self.seed), 0, -1), (0.5,))
+        else:
+            stacked = np.where(self.clip_count > 0, self.clip_mean, self.center)
+
+        return stacked.astype(dtype), std.astype(dtype)
+
+
+def stack_online(
+    ramp: np.ndarray, method: str = "online_sigma_clip", dtype: Optional[np.dtype] = None
+) -> tuple:
+    """
+    Stack a ramp along the integration axis, reading one integration at a time.
+
+    Parameters
+    ----------
+    ramp : np.ndarray
+        Ramp with shape (nints, ngroups, npix1, npix2) or (nints, npix1, npix2). Only
+        accessed with `ramp[i]`, so it can be an array read from a file on access.
+    method : str
+        "online_mean" or "online_sigma_clip" (see `OnlineStack`)
+    dtype : Optional[np.dtype]
+        Floating point type of the results (see `stack_integrations`)
+
+    Returns
+    -------
+    tuple
+        Stacked ramp and RMS, both with shape `ramp.shape[1:]`
+    """
+    if dtype is None:
+        dtype = ramp.dtype if np.issubdtype(ramp.dtype, np.floating) else np.float64
+    stack = OnlineStack(ramp.shape[1:], method=method)
+    for i in range(ramp.shape[0]):
+        stack.add(ramp[i])
+    return stack.result(dtype=dtype)
+
+
+_STACK_FUNCTIONS = {
+    "median": median_stack,
+    "sigma_clip": sigma_clip_stack,
+    "odd_ratio": odd_ratio_stack,
+    "rolling_median": rolling_median_stack,
+    "rolling_mean": rolling_mean_stack,
+}
+
+
+def stack_integrations(
+    ramp: np.ndarray,
+    method: str = "median",
+    dtype: Optional[np.dtype] = None,
+    window: Optional[int] = None,
+) -> tuple:
+    """
+    Stack a ramp along the integration axis (axis=0) in chunks of rows.
+
+    Parameters
+    ----------
+    ramp : np.ndarray
+        Ramp with shape (nints, ngroups, npix1, npix2) or (nints, npix1, npix2)
+    method : str
+        Estimator used to stack. One of "median", "sigma_clip", "odd_ratio", an
+        online method (see `stack_online`), or a rolling method ("rolling_median" or
+        "rolling_mean") that stacks each integration with its neighbors.
+    dtype : Optional[np.dtype]
+        Floating point type of the computation and results.
+        Default is the type of the ramp if floating, float64 otherwise.
+    window : Optional[int]
+        Number of integrations in the centered window of the rolling methods.
+        Default is `ROLLING_WINDOW`.
+
+    Returns
+    -------
+    tuple
+        Stacked ramp and RMS, both with shape `ramp.shape[1:]`, or `ramp.shape` for
+        the rolling methods (one stack per integration)
+    """
+    if method in ONLINE_STACK_METHODS:
+        return stack_online(ramp, method=method, dtype=dtype)
+
+    try:
+        stack_func = _STACK_FUNCTIONS[method]
+    except KeyError:
+        raise ValueError(
+            f"Unknown stack method '{method}'. Should be one of {STACK_METHODS}"
+        )
+
+    if dtype is None:
+        dtype = ramp.dtype if np.issubdtype(ramp.dtype, np.floating) else np.float64
+    rolling = method in ROLLING_STACK_METHODS
+    if rolling:
+        halfwidth = get_window_halfwidth(window, ramp.shape[0])
+        stack_func = partial(stack_func, halfwidth=halfwidth)
+        out_shape = ramp.shape
+    else:
+        out_shape = ramp.shape[1:]
+    stacked = np.empty(out_shape, dtype=dtype)
+    rms = np.empty(out_shape, dtype=dtype)
+
+    # Temporaries are float64 and a few of them exist at the same time
+    nrow = ramp.shape[-2]
+    row_nbytes = ramp[..., 0, :].size * np.dtype(np.float64).itemsize * 4
+    chunk_nrows = int(max(1, min(nrow, STACK_CHUNK_NBYTES // row_nbytes)))
+    for start in range(0, nrow, chunk_nrows):
+        chunk_ind = np.s_[..., start : start + chunk_nrows, :]
+        # Contiguous copy with the integration axis last
+        chunk = np.moveaxis(ramp[chunk_ind], 0, -1).astype(dtype, order="C")
+        chunk_stacked, chunk_rms = stack_func(chunk)
+        if rolling:
+            chunk_stacked = np.moveaxis(chunk_stacked, -1, 0)
+            chunk_rms = np.moveaxis(chunk_rms, -1, 0)
+        stacked[chunk_ind], rms[chunk_ind] = chunk_stacked, chunk_rms
+
+    return stacked, rms
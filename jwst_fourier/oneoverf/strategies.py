@@ -0,0 +1,274 @@
+"""
+Execution strategy of the 1/f correction and its memory.
+
+The correction can run on the whole array at once ("vectorized"), loop over
+integrations to build the noise map ("iterative"), or process tiles of columns that fit
+in a memory budget ("tiled"). Their memory only depends on the shape and type of the
+data, so it is estimated from FITS headers (see `jwst_fourier.planner`) and the "auto"
+strategy picks the fastest one that fits in the budget.
+"""
+import importlib.util
+import logging
+import os
+from typing import Optional
+
+import numpy as np
+
+from . import kernels, stacking
+
+__all__ = [
+    "BACKENDS",
+    "HAS_DASK",
+    "STRATEGIES",
+    "WORKING_PRECISIONS",
+    "choose_strategy",
+    "estimate_oof_memory",
+    "get_available_memory",
+    "get_backend",
+    "get_working_dtype",
+    "resolve_strategy",
+]
+
+log = logging.getLogger(__name__)
+
+STRATEGIES = ("auto", "vectorized", "iterative", "tiled")
+
+WORKING_PRECISIONS = ("auto", "float32", "float64")
+
+BACKENDS = ("numpy", "dask")
+
+HAS_DASK = importlib.util.find_spec("dask") is not None
+
+# Peak size of the temporary arrays of the correction, in units of the data in working
+# precision (measured with tracemalloc on simulated SUB80 and SUBSTRIP256 ramps).
+# The numba kernel does not create full-size weighted data, like the iterative loop.
+STRATEGY_ARRAY_COPIES = {"vectorized": 4.0, "iterative": 3.0}
+
+# Additional temporary arrays of the robust stacking methods, in the same units
+STACK_ARRAY_COPIES = {"sigma_clip": 2.0, "odd_ratio": 2.0}
+
+# Fraction of the available memory used as budget when none is configured
+AVAILABLE_MEMORY_FRACTION = 0.8
+
+
+def get_working_dtype(working_precision: str) -> Optional[np.dtype]:
+    """
+    Get the floating point type used in the 1/f computation.
+
+    Parameters
+    ----------
+    working_precision : str
+        "float32", "float64" or "auto"
+
+    Returns
+    -------
+    Optional[np.dtype]
+        Type of the computation, or None to follow numpy type promotion ("auto")
+    """
+    if working_precision == "auto":
+        return None
+    if working_precision not in WORKING_PRECISIONS:
+        raise ValueError(
+            f"Unknown working precision '{working_precision}'."
+            f" Should be one of {WORKING_PRECISIONS}"
+        )
+    return np.dtype(working_precision)
+
+
+def get_backend(backend: str) -> str:
+    """
+    Check the backend that runs the correction.
+
+    Parameters
+    ----------
+    backend : str
+        "numpy", or "dask" to run chunks of columns in parallel with dask
+        (see `dask_backend`)
+
+    Returns
+    -------
+    str
+        The backend
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}'. Should be one of {BACKENDS}")
+    if backend == "dask" and not HAS_DASK:
+        raise ImportError("dask is required for the dask backend")
+    return backend
+
+
+def get_working_itemsize(dtype: np.dtype, working_dtype: Optional[np.dtype]) -> int:
+    """
+    Size of one element of the temporary arrays of the correction, for data of type
+    `dtype` (integer data is promoted to float32 like in the correction)
+    """
+    if working_dtype is not None:
+        return np.dtype(working_dtype).itemsize
+    return np.result_type(dtype, np.float32).itemsize
+
+
+def estimate_oof_memory(
+    shape: tuple,
+    dtype: np.dtype,
+    strategy: str,
+    max_memory: Optional[float] = None,
+    working_dtype: Optional[np.dtype] = None,
+    stack_method: str = "median",
+    kernel: str = "numpy",
+) -> float:
+    """
+    Estimate the peak memory of the temporary arrays of the 1/f correction.
+
+    The input and output data are not included.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the data (nint, ngroup, nrow, ncol) or (nint, nrow, ncol)
+    dtype : np.dtype
+        Type of the data
+    strategy : str
+        "vectorized", "iterative" or "tiled"
+    max_memory : Optional[float]
+        Memory budget in GB of the tiled strategy
+    working_dtype : Optional[np.dtype]
+        Floating point type of the computation (see `get_working_dtype`)
+    stack_method : str
+        Estimator used to stack the integrations
+    kernel : str
+        Resolved kernel of the column means ("numpy" or "numba")
+
+    Returns
+    -------
+    float
+        Estimated memory in GB
+    """
+    nbytes = int(np.prod(shape)) * get_working_itemsize(dtype, working_dtype)
+    if stack_method in stacking.ROLLING_STACK_METHODS:
+        # One stack and rms per integration, so the weights also have the data shape
+        stack_nbytes = 3 * nbytes
+    else:
+        # The stack and its rms have the shape of one integration
+        stack_nbytes = 2 * nbytes / shape[0]
+    if strategy == "tiled":
+        if max_memory is None:
+            raise ValueError("The tiled strategy requires a memory budget")
+        vectorized = estimate_oof_memory(
+            shape, dtype, "vectorized", None, working_dtype, stack_method, kernel
+        )
+        return min(max_memory + stack_nbytes / 1024**3, vectorized)
+    if strategy not in STRATEGY_ARRAY_COPIES:
+        raise ValueError(
+            f"Unknown strategy '{strategy}'. Should be one of {STRATEGIES}"
+        )
+    if kernel == "numba":
+        strategy = "iterative"
+    copies = STRATEGY_ARRAY_COPIES[strategy] + STACK_ARRAY_COPIES.get(stack_method, 0.0)
+    return (copies * nbytes + stack_nbytes) / 1024**3
+
+
+def get_available_memory() -> Optional[float]:
+    """
+    Physical memory available on the machine in GB, or None if it is not known
+    """
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024**3
+    except (AttributeError, ValueError, OSError):
+        # sysconf is not available on Windows, nor these names on all systems
+        return None
+
+
+def choose_strategy(
+    shape: tuple,
+    dtype: np.dtype,
+    max_memory: Optional[float] = None,
+    working_dtype: Optional[np.dtype] = None,
+    stack_method: str = "median",
+    kernel: str = "numpy",
+) -> str:
+    """
+    Fastest strategy whose temporary arrays fit in the memory budget.
+
+    The vectorized correction is preferred, then the iterative one (numpy kernel only),
+    and the data is split in tiles when neither fits.
+
+    Parameters
+    ----------
+    max_memory : Optional[float]
+        Memory budget in GB. Default is `AVAILABLE_MEMORY_FRACTION` of the available
+        memory, or no limit if it is not known.
+
+    See `estimate_oof_memory` for the other parameters.
+
+    Returns
+    -------
+    str
+        "vectorized", "iterative" or "tiled"
+    """
+    if max_memory is None:
+        available = get_available_memory()
+        if available is None:
+            return "vectorized"
+        max_memory = AVAILABLE_MEMORY_FRACTION * available
+
+    strategies = ["vectorized"] if kernel == "numba" else ["vectorized", "iterative"]
+    for strategy in strategies:
+        memory = estimate_oof_memory(
+            shape, dtype, strategy, None, working_dtype, stack_method, kernel
+        )
+        if memory <= max_memory:
+            return strategy
+    return "tiled"
+
+
+def resolve_strategy(
+    strategy: Optional[str],
+    shape: tuple,
+    dtype: np.dtype,
+    iterative: bool = False,
+    max_memory: Optional[float] = None,
+    working_dtype: Optional[np.dtype] = None,
+    stack_method: str = "median",
+    kernel: str = "auto",
+) -> tuple:
+    """
+    Options of `one_over_f.correct_oof_data` that run a strategy.
+
+    Parameters
+    ----------
+    strategy : Optional[str]
+        One of `STRATEGIES`, or None to use `iterative` and `max_memory` as given
+    shape, dtype, working_dtype, stack_method, kernel
+        Data and options of the correction (see `estimate_oof_memory`)
+    iterative : bool
+        Whether the noise map is computed by looping over integrations
+    max_memory : Optional[float]
+        Memory budget in GB. "auto" picks the strategy that fits in it (see
+        `choose_strategy`) and "tiled" sizes the tiles with it.
+
+    Returns
+    -------
+    tuple
+        `iterative` and `max_memory` options of the correction
+    """
+    if strategy is None:
+        return iterative, max_memory
+    if strategy not in STRATEGIES:
+        raise ValueError(
+            f"Unknown strategy '{strategy}'. Should be one of {STRATEGIES}"
+        )
+    # Only the name of the kernel is needed to estimate the memory
+    kernel = kernels.get_kernel(kernel, check_installed=False)
+    if strategy == "auto":
+        strategy = choose_strategy(
+            shape, dtype, max_memory, working_dtype, stack_method, kernel
+        )
+        log.info(f"Using the {strategy} strategy for the 1/f correction")
+    if strategy == "tiled":
+        if max_memory is None:
+            available = get_available_memory()
+            if available is None:
+                raise ValueError("The tiled strategy requires max_memory")
+            max_memory = AVAILABLE_MEMORY_FRACTION * available
+        return False, max_memory
+    return strategy == "iterative", None
@@ -0,0 +1,386 @@
+"""
+Parameter sweeps of the 1/f correction that share the stack of the input.
+
+Tuning the correction runs it many times on the same exposure with different options
+(frame medians, outlier maps, DQ flags, amplificators). The stack of the ramp, its RMS,
+the pixel weights and the stack-subtracted data do not depend on these options, and
+stacking is by far the most expensive part of the correction. A sweep computes them
+once per input and evaluates each configuration with only the masking and column
+reduction it needs.
+
+Shared products are full-size arrays, so the correction of a sweep is never tiled.
+They are kept in memory for the last `SWEEP_CACHE_SIZE` inputs, so that successive
+sweeps on the same exposure do not stack it again.
+"""
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Sequence, Union
+
+import numpy as np
+from astropy.io import fits
+from jwst import datamodels
+
+from . import amplifiers, deepstack, kernels
+from .one_over_f import (
+    _frame_medians,
+    _good_pixel_mask,
+    _outlier_nan_map,
+    apply_noise_map,
+    copy_model_without_data,
+    expand_noise_map,
+    generate_noise_map,
+    generate_noise_map_iter,
+    get_dq_arrays,
+    get_dq_bitmask,
+    get_n_threads,
+    stack_ramp,
+)
+from .strategies import get_working_dtype
+
+__all__ = [
+    "SWEEP_OPTIONS",
+    "SWEEP_OUTPUTS",
+    "clear_sweep_cache",
+    "compute_shared_products",
+    "correct_oof_sweep",
+    "sweep_noise_map",
+]
+
+log = logging.getLogger(__name__)
+
+# Options of `correct_oof` that can change between the configurations of a sweep
+SWEEP_OPTIONS = (
+    "mean_per_frame",
+    "outlier_map",
+    "dq_bits",
+    "noutputs",
+    "kernel",
+    "iterative",
+    "n_threads",
+)
+
+SWEEP_OUTPUTS = ("models", "metrics")
+
+# Number of inputs whose shared products are kept in memory
+SWEEP_CACHE_SIZE = 2
+
+# Shared products of the last inputs, by input, stack method, precision and deep stack
+_shared_products = OrderedDict()
+
+
+def compute_shared_products(
+    data: np.ndarray,
+    stack_method: str = "median",
+    working_precision: str = "auto",
+    deep_stack: Optional[dict] = None,
+    stack_window: Optional[int] = None,
+) -> dict:
+    """
+    Products of the correction that do not depend on the options of a sweep.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Input ramp (nint, ngroup, nrow, ncol) or cube (nint, nrow, ncol)
+    stack_method : str
+        Estimator used to stack the data (see `one_over_f.stack_ramp`)
+    working_precision : str
+        Floating point precision of the computation (see `one_over_f.correct_oof`)
+    deep_stack : Optional[dict]
+        Deep stack used instead of stacking the data (see `deepstack.get_deep_stack`)
+    stack_window : Optional[int]
+        Window of the rolling stack methods (see `one_over_f.stack_ramp`)
+
+    Returns
+    -------
+    dict
+        "stack" and "rms" of the data, "weights" of each pixel (inverse variance, 0
+        when not finite), "sub" (data with the stack subtracted) and the working
+        "dtype"
+    """
+    dtype = get_working_dtype(working_precision)
+    if deep_stack is not None:
+        if deep_stack["stack"].shape != data.shape[1:]:
+            raise ValueError(
+                f"Deep stack with shape {deep_stack['stack'].shape} does not match"
+                f" data with shape {data.shape}"
+            )
+        stacked_ramp = deep_stack["stack"].astype(dtype or data.dtype, copy=False)
+        rms = deep_stack["rms"].astype(dtype or data.dtype, copy=False)
+    else:
+        stacked_ramp, rms = stack_ramp(
+            data, method=stack_method, dtype=dtype, window=stack_window
+        )
+
+    pixel_weights = rms**-2
+    pixel_weights[~np.isfinite(pixel_weights)] = 0.0
+
+    return {
+        "stack": stacked_ramp,
+        "rms": rms,
+        "weights": pixel_weights,
+        "sub": np.subtract(data, stacked_ramp, dtype=dtype),
+        "dtype": dtype,
+    }
+
+
+def _input_key(input_file) -> tuple:
+    """
+    Key of a sweep input: the model itself (kept alive by the cache), or the path and
+    modification time of a file
+    """
+    if isinstance(input_file, datamodels.DataModel):
+        return ("model", id(input_file))
+    path = Path(input_file).resolve()
+    return ("file", str(path), path.stat().st_mtime_ns)
+
+
+def _get_shared_products(
+    input_file,
+    stack_method: str,
+    working_precision: str,
+    deep_stack: Optional[dict],
+    stack_window: Optional[int],
+) -> dict:
+    """
+    Input model and its shared products, computed on the first sweep of the input
+    """
+    key = (
+        _input_key(input_file),
+        stack_method,
+        stack_window,
+        working_precision,
+        None if deep_stack is None else id(deep_stack),
+    )
+    if key in _shared_products:
+        _shared_products.move_to_end(key)
+        return _shared_products[key]
+
+    if isinstance(input_file, datamodels.DataModel):
+        input_model = input_file
+    else:
+        try:
+            input_model = datamodels.RampModel(input_file)
+        except ValueError:
+            input_model = datamodels.open(input_file)
+
+    log.info("Computing the products shared by the sweep")
+    entry = compute_shared_products(
+        input_model.data,
+        stack_method=stack_method,
+        working_precision=working_precision,
+        deep_stack=deep_stack,
+        stack_window=stack_window,
+    )
+    # The model and deep stack are kept so that the ids of the key are not reused
+    entry["model"] = input_model
+    entry["deep_stack"] = deep_stack
+
+    _shared_products[key] = entry
+    while len(_shared_products) > SWEEP_CACHE_SIZE:
+        _shared_products.popitem(last=False)
+    return entry
+
+
+def clear_sweep_cache():
+    """
+    Release the shared products kept in memory by previous sweeps
+    """
+    _shared_products.clear()
+
+
+def sweep_noise_map(
+    shared: dict,
+    subarray: str,
+    mean_per_frame: bool = False,
+    outlier_map: Optional[Union[np.ndarray, Path, str]] = None,
+    dq: Optional[Sequence] = None,
+    dq_bits: Optional[Union[int, str]] = None,
+    noutputs: Optional[int] = None,
+    kernel: str = "auto",
+    iterative: bool = False,
+    n_threads: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Noise map of one configuration from the shared products of its input.
+
+    The shared products are not modified. The result is the same as the noise map
+    computed by `one_over_f.correct_oof_data` with the same options.
+
+    Parameters
+    ----------
+    shared : dict
+        Products from `compute_shared_products`
+    subarray : str
+        Subarray used to acquire the data
+    outlier_map : Optional[Union[np.ndarray, Path, str]]
+        Outlier map (nint, ny, nx), or a file containing it
+    dq : Optional[Sequence]
+        DQ arrays of the data (see `one_over_f.get_dq_arrays`), used with `dq_bits`
+    mean_per_frame, dq_bits, noutputs, kernel, iterative, n_threads
+        Options of the correction (see `one_over_f.correct_oof`)
+
+    Returns
+    -------
+    np.ndarray
+        Compact noise map with shape (nint, ngroup, namps, 1, ncol)
+    """
+    sub = shared["sub"]
+    pixel_weights = shared["weights"]
+    dtype = shared["dtype"]
+    kernel = kernels.get_kernel(kernel)
+    layout = amplifiers.get_amp_layout(subarray, sub.shape[-2], noutputs=noutputs)
+    dq_bitmask = get_dq_bitmask(dq_bits)
+    masked = dq_bitmask is not None
+    if not masked or dq is None:
+        dq = []
+
+    if isinstance(outlier_map, (str, Path)):
+        outliers = fits.getdata(outlier_map)
+    else:
+        outliers = outlier_map
+
+    if mean_per_frame:
+        frame_medians = _frame_medians(
+            sub, None, outliers, dtype=dtype, dq=dq, dq_bitmask=dq_bitmask
+        )
+    else:
+        frame_medians = None
+
+    # Masking creates a new array, so only unmasked sub can still be the shared one
+    if masked:
+        good = _good_pixel_mask(sub.shape, np.s_[...], dq, dq_bitmask, outliers)
+        good &= np.isfinite(sub)
+        pixel_weights = pixel_weights * good
+        sub = np.where(good, sub, 0).astype(sub.dtype, copy=False)
+    elif outliers is not None:
+        sub = np.multiply(sub, _outlier_nan_map(outliers, sub.ndim), dtype=dtype)
+
+    if kernel == "numba":
+        dcmap = kernels.column_means(
+            layout.split(sub),
+            layout.split(pixel_weights),
+            offsets=frame_medians,
+            n_threads=None if n_threads is None else get_n_threads(n_threads),
+        )
+    else:
+        if frame_medians is not None:
+            if sub is shared["sub"]:
+                sub = sub.copy()
+            sub -= frame_medians[..., np.newaxis, np.newaxis]
+
+        if iterative:
+            dcmap = generate_noise_map_iter(
+                sub, pixel_weights, layout, masked=masked, n_threads=n_threads
+            )
+        else:
+            dcmap = generate_noise_map(
+                sub, pixel_weights, layout, masked=masked, n_threads=n_threads
+            )
+
+    return np.where(np.isfinite(dcmap), dcmap, 0)
+
+
+def _sweep_metrics(shared: dict, dcmap: np.ndarray, buffer: np.ndarray) -> dict:
+    """
+    Summary metrics of the correction of one configuration (see `correct_oof_sweep`)
+    """
+    residual = np.subtract(
+        shared["sub"], expand_noise_map(dcmap, shared["sub"].shape), out=buffer
+    )
+    np.square(residual, out=residual)
+    residual *= shared["weights"]
+    return dict(
+        noise_map_std=float(np.std(dcmap)),
+        residual_chi2=float(np.nanmean(residual)),
+    )
+
+
+def correct_oof_sweep(
+    input_file: Union[
+        str, datamodels.RampModel, datamodels.ImageModel, datamodels.CubeModel
+    ],
+    configs: Sequence[dict],
+    output: str = "models",
+    stack_method: str = "median",
+    working_precision: str = "auto",
+    deep_stack: Optional[Union[dict, Path, str]] = None,
+    stack_window: Optional[int] = None,
+) -> list:
+    """
+    Correct 1/f noise of one input with several configurations.
+
+    The stack, RMS, pixel weights and stack-subtracted data are computed once for the
+    input (and reused by later sweeps of the same input, see `SWEEP_CACHE_SIZE`), then
+    each configuration only masks the data and reduces its columns. The shared products
+    are computed in the working dtype of `one_over_f.correct_oof`, so each corrected
+    model equals its result with the same options (including `working_precision`)
+    within float32 rounding. A sweep and a correction run in different precisions
+    differ by about this rounding.
+
+    Parameters
+    ----------
+    input_file : str, RampModel, ImageModel, CubeModel
+        Path to the input file or input data model, which is not modified
+    configs : Sequence[dict]
+        Options of each configuration, among `SWEEP_OPTIONS`. `outlier_map` can also be
+        an array. Options that are not given use the defaults of `correct_oof`.
+    output : str
+        "models" to return the corrected models, or "metrics" to only return summary
+        metrics of each configuration, without allocating a model for each
+    stack_method, working_precision, deep_stack, stack_window
+        Options shared by all configurations (see `one_over_f.correct_oof`)
+
+    Returns
+    -------
+    list
+        For each configuration, in order, the corrected model or a dict with the
+        standard deviation of the noise map (`noise_map_std`, the size of the
+        correction) and the mean of the squared residuals from the stack weighted by
+        the pixel weights (`residual_chi2`, lower when more 1/f noise is removed)
+    """
+    if output not in SWEEP_OUTPUTS:
+        raise ValueError(f"Unknown output '{output}'. Should be one of {SWEEP_OUTPUTS}")
+    for config in configs:
+        unknown = set(config) - set(SWEEP_OPTIONS)
+        if unknown:
+            raise ValueError(
+                f"Options {sorted(unknown)} cannot change in a sweep."
+                f" Should be in {SWEEP_OPTIONS}"
+            )
+
+    deep_stack = deepstack.get_deep_stack(deep_stack)
+    shared = _get_shared_products(
+        input_file, stack_method, working_precision, deep_stack, stack_window
+    )
+    input_model = shared["model"]
+    if deep_stack is not None:
+        deepstack.check_compatible(
+            deepstack.get_stack_keys(input_model),
+            deep_stack["keys"],
+            name=input_model.meta.filename or "exposure",
+        )
+
+    buffer = None
+    results = []
+    for i, config in enumerate(configs):
+        log.info(f"Sweep configuration {i + 1}/{len(configs)}: {config}")
+        config = dict(config)
+        config["noutputs"] = (
+            config.get("noutputs") or input_model.meta.exposure.noutputs
+        )
+        if config.get("dq_bits") is not None:
+            config["dq"] = get_dq_arrays(input_model)
+        dcmap = sweep_noise_map(shared, input_model.meta.subarray.name, **config)
+
+        if output == "metrics":
+            if buffer is None:
+                buffer = np.empty_like(shared["sub"])
+            results.append(_sweep_metrics(shared, dcmap, buffer))
+        else:
+            output_model = copy_model_without_data(input_model)
+            apply_noise_map(input_model.data, dcmap, out=output_model.data)
+            results.append(output_model)
+
+    return results
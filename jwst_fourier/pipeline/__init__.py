@@ -1,4 +1,24 @@
-from .calwebb_fourier1 import Fourier1Pipeline
-from .calwebb_fourier2 import Fourier2Pipeline
+"""
+The pipelines are imported when first accessed, so that the lightweight modules of
+this package (e.g. `steps`) can be used without loading the jwst pipelines.
+"""
+import importlib
 
 __all__ = ["Fourier1Pipeline", "Fourier2Pipeline"]
+
+# Module of each attribute imported on first access
+_LAZY_ATTRIBUTES = {
+    "Fourier1Pipeline": ".calwebb_fourier1",
+    "Fourier2Pipeline": ".calwebb_fourier2",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        module = importlib.import_module(_LAZY_ATTRIBUTES[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,275 @@
+"""
+On-disk cache of pipeline step results.
+
+Each step result is stored in a FITS file named after a key that identifies how it was
+obtained: the hash of the pipeline input, then for each step its name and
+configuration, chained with the key of the step before it. A pipeline can then skip
+the longest prefix of its step list that is already cached and only run the rest.
+
+Several processes can share a cache directory (e.g. the workers of a batch run):
+results are written atomically, and results evicted by another process while they
+are loaded are treated as missing.
+"""
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+import crds
+import jwst
+import numpy as np
+from jwst import datamodels
+
+from .steps import OUTPUT_PARAMETERS
+
+__all__ = ["StepCache"]
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+HASH_CHUNK_NBYTES = 2**24
+
+# Attributes of model inputs left out of their key: the creation date of the model
+# changes on every run even when its content does not
+UNHASHED_ATTRIBUTES = (".meta.date",)
+
+# Resolved CRDS context, by value of the CRDS_CONTEXT environment variable
+_crds_contexts: dict = {}
+
+
+def get_crds_context() -> Optional[str]:
+    """
+    CRDS context that selects the reference files of the steps.
+
+    CRDS_CONTEXT when it names a context, otherwise the context it refers to (e.g.
+    "jwst-operational") or the default one, from the CRDS server or the local CRDS
+    cache. When it cannot be resolved, CRDS_CONTEXT is used as is, so the cache should
+    be cleared when reference files change.
+    """
+    env_context = os.environ.get("CRDS_CONTEXT")
+    if env_context not in _crds_contexts:
+        try:
+            _crds_contexts[env_context] = crds.get_context_name("jwst", env_context)
+        except Exception as e:
+            # Resolved once per process, so an unreachable server is not queried again
+            log.warning(f"Could not resolve the CRDS context: {e}")
+            _crds_contexts[env_context] = env_context
+    return _crds_contexts[env_context]
+
+
+def _hash_tree(hasher, node, path: str = ""):
+    """
+    Update a hash with the arrays and values of a tree of model attributes.
+
+    Arrays are hashed through a buffer of their memory, without copying contiguous
+    arrays.
+    """
+    if path in UNHASHED_ATTRIBUTES:
+        return
+    if isinstance(node, dict):
+        for key in sorted(node, key=str):
+            _hash_tree(hasher, node[key], f"{path}.{key}")
+    elif isinstance(node, (list, tuple)):
+        for i, value in enumerate(node):
+            _hash_tree(hasher, value, f"{path}[{i}]")
+    elif isinstance(node, np.ndarray):
+        hasher.update(f"{path}:{node.dtype.str}{node.shape}".encode())
+        hasher.update(memoryview(np.ascontiguousarray(node)))
+    else:
+        hasher.update(f"{path}={node!r}".encode())
+
+
+class StepCache:
+    """
+    Cache of step results in a directory, with size-based LRU eviction.
+
+    Parameters
+    ----------
+    cache_dir : Union[Path, str]
+        Directory where results are stored
+    max_size : Optional[float]
+        Maximum size of the cache in GB. The least recently used results are deleted
+        when the cache grows larger. No limit by default.
+    """
+
+    def __init__(self, cache_dir: Union[Path, str], max_size: Optional[float] = None):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+
+    @staticmethod
+    def input_key(input) -> str:
+        """
+        Key of the pipeline input: hash of the file content, or of the model content.
+
+        Like the content of a file, the key of a model covers all its arrays (data, err,
+        DQ, tables) and its metadata, except `UNHASHED_ATTRIBUTES`.
+        """
+        hasher = hashlib.sha256()
+        if isinstance(input, datamodels.DataModel):
+            _hash_tree(hasher, input.instance)
+        else:
+            with open(input, "rb") as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_NBYTES), b""):
+                    hasher.update(chunk)
+        return hasher.hexdigest()
+
+    @staticmethod
+    def step_key(
+        parent_key: str,
+        step_name: str,
+        step,
+        step_cfg: Optional[dict] = None,
+        extra: Optional[list] = None,
+    ) -> str:
+        """
+        Key of a step result from the key of its input and the step configuration.
+
+        Parameters
+        ----------
+        parent_key : str
+            Key of the step input
+        step_name : str
+            Name of the step in the pipeline
+        step : Step
+            Step instance, with its configuration applied
+        step_cfg : Optional[dict]
+            Options set on the step with `apply_cfg_dict`. Included in case some are not
+            step parameters.
+        extra : Optional[list]
+            Other values that affect the result (e.g. keys of extra input files)
+
+        Returns
+        -------
+        str
+            Key of the step result
+        """
+        config = {
+            k: v for k, v in step.get_pars().items() if k not in OUTPUT_PARAMETERS
+        }
+        for k in step_cfg or {}:
+            if k not in OUTPUT_PARAMETERS:
+                config[k] = getattr(step, k)
+        key_dict = {
+            "parent": parent_key,
+            "step": step_name,
+            "config": config,
+            "extra": extra,
+            "jwst": jwst.__version__,
+            "crds_context": get_crds_context(),
+        }
+        key_str = json.dumps(key_dict, sort_keys=True, default=str)
+        return hashlib.sha256(key_str.encode()).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.fits"
+
+    def load(self, key: str, model_class: Callable = datamodels.open):
+        """
+        Load a cached result, or return None if it is not in the cache.
+        """
+        path = self.path(key)
+        try:
+            # Mark as recently used for eviction
+            os.utime(path)
+            return model_class(str(path))
+        except FileNotFoundError:
+            # Never cached, or evicted by another process
+            return None
+
+    def save(self, key: str, model):
+        """
+        Save a result in the cache and evict old results if the cache is too large.
+        """
+        tmp_dir = self.cache_dir / "tmp"
+        tmp_dir.mkdir(exist_ok=True)
+        tmp_path = tmp_dir / f"{key}_{os.getpid()}.fits"
+        # Saving updates the filename, which is used to name pipeline outputs
+        filename = model.meta.filename
+        model.save(str(tmp_path))
+        model.meta.filename = filename
+        # Rename at the end so that other processes never see a partial file
+        os.replace(tmp_path, self.path(key))
+
+        self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used results until the cache fits in `max_size`.
+        """
+        if self.max_size is None:
+            return
+        max_nbytes = self.max_size * 1024**3
+        files = []
+        for path in self.cache_dir.glob("*.fits"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Evicted by another process
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort(key=lambda file: file[0])
+        total_nbytes = sum(size for _, size, _ in files)
+        # The most recent file is kept even if it is larger than the cache
+        for _, size, path in files[:-1]:
+            if total_nbytes <= max_nbytes:
+                break
+            total_nbytes -= size
+            log.debug(f"Evicting {path.name} from step cache")
+            path.unlink(missing_ok=True)
+
+    def run_steps(
+        self,
+        steps: list,
+        input,
+        input_key: str,
+        cfg_dict: Optional[dict] = None,
+        model_class: Callable = datamodels.open,
+    ):
+        """
+        Run a sequence of steps, skipping the longest prefix that is already cached.
+
+        Parameters
+        ----------
+        steps : list
+            List of (step_name, step, func, extra) tuples. `func(model)` runs the step and
+            returns its result. `extra` is passed to `step_key`.
+        input : DataModel
+            Input of the first step
+        input_key : str
+            Key of the input, from `input_key`
+        cfg_dict : Optional[dict]
+            Configuration applied to the pipeline steps with `apply_cfg_dict`
+        model_class : Callable
+            Function used to open cached results
+
+        Returns
+        -------
+        DataModel
+            Result of the last step
+        """
+        cfg_dict = cfg_dict or {}
+        keys = []
+        key = input_key
+        for step_name, step, _, extra in steps:
+            key = self.step_key(key, step_name, step, cfg_dict.get(step_name), extra)
+            keys.append(key)
+
+        start = 0
+        for i in range(len(steps), 0, -1):
+            cached = self.load(keys[i - 1], model_class=model_class)
+            if cached is not None:
+                skipped = [step[0] for step in steps[:i]]
+                log.info(f"Using cached result, skipping steps {skipped}")
+                cached.meta.filename = input.meta.filename
+                input = cached
+                start = i
+                break
+
+        for (step_name, _, func, _), key in zip(steps[start:], keys[start:]):
+            input = func(input)
+            self.save(key, input)
+
+        return input
@@ -4,6 +4,9 @@ from jwst import datamodels
 from jwst.pipeline import Detector1Pipeline
 
 from ..oneoverf import oneoverf_step
+from .cache import StepCache
+from .profiling import StepProfiler, get_report_path, wrap_step
+from .steps import get_default_steps_stage1
 
 __all__ = ["Fourier1Pipeline"]
 
@@ -14,31 +17,54 @@ log.setLevel(logging.DEBUG)
 
 
 class Fourier1Pipeline(Detector1Pipeline):
+    """
+    Detector1Pipeline with the 1/f noise step.
+
+    `run` returns the rate product. The rateints product of the last run is kept in
+    `ints_result`, so that both can be passed to stage 2 without reading them back.
+    """
 
     class_alias = "calwebb_fourier1"
 
     spec = """
-
+        cache_dir = string(default=None)  # Directory of the step result cache. Disabled by default.
+        cache_max_size = float(default=None)  # Maximum size of the cache in GB
+        profile = boolean(default=False)  # Save a JSON report of the time and memory used by each step
     """
 
     _added_steps = {"oneoverf": oneoverf_step.OneOverFStep}
 
     step_defs = {**Detector1Pipeline.step_defs, **_added_steps}
 
+    ints_result = None
+
     def run(self, *args, step_list=None, cfg_dict=None):
         all_args = (*args, step_list, cfg_dict)
-        super().run(*all_args)
+        return super().run(*all_args)
 
     def process(self, input, step_list, cfg_dict):
 
         log.info(f"Starting {self.class_alias} ...")
+        self.ints_result = None
 
         if cfg_dict is not None:
             self.apply_cfg_dict(cfg_dict)
 
+        if self.cache_dir is not None:
+            cache = StepCache(self.cache_dir, max_size=self.cache_max_size)
+            input_key = cache.input_key(input)
+
+        # A ramp opened here is not used outside the pipeline, so steps can modify it
+        owns_input = not isinstance(input, datamodels.DataModel)
+
         # open the input as a RampModel
         input = datamodels.RampModel(input)
 
+        if self.profile:
+            profiler = StepProfiler(input.meta.filename or self.output_file)
+        else:
+            profiler = None
+
         # propagate output_dir to steps that might need it
         self.dark_current.output_dir = self.output_dir
         self.ramp_fit.output_dir = self.output_dir
@@ -56,6 +82,7 @@ class Fourier1Pipeline(Detector1Pipeline):
 
         step_list = step_list or self.get_default_steps(instrument)
 
+        ramp_steps = []
         for step_name in step_list:
             if step_name in ("ramp_fit", "gain_scale"):
                 break
@@ -63,7 +90,24 @@ class Fourier1Pipeline(Detector1Pipeline):
                 log.info("Skipping persistence step for NIRSPEC")
                 continue
             step = getattr(self, step_name)
-            input = step(input)
+            func = step
+            if step_name == "oneoverf" and owns_input:
+                func = self._run_oneoverf_in_place
+            ramp_steps.append(
+                (step_name, step, wrap_step(profiler, step_name, func), None)
+            )
+
+        if self.cache_dir is not None:
+            input = cache.run_steps(
+                ramp_steps,
+                input,
+                input_key,
+                cfg_dict=cfg_dict,
+                model_class=datamodels.RampModel,
+            )
+        else:
+            for _, _, func, _ in ramp_steps:
+                input = func(input)
 
         # save the corrected ramp data, if requested
         if self.save_calibrated_ramp:
@@ -74,17 +118,18 @@ class Fourier1Pipeline(Detector1Pipeline):
         # to fix the problem that the ramp_fit step ordinarily returns two
         # objects, but when the step is skipped due to `skip = True`,
         # only the input is returned when the step is invoked.
+        ramp_fit = wrap_step(profiler, "ramp_fit", self.ramp_fit)
         if self.ramp_fit.skip or "ramp_fit" not in step_list:
-            input = self.ramp_fit(input)
+            input = ramp_fit(input)
             ints_model = None
         else:
-            input, ints_model = self.ramp_fit(input)
+            input, ints_model = ramp_fit(input)
 
         if "gain_scale" in step_list:
             # apply the gain_scale step to the exposure-level product
             if input is not None:
                 self.gain_scale.suffix = "gain_scale"
-                input = self.gain_scale(input)
+                input = wrap_step(profiler, "gain_scale", self.gain_scale)(input)
             else:
                 log.info("NoneType returned from ramp_fit.  Gain Scale step skipped.")
 
@@ -92,52 +137,41 @@ class Fourier1Pipeline(Detector1Pipeline):
             # if it exists, and then save it
             if ints_model is not None:
                 self.gain_scale.suffix = "gain_scaleints"
-                ints_model = self.gain_scale(ints_model)
+                ints_model = wrap_step(profiler, "gain_scaleints", self.gain_scale)(
+                    ints_model
+                )
 
         if ints_model is not None:
             self.save_model(ints_model, "rateints")
+        self.ints_result = ints_model
 
         # setup output_file for saving
         self.setup_output(input)
 
+        if profiler is not None:
+            profiler.save(
+                get_report_path(profiler.exposure, self.output_dir, "rate")
+            )
+
         log.info(f"... ending {self.class_alias}")
 
         return input
 
-    def get_default_steps(self, instrument):
-        if instrument == "MIRI":
-            # NOTE: No custom steps implemented for MIRI. Just does what calwebb_detector1 would do
-            instrument_specific_list = [
-                "group_scale",
-                "dq_init",
-                "saturation",
-                "ipc",
-                "firstframe",
-                "lastframe",
-                "reset",
-                "linearity",
-                "rscd",
-                "dark_current",
-                "refpix",
-            ]
-        else:
-            instrument_specific_list = [
-                "group_scale",
-                "dq_init",
-                "saturation",
-                "ipc",
-                "oneoverf",
-                "superbias",
-                "refpix",
-                "linearity",
-            ]
-            if instrument != "NIRSPEC":
-                instrument_specific_list.append("persistence")
-            instrument_specific_list.append("dark_current")
-
-        generic_list = ["jump", "ramp_fit", "gain_scale"]
-
-        return instrument_specific_list + generic_list
+    def _run_oneoverf_in_place(self, input):
+        """
+        Run the 1/f step on a ramp owned by the pipeline, correcting it in place
+        instead of copying it. The `in_place` option of the step is restored after.
+        """
+        in_place = self.oneoverf.in_place
+        self.oneoverf.in_place = True
+        try:
+            return self.oneoverf(input)
+        finally:
+            self.oneoverf.in_place = in_place
+
+    @staticmethod
+    def get_default_steps(instrument):
+        return get_default_steps_stage1(instrument)
 
     def apply_cfg_dict(self, cfg_dict):
         for step_name in self.step_defs:
@@ -1,11 +1,18 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import logging
 import os.path as op
+import threading
 
 from jwst import datamodels
 from jwst.pipeline import Image2Pipeline
 from jwst.associations.load_as_asn import LoadAsLevel2Asn
 
 from ..oneoverf import oneoverf_step
+from .cache import StepCache
+from .profiling import StepProfiler, get_report_path
+from .steps import get_default_steps_stage2
 
 __all__ = ["Fourier2Pipeline"]
 
@@ -15,7 +22,10 @@ class Fourier2Pipeline(Image2Pipeline):
     class_alias = "calwebb_fourier2"
 
     spec = """
-
+        cache_dir = string(default=None)  # Directory of the step result cache. Disabled by default.
+        cache_max_size = float(default=None)  # Maximum size of the cache in GB
+        profile = boolean(default=False)  # Save a JSON report of the time and memory used by each step
+        product_workers = integer(default=1)  # Association products processed concurrently, each by a copy of the pipeline in a thread
     """
 
     _added_steps = {"oneoverf": oneoverf_step.OneOverFStep}
@@ -24,7 +34,7 @@ class Fourier2Pipeline(Image2Pipeline):
 
     def run(self, *args, step_list=None, cfg_dict=None):
         all_args = (*args, step_list, cfg_dict)
-        super().run(*all_args)
+        return super().run(*all_args)
 
     def process(self, input, step_list, cfg_dict):
 
@@ -38,31 +48,38 @@ class Fourier2Pipeline(Image2Pipeline):
         # Retrieve the input(s)
         asn = LoadAsLevel2Asn.load(input, basename=self.output_file)
 
+        try:
+            getattr(asn, 'filename')
+        except AttributeError:
+            asn.filename = "singleton"
+
         # Each exposure is a product in the association.
         # Process each exposure.
-        results = []
-        for product in asn['products']:
-            self.log.info('Processing product {}'.format(product['name']))
-            if self.save_results:
-                self.output_file = product['name']
-            try:
-                getattr(asn, 'filename')
-            except AttributeError:
-                asn.filename = "singleton"
-
-            result = self.process_exposure_product(
-                step_list,
-                product,
-                asn['asn_pool'],
-                op.basename(asn.filename)
+        products = asn['products']
+        n_workers = min(self.product_workers or 1, len(products))
+        if n_workers > 1:
+            self.log.info(
+                'Processing {} products with {} workers'.format(
+                    len(products), n_workers
+                )
             )
 
-            # Save result
-            suffix = 'cal'
-            if isinstance(result, datamodels.CubeModel):
-                suffix = 'calints'
-            result.meta.filename = self.make_output_path(suffix=suffix)
-            results.append(result)
+            def process_product(product):
+                # Steps keep state while they run, so each thread has its own copy
+                pipeline = self._copy_for_product(cfg_dict)
+                with _product_log_prefix(product['name']):
+                    return pipeline._process_product(step_list, product, asn, cfg_dict)
+
+            # Products are read, processed and written concurrently. Results keep the
+            # order of the association.
+            loggers = self._loggers()
+            with _log_products(loggers), ThreadPoolExecutor(n_workers) as executor:
+                results = list(executor.map(process_product, products))
+        else:
+            results = [
+                self._process_product(step_list, product, asn, cfg_dict)
+                for product in products
+            ]
 
         self.log.info('... ending calwebb_image2')
 
@@ -70,12 +87,50 @@ class Fourier2Pipeline(Image2Pipeline):
         self.suffix = False
         return results
 
+    def _process_product(self, step_list, product, asn, cfg_dict=None):
+        """Process one product of the association and name its result"""
+        self.log.info('Processing product {}'.format(product['name']))
+        if self.save_results:
+            self.output_file = product['name']
+
+        result = self.process_exposure_product(
+            step_list,
+            product,
+            asn['asn_pool'],
+            op.basename(asn.filename),
+            cfg_dict=cfg_dict,
+        )
+
+        # Save result
+        suffix = 'cal'
+        if isinstance(result, datamodels.CubeModel):
+            suffix = 'calints'
+        result.meta.filename = self.make_output_path(suffix=suffix)
+        return result
+
+    def _loggers(self):
+        """Loggers of the pipeline and its steps"""
+        loggers = [self.log]
+        for step_name in self.step_defs:
+            step = getattr(self, step_name, None)
+            if step is not None:
+                loggers.append(step.log)
+        return loggers
+
+    def _copy_for_product(self, cfg_dict=None):
+        """Copy of the pipeline and its steps, with the same configuration"""
+        pipeline = self.__class__(**self.get_pars())
+        if cfg_dict is not None:
+            pipeline.apply_cfg_dict(cfg_dict)
+        return pipeline
+
     def process_exposure_product(
             self,
             step_list,
             exp_product,
             pool_name=' ',
-            asn_file=' '
+            asn_file=' ',
+            cfg_dict=None,
     ):
         """Process an exposure found in the association product
 
@@ -90,6 +145,10 @@ class Fourier2Pipeline(Image2Pipeline):
         asn_file: str
             The name of the association file.
             Used for recording purposes only.
+
+        cfg_dict: dict
+            Configuration applied to the steps with `apply_cfg_dict`.
+            Used for the step result cache only.
         """
         # Find all the member types in the product
         members_by_type = defaultdict(list)
@@ -110,6 +169,9 @@ class Fourier2Pipeline(Image2Pipeline):
         science = science[0]
 
         self.log.info('Working on input %s ...', science)
+        if self.cache_dir is not None:
+            cache = StepCache(self.cache_dir, max_size=self.cache_max_size)
+            input_key = cache.input_key(science)
         if isinstance(science, datamodels.DataModel):
             input = science
         else:
@@ -119,6 +181,9 @@ class Fourier2Pipeline(Image2Pipeline):
         input.meta.asn.pool_name = pool_name
         input.meta.asn.table_name = asn_file
 
+        # Steps to run, as (name, step, function applied to input, extra cache key)
+        exposure_steps = []
+
         # Do background processing, if necessary
         if "bkg_subtract" in step_list and len(members_by_type['background']) > 0:
 
@@ -132,43 +197,76 @@ class Fourier2Pipeline(Image2Pipeline):
                 self.bkg_subtract.save_results = True
 
             # Call the background subtraction step
-            input = self.bkg_subtract(input, members_by_type['background'])
+            background = members_by_type['background']
+            if self.cache_dir is not None:
+                background_keys = [cache.input_key(bkg) for bkg in background]
+            else:
+                background_keys = None
+            exposure_steps.append((
+                "bkg_subtract",
+                self.bkg_subtract,
+                lambda model: self.bkg_subtract(model, background),
+                background_keys,
+            ))
+
+        for step_name in ["assign_wcs", "flat_field", "photom"]:
+            if step_name in step_list:
+                step = getattr(self, step_name)
+                exposure_steps.append((step_name, step, step, None))
+
+        if "resample" in step_list:
+            exposure_steps.append(
+                ("resample", self.resample, self._resample_exposure, None)
+            )
+
+        if "oneoverf" in step_list:
+            exposure_steps.append(("oneoverf", self.oneoverf, self.oneoverf, None))
+
+        if self.profile:
+            profiler = StepProfiler(input.meta.filename or self.output_file)
+            exposure_steps = [
+                (step_name, step, profiler.wrap(step_name, func), extra)
+                for step_name, step, func, extra in exposure_steps
+            ]
+            product_suffix = 'cal'
+            if isinstance(input, datamodels.CubeModel):
+                product_suffix = 'calints'
+
+        if self.cache_dir is not None:
+            input = cache.run_steps(
+                exposure_steps, input, input_key, cfg_dict=cfg_dict
+            )
+        else:
+            for _, _, func, _ in exposure_steps:
+                input = func(input)
+
+        if self.profile:
+            profiler.save(
+                get_report_path(profiler.exposure, self.output_dir, product_suffix)
+            )
 
-        if "assign_wcs" in step_list:
-            input = self.assign_wcs(input)
-        if "flat_field" in step_list:
-            input = self.flat_field(input)
-        if "photom" in step_list:
-            input = self.photom(input)
+        # That's all folks
+        self.log.info(
+            'Finished processing product {}'.format(exp_product['name'])
+        )
+        return input
 
+    def _resample_exposure(self, input):
+        """Resample the exposure if it is a 2D image. The input is returned unchanged."""
         # Resample individual exposures, but only if it's one of the
         # regular 2D science image types
-        if "resample" in step_list and input.meta.exposure.type.upper() in self.image_exptypes and \
+        if input.meta.exposure.type.upper() in self.image_exptypes and \
                 len(input.data.shape) == 2:
             self.resample.save_results = self.save_results
             self.resample.suffix = 'i2d'
             # TODO: Should resample result be set to input?
             # It was not in Image2pipeline... Usually skipping for AMI anyway
             self.resample(input)
-
-        if "oneoverf" in step_list:
-            input = self.oneoverf(input)
-
-        # That's all folks
-        self.log.info(
-            'Finished processing product {}'.format(exp_product['name'])
-        )
         return input
 
-    def get_default_steps(self):
-        step_list = [
-            "bkg_subtract",
-            "assign_wcs",
-            "flat_field",
-            "photom",
-            "resample",
-        ]
-        return step_list
+    @staticmethod
+    def get_default_steps():
+        return get_default_steps_stage2()
 
     def apply_cfg_dict(self, cfg_dict):
         for step_name in self.step_defs:
@@ -178,3 +276,54 @@ class Fourier2Pipeline(Image2Pipeline):
             step = getattr(self, step_name)
             for k, v in step_cfg.items():
                 setattr(step, k, v)
+
+
+# Name of the product processed by each thread, used to prefix log messages
+_thread_products = {}
+
+
+@contextmanager
+def _product_log_prefix(product_name):
+    """Prefix the log messages of the current thread with a product name"""
+    thread_id = threading.get_ident()
+    _thread_products[thread_id] = product_name.replace('%', '%%')
+    try:
+        yield
+    finally:
+        del _thread_products[thread_id]
+
+
+class _ProductFilter(logging.Filter):
+    """Prefix the log records of the threads processing a product with its name"""
+
+    def filter(self, record):
+        product_name = _thread_products.get(record.thread)
+        # Records reaching several handlers are only prefixed once
+        if product_name is not None and not hasattr(record, 'product'):
+            record.product = product_name
+            record.msg = '[{}] {}'.format(product_name, record.msg)
+        return True
+
+
+@contextmanager
+def _log_products(loggers):
+    """Prefix log messages with the product of their thread while products run
+
+    Filters of a logger do not see the records propagated from its children (e.g. the
+    modules called by the steps), so the filter is added to the handlers reached by
+    the pipeline loggers and the root logger, and removed when products are done.
+    """
+    handlers = set(logging.getLogger().handlers)
+    for logger in loggers:
+        while logger is not None:
+            handlers.update(logger.handlers)
+            logger = logger.parent if logger.propagate else None
+
+    product_filter = _ProductFilter()
+    for handler in handlers:
+        handler.addFilter(product_filter)
+    try:
+        yield
+    finally:
+        for handler in handlers:
+            handler.removeFilter(product_filter)
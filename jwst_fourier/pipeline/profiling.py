@@ -0,0 +1,290 @@
+"""
+Time and memory used by each step of a pipeline run.
+
+A `StepProfiler` wraps the functions that run the steps of one exposure. For each step,
+it records the wall and CPU time, the peak resident memory of the process while the
+step runs, and the size of the arrays of the input and output models. The records are
+saved in a JSON report next to the pipeline outputs.
+
+The high-water mark of the process (`ru_maxrss`) never decreases, so it does not show
+the peak of a step that uses less memory than the steps, or exposures, before it. The
+resident memory is instead sampled by a thread while each step runs (`RSSSampler`),
+which needs `/proc` (Linux). Other systems fall back on the high-water mark, and the
+method is recorded with each step.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+import numpy as np
+from jwst.lib.suffix import remove_suffix
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+__all__ = ["StepProfiler", "get_report_path", "wrap_step"]
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# Name of the reports of inputs without a file name (e.g. in-memory models)
+DEFAULT_EXPOSURE_NAME = "exposure"
+
+# ru_maxrss is in bytes on macOS and in kilobytes on Linux
+MAXRSS_UNIT_NBYTES = 1 if sys.platform == "darwin" else 1024
+
+# Interval between samples of the resident memory while a step runs, in seconds
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def get_peak_rss() -> Optional[int]:
+    """
+    Peak resident memory of the process in bytes, or None if it is not available
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT_NBYTES
+
+
+def get_current_rss() -> Optional[int]:
+    """
+    Current resident memory of the process in bytes, or None if it is not available
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        # /proc is only available on Linux, and sysconf not on Windows
+        return None
+
+
+class RSSSampler:
+    """
+    Peak resident memory of the process while a block runs, sampled by a thread.
+
+    Use as a context manager. Peaks shorter than `interval` can be missed. The memory
+    is the one of the whole process, so it includes other threads running at the same
+    time (e.g. stage 2 products processed concurrently).
+
+    Parameters
+    ----------
+    interval : float
+        Interval between samples in seconds
+
+    Attributes
+    ----------
+    start, peak : Optional[int]
+        Resident memory in bytes when the block started and its peak while it ran.
+        None if the resident memory is not available.
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.start = None
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _update(self):
+        rss = get_current_rss()
+        if rss is not None:
+            self.peak = max(self.peak, rss)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._update()
+
+    def __enter__(self):
+        self.start = self.peak = get_current_rss()
+        if self.start is not None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._update()
+
+
+def get_arrays_info(model) -> dict:
+    """
+    Shape, type and size of the arrays of a model (or of a tuple of models)
+
+    Parameters
+    ----------
+    model : DataModel, tuple or None
+        Input or output of a step
+
+    Returns
+    -------
+    dict
+        "arrays" with the shape and dtype of each array and their total "nbytes"
+    """
+    if model is None:
+        return {"arrays": {}, "nbytes": 0}
+    if isinstance(model, (tuple, list)):
+        infos = [get_arrays_info(m) for m in model]
+        return {
+            "arrays": [info["arrays"] for info in infos],
+            "nbytes": sum(info["nbytes"] for info in infos),
+        }
+
+    # The instance only holds arrays that exist: attributes could create default ones
+    instance = getattr(model, "instance", {})
+    arrays = {k: v for k, v in instance.items() if isinstance(v, np.ndarray)}
+    return {
+        "arrays": {
+            k: {"shape": list(v.shape), "dtype": str(v.dtype)} for k, v in arrays.items()
+        },
+        "nbytes": sum(v.nbytes for v in arrays.values()),
+    }
+
+
+class StepProfiler:
+    """
+    Record the time and memory used by each step run for one exposure.
+
+    Parameters
+    ----------
+    exposure : Optional[str]
+        Name of the exposure, saved in the report (None for inputs without a file)
+    """
+
+    def __init__(self, exposure: Optional[str]):
+        self.exposure = exposure
+        self.records = []
+
+    def wrap(self, step_name: str, func: Callable) -> Callable:
+        """
+        Wrap a function that runs a step so that each call is recorded.
+        """
+
+        @wraps(func)
+        def profiled(input, *args, **kwargs):
+            # Steps can modify their input in place, so it is described before running
+            input_info = get_arrays_info(input)
+            max_rss_before = get_peak_rss()
+            wall_start = time.perf_counter()
+            cpu_start = time.process_time()
+
+            with RSSSampler() as rss:
+                output = func(input, *args, **kwargs)
+
+            cpu_time = time.process_time() - cpu_start
+            wall_time = time.perf_counter() - wall_start
+            if rss.peak is not None:
+                memory_method = "sampled"
+                peak_rss = rss.peak
+                peak_rss_delta = rss.peak - rss.start
+            elif max_rss_before is not None:
+                # Only shows steps that use more memory than all the previous ones
+                memory_method = "maxrss"
+                peak_rss = get_peak_rss()
+                peak_rss_delta = peak_rss - max_rss_before
+            else:
+                memory_method = None
+                peak_rss = peak_rss_delta = None
+
+            record = {
+                "step": step_name,
+                "wall_time": wall_time,
+                "cpu_time": cpu_time,
+                "peak_rss": peak_rss,
+                "peak_rss_delta": peak_rss_delta,
+                "memory_method": memory_method,
+                "input": input_info,
+                "output": get_arrays_info(output),
+            }
+            self.records.append(record)
+            log.debug(
+                f"{step_name}: {wall_time:.2f} s wall, {cpu_time:.2f} s CPU,"
+                f" peak RSS +{(peak_rss_delta or 0) / 1024**2:.0f} MB"
+            )
+            return output
+
+        return profiled
+
+    def report(self) -> dict:
+        """
+        Report with the records of all steps, their total time and peak memory
+        """
+        peaks = [r["peak_rss"] for r in self.records if r["peak_rss"] is not None]
+        return {
+            "exposure": self.exposure,
+            "steps": self.records,
+            "total_wall_time": sum(r["wall_time"] for r in self.records),
+            "total_cpu_time": sum(r["cpu_time"] for r in self.records),
+            "peak_rss": max(peaks, default=None),
+        }
+
+    def save(self, output_path: Union[Path, str]):
+        """
+        Save the report to a JSON file.
+
+        The report is written after the steps have run, so failing to write it only
+        logs a warning instead of losing their results.
+        """
+        try:
+            with open(output_path, "w") as f:
+                json.dump(self.report(), f, indent=2)
+        except (OSError, TypeError, ValueError) as e:
+            log.warning(f"Could not save step profile to {output_path}: {e}")
+            return
+        log.info(f"Saved step profile to {output_path}")
+
+
+def wrap_step(
+    profiler: Optional[StepProfiler], step_name: str, func: Callable
+) -> Callable:
+    """
+    Wrap a step function with a profiler, or return it unchanged if profiler is None
+    """
+    if profiler is None:
+        return func
+    return profiler.wrap(step_name, func)
+
+
+def get_report_path(
+    filename: Optional[Union[Path, str]],
+    output_dir: Optional[Union[Path, str]],
+    product_suffix: str,
+) -> Path:
+    """
+    Path of the report for an exposure, named after the product of the pipeline.
+
+    Parameters
+    ----------
+    filename : Optional[Union[Path, str]]
+        Name of the exposure file. Inputs without a name (e.g. in-memory models) use
+        `DEFAULT_EXPOSURE_NAME`.
+    output_dir : Optional[Union[Path, str]]
+        Directory of the pipeline outputs (defaults to CWD)
+    product_suffix : str
+        Suffix of the pipeline product described by the report (e.g. "rate")
+
+    Returns
+    -------
+    Path
+        Path of the JSON report, e.g. `<exposure>_rate_profile.json`
+    """
+    if filename is None:
+        log.warning(
+            f"Input has no file name, the step profile is named after"
+            f" '{DEFAULT_EXPOSURE_NAME}'"
+        )
+        filename = DEFAULT_EXPOSURE_NAME
+    file_id, sep = remove_suffix(Path(filename).stem)
+    output_name = f"{file_id}{sep or '_'}{product_suffix}_profile.json"
+    return Path(output_dir or ".") / output_name
@@ -0,0 +1,72 @@
+"""
+Steps of the pipelines, defined without importing jwst so that batch configurations
+can be checked and planned before any pipeline is loaded.
+"""
+
+__all__ = ["OUTPUT_PARAMETERS", "get_default_steps_stage1", "get_default_steps_stage2"]
+
+# Step parameters that only affect where or whether outputs are saved
+OUTPUT_PARAMETERS = {
+    "input_dir",
+    "output_dir",
+    "output_ext",
+    "output_file",
+    "output_use_index",
+    "output_use_model",
+    "save_results",
+    "search_output_file",
+    "suffix",
+}
+
+
+def get_default_steps_stage1(instrument: str) -> list:
+    """
+    Default steps of `Fourier1Pipeline` for an instrument
+    """
+    if instrument == "MIRI":
+        # NOTE: No custom steps implemented for MIRI. Just does what calwebb_detector1 would do
+        instrument_specific_list = [
+            "group_scale",
+            "dq_init",
+            "saturation",
+            "ipc",
+            "firstframe",
+            "lastframe",
+            "reset",
+            "linearity",
+            "rscd",
+            "dark_current",
+            "refpix",
+        ]
+    else:
+        instrument_specific_list = [
+            "group_scale",
+            "dq_init",
+            "saturation",
+            "ipc",
+            "oneoverf",
+            "superbias",
+            "refpix",
+            "linearity",
+        ]
+        if instrument != "NIRSPEC":
+            instrument_specific_list.append("persistence")
+        instrument_specific_list.append("dark_current")
+
+    generic_list = ["jump", "ramp_fit", "gain_scale"]
+
+    return instrument_specific_list + generic_list
+
+
+def get_default_steps_stage2() -> list:
+    """
+    Default steps of `Fourier2Pipeline`
+    """
+    step_list = [
+        "bkg_subtract",
+        "assign_wcs",
+        "flat_field",
+        "photom",
+        "resample",
+    ]
+    return step_list
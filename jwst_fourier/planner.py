@@ -0,0 +1,401 @@
+"""
+Memory and runtime of a reduction planned from the FITS headers of its exposures.
+
+The size of each array held by the pipelines only depends on the number of
+integrations, groups, rows and columns of an exposure, so the memory of each step is
+estimated without reading the data. JWST steps are modeled as holding their input and
+a copy of it, and the 1/f step as holding its input, its new data array and the
+temporary arrays of its execution strategy (see `oneoverf.strategies`). Arrays used
+internally by the JWST steps are not included, so estimates are a lower bound for
+steps like jump and ramp_fit.
+
+Runtimes are only estimated from the profile reports of previous runs (see
+`pipeline.profiling`), which give the time per GB of input of each step.
+"""
+import json
+import logging
+from pathlib import Path
+from typing import Optional, Sequence, Union
+
+import numpy as np
+from astropy.io import fits
+
+from .oneoverf import kernels, strategies
+
+__all__ = [
+    "format_plan",
+    "load_step_rates",
+    "plan_stage1",
+    "plan_stage2",
+    "read_exposure_header",
+    "summarize_plan",
+]
+
+log = logging.getLogger(__name__)
+
+# Bytes of each pixel of a ramp: float32 data and err and uint8 groupdq
+RAMP_PIXEL_NBYTES = 4 + 4 + 1
+# Bytes of each pixel of a rate image or cube: float32 data, err, var_poisson,
+# var_rnoise and var_flat, and uint32 dq
+IMAGE_PIXEL_NBYTES = 5 * 4 + 4
+# Bytes of each pixel of the pixeldq array of a ramp
+PIXELDQ_NBYTES = 4
+
+# Models held by a JWST step: its input and the copy it modifies
+STEP_MODEL_COPIES = 2
+
+# Default options of OneOverFStep used to plan the 1/f step
+OOF_DEFAULTS = {
+    "strategy": None,
+    "iterative": False,
+    "max_memory": None,
+    "working_precision": "auto",
+    "stack_method": "median",
+    "kernel": "auto",
+    "in_place": False,
+}
+
+GB = 1024**3
+
+
+def read_exposure_header(input_file: Union[Path, str]) -> dict:
+    """
+    Shape and readout of an exposure from the primary and SCI headers of its file.
+
+    Parameters
+    ----------
+    input_file : Union[Path, str]
+        Path to the uncal file
+
+    Returns
+    -------
+    dict
+        "nints", "ngroups", "nrows", "ncols", "dtype" of the SCI data in the file,
+        "subarray" and "instrument"
+    """
+    header = fits.getheader(input_file, 0)
+    sci_header = fits.getheader(input_file, "SCI")
+    naxis = sci_header["NAXIS"]
+    # Missing axes of integrations or groups have a size of 1
+    shape = [sci_header[f"NAXIS{i}"] for i in range(naxis, 0, -1)]
+    shape = [1] * (4 - naxis) + shape
+    dtype = fits.hdu.base.BITPIX2DTYPE[sci_header["BITPIX"]]
+    signed_offset = 2 ** (8 * np.dtype(dtype).itemsize - 1)
+    if dtype.startswith("int") and sci_header.get("BZERO", 0) == signed_offset:
+        # Unsigned integers are stored as signed integers with an offset
+        dtype = dtype.replace("int", "uint")
+    return {
+        "nints": header.get("NINTS", shape[0]),
+        "ngroups": header.get("NGROUPS", shape[1]),
+        "nrows": shape[2],
+        "ncols": shape[3],
+        "dtype": dtype,
+        "subarray": header.get("SUBARRAY"),
+        "instrument": header.get("INSTRUME"),
+    }
+
+
+def _oof_memory(shape: tuple, options: Optional[dict]) -> tuple:
+    """
+    Strategy and memory in GB of the temporary arrays of the 1/f step on float32 data
+    """
+    options = {**OOF_DEFAULTS, **(options or {})}
+    # Planning does not need the kernel to be installed, e.g. numba on this machine
+    kernel = kernels.get_kernel(options["kernel"], check_installed=False)
+    working_dtype = strategies.get_working_dtype(options["working_precision"])
+    iterative, max_memory = strategies.resolve_strategy(
+        options["strategy"],
+        shape,
+        np.float32,
+        iterative=options["iterative"],
+        max_memory=options["max_memory"],
+        working_dtype=working_dtype,
+        stack_method=options["stack_method"],
+        kernel=kernel,
+    )
+    if max_memory is not None:
+        strategy = "tiled"
+    elif iterative and kernel == "numpy":
+        strategy = "iterative"
+    else:
+        strategy = "vectorized"
+    memory = strategies.estimate_oof_memory(
+        shape,
+        np.float32,
+        strategy,
+        max_memory,
+        working_dtype,
+        options["stack_method"],
+        kernel,
+    )
+    return strategy, memory
+
+
+def _step_plan(
+    stage: str,
+    step: str,
+    memory: float,
+    input_nbytes: float,
+    rates: Optional[dict],
+    strategy: Optional[str] = None,
+    product: Optional[str] = None,
+) -> dict:
+    """Plan of one step, with its runtime if the rate of the step is known"""
+    rate = (rates or {}).get((stage, step))
+    return {
+        "stage": stage,
+        "product": product,
+        "step": step,
+        "memory": memory,
+        "time": rate * input_nbytes / GB if rate is not None else None,
+        "strategy": strategy,
+    }
+
+
+def plan_stage1(
+    exposure: dict,
+    steps: Sequence[str],
+    step_config: Optional[dict] = None,
+    oof_in_place: bool = True,
+    rates: Optional[dict] = None,
+) -> list:
+    """
+    Memory and runtime of each step of `Fourier1Pipeline` for one exposure.
+
+    Parameters
+    ----------
+    exposure : dict
+        Exposure from `read_exposure_header`
+    steps : Sequence[str]
+        Steps that run, in order
+    step_config : Optional[dict]
+        Configuration of the steps (used for the options of the 1/f step)
+    oof_in_place : bool
+        Whether the pipeline corrects 1/f noise in place (when it opened the ramp)
+    rates : Optional[dict]
+        Time per GB of input of each step, from `load_step_rates`
+
+    Returns
+    -------
+    list
+        Plan of each step: "stage", "product" (stage 2 only), "step", "memory" in GB,
+        "time" in seconds (None if unknown) and 1/f "strategy"
+    """
+    step_config = step_config or {}
+    nints, ngroups = exposure["nints"], exposure["ngroups"]
+    nrows, ncols = exposure["nrows"], exposure["ncols"]
+    npix = nints * ngroups * nrows * ncols
+    ramp_nbytes = npix * RAMP_PIXEL_NBYTES + nrows * ncols * PIXELDQ_NBYTES
+    rate_nbytes = nrows * ncols * IMAGE_PIXEL_NBYTES
+    rateints_nbytes = nints * rate_nbytes
+
+    plans = []
+    for step in steps:
+        if step == "oneoverf":
+            options = step_config.get(step)
+            strategy, memory = _oof_memory((nints, ngroups, nrows, ncols), options)
+            in_place = oof_in_place or (options or {}).get("in_place", False)
+            nbytes = ramp_nbytes + memory * GB + (0 if in_place else 4 * npix)
+            plans.append(
+                _step_plan("stage1", step, nbytes / GB, ramp_nbytes, rates, strategy)
+            )
+        elif step == "ramp_fit":
+            nbytes = ramp_nbytes + rate_nbytes + rateints_nbytes
+            plans.append(_step_plan("stage1", step, nbytes / GB, ramp_nbytes, rates))
+        elif step == "gain_scale":
+            # Applied to both products, which are held at the same time
+            input_nbytes = rate_nbytes + rateints_nbytes
+            nbytes = STEP_MODEL_COPIES * input_nbytes
+            plans.append(_step_plan("stage1", step, nbytes / GB, input_nbytes, rates))
+        else:
+            nbytes = STEP_MODEL_COPIES * ramp_nbytes
+            plans.append(_step_plan("stage1", step, nbytes / GB, ramp_nbytes, rates))
+    return plans
+
+
+def plan_stage2(
+    exposure: dict,
+    steps: Sequence[str],
+    step_config: Optional[dict] = None,
+    concurrent: bool = False,
+    inputs_in_memory: bool = False,
+    rates: Optional[dict] = None,
+) -> list:
+    """
+    Memory and runtime of each step of `Fourier2Pipeline` for one exposure.
+
+    The memory of each step includes the products of the exposure held while it runs:
+    results of the products processed before it, products processed at the same time
+    (`concurrent`), and inputs of the next products when they are passed in memory.
+
+    Parameters
+    ----------
+    exposure : dict
+        Exposure from `read_exposure_header`
+    steps : Sequence[str]
+        Steps that run on each product, in order
+    step_config : Optional[dict]
+        Configuration of the steps (used for the options of the 1/f step)
+    concurrent : bool
+        Whether the rate and rateints products are processed at the same time
+    inputs_in_memory : bool
+        Whether stage 1 products are passed in memory instead of files
+    rates : Optional[dict]
+        Time per GB of input of each step, from `load_step_rates`
+
+    Returns
+    -------
+    list
+        Plan of each step of each product (see `plan_stage1`)
+    """
+    step_config = step_config or {}
+    nints, nrows, ncols = exposure["nints"], exposure["nrows"], exposure["ncols"]
+    rate_nbytes = nrows * ncols * IMAGE_PIXEL_NBYTES
+    products = [(rate_nbytes, None), (nints * rate_nbytes, (nints, nrows, ncols))]
+
+    # Peak of each product alone, then with the products held while it runs
+    product_plans = []
+    for (model_nbytes, cube_shape), product in zip(products, ["rate", "rateints"]):
+        plans = []
+        for step in steps:
+            strategy = None
+            if step == "oneoverf" and cube_shape is None:
+                # Images are not corrected
+                nbytes = model_nbytes
+            elif step == "oneoverf":
+                options = step_config.get(step)
+                strategy, memory = _oof_memory(cube_shape, options)
+                in_place = (options or {}).get("in_place", False)
+                new_data_nbytes = 0 if in_place else 4 * int(np.prod(cube_shape))
+                nbytes = model_nbytes + memory * GB + new_data_nbytes
+            else:
+                nbytes = STEP_MODEL_COPIES * model_nbytes
+            plans.append(
+                _step_plan(
+                    "stage2", step, nbytes / GB, model_nbytes, rates, strategy, product
+                )
+            )
+        product_plans.append(plans)
+
+    peaks = [max((p["memory"] for p in plans), default=0.0) for plans in product_plans]
+    for i, plans in enumerate(product_plans):
+        if concurrent:
+            # Other products can be at their own peak at the same time
+            others = sum(peaks) - peaks[i]
+        else:
+            # Results of previous products are kept, next inputs are held if in memory
+            held = products[:i] + (products[i + 1 :] if inputs_in_memory else [])
+            others = sum(model_nbytes for model_nbytes, _ in held) / GB
+        for plan in plans:
+            plan["memory"] += others
+
+    return [plan for plans in product_plans for plan in plans]
+
+
+def load_step_rates(report_files: Sequence[Union[Path, str]]) -> dict:
+    """
+    Time per GB of input of each step, from the profile reports of previous runs.
+
+    Reports of stage 1 (`*_rate_profile.json`) and stage 2 (`*_cal_profile.json` and
+    `*_calints_profile.json`) are distinguished by their name.
+
+    Parameters
+    ----------
+    report_files : Sequence[Union[Path, str]]
+        JSON reports saved by `profiling.StepProfiler`
+
+    Returns
+    -------
+    dict
+        Seconds per GB of input, by ("stage1" or "stage2", step name)
+    """
+    wall_times = {}
+    nbytes = {}
+    for report_file in report_files:
+        if Path(report_file).name.endswith("_rate_profile.json"):
+            stage = "stage1"
+        else:
+            stage = "stage2"
+        try:
+            with open(report_file, "r") as f:
+                report = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            log.warning(f"Could not read profile report {report_file}")
+            continue
+        for record in report["steps"]:
+            key = (stage, record["step"])
+            wall_times[key] = wall_times.get(key, 0.0) + record["wall_time"]
+            nbytes[key] = nbytes.get(key, 0) + record["input"]["nbytes"]
+    return {key: wall_times[key] / (nbytes[key] / GB) for key in nbytes if nbytes[key]}
+
+
+def summarize_plan(steps: list) -> dict:
+    """
+    Peak memory and total runtime of the steps of an exposure.
+
+    Steps that did not run in the profiled runs (e.g. bkg_subtract without background
+    exposures) have no known runtime: the total is then a lower bound, with
+    "time_complete" False. The runtime is None if no step has a known runtime.
+    """
+    times = [step["time"] for step in steps if step["time"] is not None]
+    return {
+        "peak_memory": max((step["memory"] for step in steps), default=0.0),
+        "time": sum(times) if times else None,
+        "time_complete": len(times) == len(steps),
+    }
+
+
+def format_plan(plans: list) -> str:
+    """
+    Table of the plans of several exposures.
+
+    Parameters
+    ----------
+    plans : list
+        Plan of each exposure, with its "exposure" name, "shape", "steps", and the
+        "peak_memory", "time" and "time_complete" from `summarize_plan`. Exposures
+        that could not be planned have an "error" instead.
+
+    Returns
+    -------
+    str
+        One line per step of each exposure, and the peak memory and runtime of each
+        exposure and of the batch
+    """
+
+    def format_time(time, complete=True):
+        if time is None:
+            return f"{'?':>9s} s"
+        # Lower bound when the time of some steps is unknown
+        return f"{time:9.1f} s" + ("" if complete else "+")
+
+    lines = []
+    for plan in plans:
+        if "error" in plan:
+            lines.append(f"{plan['exposure']} (unreadable: {plan['error']})")
+            continue
+        shape = "x".join(str(n) for n in plan["shape"])
+        lines.append(f"{plan['exposure']} ({shape})")
+        for step in plan["steps"]:
+            stage = f"{step['stage']} {step['product'] or ''}"
+            strategy = f"  [{step['strategy']}]" if step["strategy"] else ""
+            lines.append(
+                f"  {stage:16s}{step['step']:16s}{step['memory']:9.3f} GB"
+                f"{format_time(step['time'])}{strategy}"
+            )
+        time = format_time(plan["time"], plan["time_complete"])
+        lines.append(f"  {'peak':32s}{plan['peak_memory']:9.3f} GB{time}")
+
+    # The time of unreadable exposures is unknown, so the total is then a lower bound
+    planned = [plan for plan in plans if "error" not in plan]
+    peak_memory = max((plan["peak_memory"] for plan in planned), default=0.0)
+    times = [plan["time"] for plan in planned if plan["time"] is not None]
+    complete = len(times) == len(plans) and all(p["time_complete"] for p in planned)
+    time = format_time(sum(times) if times else None, complete)
+    unreadable = len(plans) - len(planned)
+    lines.append(
+        f"{len(plans)} exposures"
+        + (f" ({unreadable} unreadable)" if unreadable else "")
+        + f": largest peak {peak_memory:.3f} GB, total time {time.strip()}"
+    )
+    return "\n".join(lines)
@@ -0,0 +1,645 @@
+"""
+Reduce Fourier imaging exposures with the stage 1 and stage 2 pipelines.
+
+The reduction is configured with a YAML file (see `scripts/example.yaml`). Exposures
+can be dispatched to a pool of worker processes, with a memory budget shared by
+all workers.
+"""
+import logging
+import multiprocessing
+import os
+import traceback
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from copy import deepcopy
+from pathlib import Path
+from typing import Optional, Union
+
+import yaml
+
+from . import planner
+from .manifest import RunManifest, file_identity, stage_hash
+from .pipeline.steps import get_default_steps_stage1, get_default_steps_stage2
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# Steps that reduce_exposure always skips
+STAGE1_SKIPPED_STEPS = ["ipc"]
+STAGE2_SKIPPED_STEPS = ["photom", "resample"]
+
+# Fraction of the CPUs used by each ramp_fit max_cores option
+MAX_CORES_FRACTIONS = {"all": 1.0, "half": 0.5, "quarter": 0.25}
+
+
+def get_input_files(input_cfg: Union[str, list]) -> list:
+    if isinstance(input_cfg, str):
+        return [input_cfg]
+    elif isinstance(input_cfg, list):
+        return input_cfg
+    else:
+        raise TypeError("Unexpected type for input_file(s) config")
+
+
+def parse_config(cfg_dict: dict) -> dict:
+    """
+    Parse the YAML configuration of a reduction.
+
+    Parameters
+    ----------
+    cfg_dict : dict
+        Configuration loaded from the YAML file
+
+    Returns
+    -------
+    dict
+        Configuration with input files, output directories, steps and step
+        configuration of each stage
+    """
+    if "input_file" in cfg_dict and "input_files" not in cfg_dict:
+        input_files = get_input_files(cfg_dict["input_file"])
+    elif "input_files" in cfg_dict and "input_file" not in cfg_dict:
+        input_files = get_input_files(cfg_dict["input_files"])
+    elif "input_files" in cfg_dict and "input_file" in cfg_dict:
+        raise ValueError("input_files and input_file cannot both be provided.")
+    else:
+        raise ValueError("One of input_files or input file must be provided.")
+    input_files = [Path(f) for f in input_files]
+    output_dir_parent = Path(cfg_dict["output_dir_parent"])
+
+    output_dir_stage1 = output_dir_parent
+    output_dir_stage2 = output_dir_parent
+    if "stage1_subdir" in cfg_dict and cfg_dict["stage1_subdir"] is not None:
+        output_dir_stage1 = output_dir_stage1 / cfg_dict["stage1_subdir"]
+    if "stage2_subdir" in cfg_dict and cfg_dict["stage2_subdir"] is not None:
+        output_dir_stage2 = output_dir_stage2 / cfg_dict["stage2_subdir"]
+
+    if "steps" in cfg_dict:
+        steps_stage1 = cfg_dict.get("steps")
+    else:
+        steps_stage1 = cfg_dict.get("steps_stage1")
+    steps_stage2 = cfg_dict.get("steps_stage2")
+
+    if "step_config" in cfg_dict:
+        stage1_config = cfg_dict.get("step_config")
+    else:
+        stage1_config = cfg_dict.get("stage1_config")
+    if "stage2_config" not in cfg_dict and "step_config" in cfg_dict:
+        stage2_config = cfg_dict.get("step_config")
+    else:
+        stage2_config = cfg_dict.get("stage2_config")
+
+    return dict(
+        input_files=input_files,
+        output_dir_parent=output_dir_parent,
+        output_dir_stage1=output_dir_stage1,
+        output_dir_stage2=output_dir_stage2,
+        steps_stage1=steps_stage1,
+        steps_stage2=steps_stage2,
+        stage1_config=stage1_config,
+        stage2_config=stage2_config,
+        run_stage1=cfg_dict.get("run_stage1") or False,
+        run_stage2=cfg_dict.get("run_stage2") or False,
+        n_workers=cfg_dict.get("n_workers") or 1,
+        max_memory=cfg_dict.get("max_memory"),
+        cache_dir=cfg_dict.get("cache_dir"),
+        cache_max_size=cfg_dict.get("cache_max_size"),
+        profile=cfg_dict.get("profile") or False,
+        product_workers=cfg_dict.get("product_workers") or 1,
+        save_stage1=cfg_dict.get("save_stage1", True),
+        manifest_file=Path(
+            cfg_dict.get("manifest_file") or output_dir_parent / "reduce_manifest.jsonl"
+        ),
+        resume=cfg_dict.get("resume", True),
+    )
+
+
+def load_config(config_file: Union[Path, str]) -> dict:
+    """
+    Load and parse a YAML configuration file (see `parse_config`)
+    """
+    with open(config_file, "r") as cfg:
+        cfg_dict = yaml.safe_load(cfg)
+
+    return parse_config(cfg_dict)
+
+
+def get_stage1_path(
+    input_file: Union[Path, str], output_dir: Union[Path, str], suffix: str
+) -> Path:
+    """
+    Path of a stage 1 product of an exposure (e.g. `suffix="rateints"`)
+    """
+    from jwst.lib.suffix import replace_suffix
+
+    input_file = Path(input_file)
+    return Path(output_dir) / (replace_suffix(input_file.stem, suffix) + ".fits")
+
+
+def get_stage_hashes(input_file: Union[Path, str], config: dict) -> dict:
+    """
+    Hash of the result of each stage for one exposure (see `manifest.stage_hash`).
+
+    The stage 2 hash includes the stage 1 hash when both stages run, so that changing
+    stage 1 also reruns stage 2. Otherwise, it includes the stage 1 files.
+
+    Parameters
+    ----------
+    input_file : Union[Path, str]
+        Path to the uncal file
+    config : dict
+        Configuration from `parse_config`
+
+    Returns
+    -------
+    dict
+        Hash of "stage1" (None if it does not run) and "stage2"
+    """
+    if config["run_stage1"]:
+        stage1_hash = stage_hash(
+            file_identity(input_file),
+            config["steps_stage1"],
+            config["stage1_config"],
+            save_stage1=config["save_stage1"] or not config["run_stage2"],
+        )
+        stage2_inputs = stage1_hash
+    else:
+        stage1_hash = None
+        stage2_inputs = [
+            file_identity(get_stage1_path(input_file, config["output_dir_stage1"], s))
+            for s in ["rate", "rateints"]
+        ]
+    stage2_hash = stage_hash(
+        stage2_inputs, config["steps_stage2"], config["stage2_config"]
+    )
+    return {"stage1": stage1_hash, "stage2": stage2_hash}
+
+
+def _run_stage(
+    manifest: RunManifest, input_file: Path, stage: str, config_hash: str, func
+):
+    """
+    Run a stage of an exposure, recording its status and outputs in the manifest.
+    `func()` runs the stage and returns its result and output files.
+    """
+    manifest.record(input_file, stage, "running", config_hash)
+    try:
+        result, outputs = func()
+    except Exception as e:
+        manifest.record(
+            input_file, stage, "failed", config_hash, error=f"{type(e).__name__}: {e}"
+        )
+        raise
+    manifest.record(input_file, stage, "done", config_hash, outputs=outputs)
+    return result
+
+
+def reduce_exposure(input_file: Union[Path, str], config: dict):
+    """
+    Run stage 1 and/or stage 2 on one uncal exposure.
+
+    When both stages run, the stage 1 products are passed to stage 2 in memory. They
+    are only written to disk if `save_stage1` is set in the configuration.
+
+    The status of each stage is recorded in the run manifest. With `resume`, stages
+    that completed in a previous run with the same configuration are skipped.
+
+    Parameters
+    ----------
+    input_file : Union[Path, str]
+        Path to the uncal file
+    config : dict
+        Configuration from `parse_config`
+    """
+    # jwst is only imported by the processes that reduce exposures
+    from .oneoverf import one_over_f
+    from .pipeline import Fourier1Pipeline, Fourier2Pipeline
+
+    input_file = Path(input_file)
+    output_dir_stage1 = config["output_dir_stage1"]
+    output_dir_stage2 = config["output_dir_stage2"]
+
+    manifest = RunManifest(config["manifest_file"])
+    hashes = get_stage_hashes(input_file, config)
+    resume = config["resume"]
+    stage1_done = (
+        resume
+        and config["run_stage1"]
+        and manifest.is_done(input_file, "stage1", hashes["stage1"])
+    )
+    stage2_done = (
+        resume
+        and config["run_stage2"]
+        and manifest.is_done(input_file, "stage2", hashes["stage2"])
+    )
+    run_stage1 = config["run_stage1"] and not stage1_done
+    run_stage2 = config["run_stage2"] and not stage2_done
+    if stage1_done and run_stage2:
+        # Stage 1 products that were not saved are computed again for stage 2
+        run_stage1 = not manifest.get(input_file, "stage1")["outputs"]
+    if config["run_stage1"] and not run_stage1:
+        log.info(f"Skipping stage 1 of {input_file}: already completed")
+    if config["run_stage2"] and not run_stage2:
+        log.info(f"Skipping stage 2 of {input_file}: already completed")
+
+    def stage1():
+        pipe1 = Fourier1Pipeline()
+        pipe1.save_results = config["save_stage1"] or not config["run_stage2"]
+        pipe1.output_dir = str(output_dir_stage1)
+        for step_name in STAGE1_SKIPPED_STEPS:
+            getattr(pipe1, step_name).skip = True
+        pipe1.cache_dir = config["cache_dir"]
+        pipe1.cache_max_size = config["cache_max_size"]
+        pipe1.profile = config["profile"]
+        rate_model = pipe1.run(
+            str(input_file),
+            step_list=config["steps_stage1"],
+            cfg_dict=config["stage1_config"],
+        )
+        one_over_f.wait_for_intermediates()
+
+        outputs = []
+        if pipe1.save_results:
+            for suffix in ["rate", "rateints"]:
+                stage1_file = get_stage1_path(input_file, output_dir_stage1, suffix)
+                if stage1_file.exists():
+                    outputs.append(stage1_file)
+        return {"rate": rate_model, "rateints": pipe1.ints_result}, outputs
+
+    def stage2():
+        stage2_inputs = []
+        for suffix in ["rate", "rateints"]:
+            stage1_file = get_stage1_path(input_file, output_dir_stage1, suffix)
+            if stage1_results is None:
+                stage2_inputs.append(str(stage1_file))
+            elif stage1_results[suffix] is not None:
+                # Models are named like their file, which names the stage 2 products
+                model = stage1_results[suffix]
+                model.meta.filename = stage1_file.name
+                stage2_inputs.append(model)
+        pipe2 = Fourier2Pipeline()
+        pipe2.save_results = True
+        pipe2.output_dir = str(output_dir_stage2)
+        for step_name in STAGE2_SKIPPED_STEPS:
+            getattr(pipe2, step_name).skip = True
+        pipe2.cache_dir = config["cache_dir"]
+        pipe2.cache_max_size = config["cache_max_size"]
+        pipe2.profile = config["profile"]
+        pipe2.product_workers = config["product_workers"]
+        results = pipe2.run(
+            stage2_inputs,
+            step_list=config["steps_stage2"],
+            cfg_dict=config["stage2_config"],
+        )
+        # Intermediate 1/f products are written in the background: report their errors
+        one_over_f.wait_for_intermediates()
+
+        outputs = [
+            Path(output_dir_stage2) / Path(result.meta.filename).name
+            for result in results or []
+        ]
+        return results, outputs
+
+    stage1_results = None
+    if run_stage1:
+        stage1_results = _run_stage(
+            manifest, input_file, "stage1", hashes["stage1"], stage1
+        )
+
+    if run_stage2:
+        _run_stage(manifest, input_file, "stage2", hashes["stage2"], stage2)
+
+
+def _reduce_exposure_safe(input_file: Path, config: dict) -> Optional[str]:
+    """
+    Reduce one exposure and return the traceback instead of raising on failure
+    """
+    try:
+        reduce_exposure(input_file, config)
+    except Exception:
+        log.error(f"Reduction of {input_file} failed")
+        return traceback.format_exc()
+    return None
+
+
+def _record_worker_failure(manifest: RunManifest, input_file: Path, error: str):
+    """
+    Mark the stages of an exposure left running by a dead worker process as failed
+    """
+    for stage in ["stage1", "stage2"]:
+        record = manifest.get(input_file, stage)
+        if record is not None and record["status"] == "running":
+            manifest.record(
+                input_file, stage, "failed", record["config_hash"], error=error
+            )
+
+
+def get_run_steps(
+    steps: Optional[list], step_config: Optional[dict], skipped_steps: list
+) -> list:
+    """
+    Steps of a stage that run: steps of the configuration without the skipped ones
+    """
+    step_config = step_config or {}
+    return [
+        step
+        for step in steps
+        if step not in skipped_steps and not (step_config.get(step) or {}).get("skip")
+    ]
+
+
+def plan_exposure(
+    input_file: Union[Path, str], config: dict, rates: Optional[dict] = None
+) -> dict:
+    """
+    Plan the memory and runtime of each step for an exposure from its headers only.
+
+    Parameters
+    ----------
+    input_file : Union[Path, str]
+        Path to the uncal file
+    config : dict
+        Configuration from `parse_config`
+    rates : Optional[dict]
+        Time per GB of input of each step (see `planner.load_step_rates`)
+
+    Returns
+    -------
+    dict
+        "exposure", "shape" (nints, ngroups, nrows, ncols), plan of each step (see
+        `planner.plan_stage1`), "peak_memory" in GB and total "time" in seconds (None
+        if the time of a step is unknown)
+    """
+    exposure = planner.read_exposure_header(input_file)
+    steps = []
+    if config["run_stage1"]:
+        step_list = config["steps_stage1"] or get_default_steps_stage1(
+            exposure["instrument"]
+        )
+        steps += planner.plan_stage1(
+            exposure,
+            get_run_steps(step_list, config["stage1_config"], STAGE1_SKIPPED_STEPS),
+            config["stage1_config"],
+            rates=rates,
+        )
+    if config["run_stage2"]:
+        step_list = config["steps_stage2"] or get_default_steps_stage2()
+        steps += planner.plan_stage2(
+            exposure,
+            get_run_steps(step_list, config["stage2_config"], STAGE2_SKIPPED_STEPS),
+            config["stage2_config"],
+            concurrent=config["product_workers"] > 1,
+            inputs_in_memory=config["run_stage1"],
+            rates=rates,
+        )
+    shape = tuple(exposure[k] for k in ["nints", "ngroups", "nrows", "ncols"])
+    return {
+        "exposure": Path(input_file).name,
+        "shape": shape,
+        "steps": steps,
+        **planner.summarize_plan(steps),
+    }
+
+
+def plan_batch(config: dict, report_files: Optional[list] = None) -> list:
+    """
+    Plan all exposures of a configuration (see `plan_exposure`).
+
+    Runtimes are estimated from the profile reports found in the output directories,
+    or from `report_files` if given. Exposures whose headers cannot be read (e.g.
+    missing files) have an "error" instead of a plan, and the others are still planned.
+    """
+    if report_files is None:
+        report_files = set()
+        for output_dir in [config["output_dir_stage1"], config["output_dir_stage2"]]:
+            report_files |= set(Path(output_dir).glob("*_profile.json"))
+        report_files = sorted(report_files)
+    rates = planner.load_step_rates(report_files)
+    plans = []
+    for input_file in config["input_files"]:
+        try:
+            plans.append(plan_exposure(input_file, config, rates))
+        except (OSError, KeyError) as e:
+            log.warning(f"Could not plan {input_file}: {e}")
+            plans.append({"exposure": Path(input_file).name, "error": str(e)})
+    return plans
+
+
+def estimate_memory(input_file: Union[Path, str], config: dict) -> float:
+    """
+    Estimate the memory required to reduce an exposure from its headers only.
+
+    Parameters
+    ----------
+    input_file : Union[Path, str]
+        Path to the uncal file
+    config : dict
+        Configuration from `parse_config`
+
+    Returns
+    -------
+    float
+        Estimated peak memory in GB (see `plan_exposure`)
+    """
+    return plan_exposure(input_file, config)["peak_memory"]
+
+
+def limit_ramp_fit_cores(stage1_config: Optional[dict], n_workers: int) -> dict:
+    """
+    Lower `ramp_fit.max_cores` so that all workers together do not use more than the CPUs.
+
+    Parameters
+    ----------
+    stage1_config : Optional[dict]
+        Step configuration of stage 1
+    n_workers : int
+        Number of exposures processed at the same time
+
+    Returns
+    -------
+    dict
+        Copy of the configuration with an updated `ramp_fit.max_cores`
+    """
+    stage1_config = deepcopy(stage1_config) or {}
+    ramp_fit_config = stage1_config.setdefault("ramp_fit", {})
+    max_cores = str(ramp_fit_config.get("max_cores", "none"))
+
+    ncpus = os.cpu_count() or 1
+    if max_cores in MAX_CORES_FRACTIONS:
+        ncores = max(1, int(ncpus * MAX_CORES_FRACTIONS[max_cores]))
+    elif max_cores.isdigit():
+        ncores = int(max_cores)
+    else:
+        ncores = 1
+
+    cores_per_worker = max(1, ncpus // n_workers)
+    if ncores <= cores_per_worker:
+        return stage1_config
+
+    # Named options are supported by all versions of ramp_fit
+    new_max_cores = "none"
+    for option, fraction in MAX_CORES_FRACTIONS.items():
+        if int(ncpus * fraction) <= cores_per_worker:
+            new_max_cores = option
+            break
+    log.warning(
+        f"ramp_fit.max_cores={max_cores} with {n_workers} workers would use more than"
+        f" {ncpus} CPUs. Using max_cores={new_max_cores} instead."
+    )
+    ramp_fit_config["max_cores"] = new_max_cores
+
+    return stage1_config
+
+
+def reduce_batch(
+    config: dict, n_workers: int = 1, max_memory: Optional[float] = None
+) -> dict:
+    """
+    Reduce all exposures of a configuration, optionally in parallel.
+
+    Failures are logged and reported without stopping the other exposures.
+
+    Parameters
+    ----------
+    config : dict
+        Configuration from `parse_config`
+    n_workers : int
+        Number of worker processes. Exposures are processed serially when 1.
+    max_memory : Optional[float]
+        Memory budget in GB shared by all workers. A new exposure is only dispatched
+        if its estimated memory fits with the exposures already running.
+
+    Returns
+    -------
+    dict
+        Traceback of the error for each input file, or None for successful files
+    """
+    config["output_dir_stage1"].mkdir(exist_ok=True, parents=True)
+    config["output_dir_stage2"].mkdir(exist_ok=True, parents=True)
+    input_files = config["input_files"]
+
+    results = {}
+    if n_workers == 1:
+        for input_file in input_files:
+            results[input_file] = _reduce_exposure_safe(input_file, config)
+        return results
+
+    config = dict(
+        config, stage1_config=limit_ramp_fit_cores(config["stage1_config"], n_workers)
+    )
+    memory = {}
+    for input_file in input_files:
+        try:
+            memory[input_file] = estimate_memory(input_file, config)
+        except (OSError, KeyError):
+            # Unreadable files are still dispatched so that the error is reported
+            memory[input_file] = 0.0
+        if max_memory is not None and memory[input_file] > max_memory:
+            log.warning(
+                f"{input_file} needs about {memory[input_file]:.1f} GB, more than the"
+                f" {max_memory} GB budget. It will run alone."
+            )
+
+    manifest = RunManifest(config["manifest_file"])
+
+    # Spawn workers instead of forking a process that may hold threads
+    mp_context = multiprocessing.get_context("spawn")
+    executor = ProcessPoolExecutor(n_workers, mp_context=mp_context)
+    pending = list(input_files)
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < n_workers:
+                used_memory = sum(memory[f] for f in running.values())
+                if (
+                    max_memory is not None
+                    and running
+                    and used_memory + memory[pending[0]] > max_memory
+                ):
+                    break
+                input_file = pending.pop(0)
+                log.info(f"Dispatching {input_file} ({memory[input_file]:.1f} GB)")
+                future = executor.submit(_reduce_exposure_safe, input_file, config)
+                running[future] = input_file
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            if any(isinstance(f.exception(), BrokenProcessPool) for f in done):
+                # A worker was killed (e.g. out of memory): the pool is dead, so all
+                # its files fail together and a single new pool runs the next ones
+                done, _ = wait(running)
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(n_workers, mp_context=mp_context)
+            for future in done:
+                input_file = running.pop(future)
+                try:
+                    results[input_file] = future.result()
+                except BrokenProcessPool as e:
+                    results[input_file] = traceback.format_exc()
+                    _record_worker_failure(
+                        manifest, input_file, f"{type(e).__name__}: {e}"
+                    )
+                status = "failed" if results[input_file] else "done"
+                log.info(f"{input_file}: {status}")
+    finally:
+        executor.shutdown()
+
+    return results
+
+
+def main(argv: Optional[list] = None) -> int:
+    psr = ArgumentParser(description="Run Fourier imaging JWST reduction")
+    psr.add_argument(
+        "config_file", type=str, help="YAML configuration file for pipeline script"
+    )
+    psr.add_argument(
+        "-j",
+        "--n-workers",
+        type=int,
+        default=None,
+        help="Number of exposures processed in parallel (overrides n_workers in config)",
+    )
+    psr.add_argument(
+        "--max-memory",
+        type=float,
+        default=None,
+        help="Memory budget in GB shared by all workers (overrides max_memory in config)",
+    )
+    psr.add_argument(
+        "--force",
+        action="store_true",
+        help="Rerun exposures already completed in the run manifest (sets resume: false)",
+    )
+    psr.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the memory and runtime planned for each exposure without running",
+    )
+    psr.add_argument(
+        "--profile-reports",
+        nargs="+",
+        default=None,
+        help="Profile reports used to estimate runtimes (default: in output dirs)",
+    )
+    cli_args = psr.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    config = load_config(cli_args.config_file)
+    n_workers = cli_args.n_workers or config["n_workers"]
+    max_memory = cli_args.max_memory or config["max_memory"]
+    if cli_args.force:
+        config["resume"] = False
+
+    if cli_args.dry_run:
+        print(planner.format_plan(plan_batch(config, cli_args.profile_reports)))
+        return 0
+
+    results = reduce_batch(config, n_workers=n_workers, max_memory=max_memory)
+
+    failed = [input_file for input_file, error in results.items() if error]
+    log.info(f"{len(results) - len(failed)}/{len(results)} exposures reduced")
+    for input_file in failed:
+        log.error(f"{input_file} failed:\n{results[input_file]}")
+
+    return 1 if failed else 0
@@ -2,6 +2,7 @@
 from pathlib import Path
 
 from jwst_fourier.pipeline import Fourier1Pipeline, Fourier2Pipeline
+from jwst_fourier.reduce import get_stage1_path
 
 input_file = Path(
     "data/01189/jw01189017001_06101_00001_nis_uncal.fits"
@@ -59,14 +60,16 @@ for input_file in input_files:
         pipe1.save_results = True
         pipe1.output_dir = str(output_dir_stage1)
         pipe1.ipc.skip = True
-        pipe1.run(str(input_file), step_list=steps, cfg_dict=config_dict)
+        rate_model = pipe1.run(str(input_file), step_list=steps, cfg_dict=config_dict)
+        # Stage 1 products are passed to stage 2 without reading them back
+        stage1_files = [m for m in [rate_model, pipe1.ints_result] if m is not None]
+    else:
+        stage1_files = [
+            str(get_stage1_path(input_file, output_dir_stage1, suffix))
+            for suffix in ["rate", "rateints"]
+        ]
 
     if run_stage2:
-        file_base = input_file.name
-        stage1_files = []
-        for suffix in ["rate", "rateints"]:
-            stage1_file = str(output_dir_stage1 / file_base.replace("uncal", suffix))
-            stage1_files.append(stage1_file)
         pipe2 = Fourier2Pipeline()
         pipe2.save_results = True
         pipe2.output_dir = str(output_dir_stage2)